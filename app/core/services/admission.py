@@ -0,0 +1,250 @@
+"""
+Admission control for our DB bound routes
+
+Before a request reaches a route that talks to the DB it takes a token from
+its client's bucket, keyed by JWT subject (by IP for /auth/login and for
+requests without a valid token), then a slot under our global DB concurrency
+limit. Clients over their rate get a 429. When every slot is taken requests
+wait briefly in a bounded queue, then get a 503. Both come with Retry-After,
+so a burst is shed at the door instead of piling up on the DB pool. Limits
+are kept per worker process
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.core.config import settings
+from app.core.services.auth import CachedAuthJWT
+from app.core.services.metrics import (
+    admission_in_flight,
+    admission_queue_depth,
+    admission_rejections_total,
+    route_label,
+)
+
+# Routes that talk to the DB, everything else (status, metrics, docs) is let through
+DB_BOUND_PREFIXES = ("/data", "/auth", "/users")
+LOGIN_PATH = "/auth/login"
+
+
+class TokenBuckets:
+    """
+    Token bucket per client, refilling at rate tokens a second up to burst
+
+    Only the least recently seen maxsize clients are kept, a client we've
+    forgotten starts over with a full bucket
+    """
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, key: str) -> float:
+        """Takes a token for key, returns 0 if it had one, else seconds until it will"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        entry = self._buckets.get(key)
+        tokens = float(self.burst)
+        if entry is not None:
+            tokens, last = entry
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class ConcurrencyLimiter:
+    """
+    At most limit requests hold a slot at once, up to max_queue more wait for
+    one in order, for at most queue_timeout seconds
+
+    Only touched from the event loop, so needs no locking of its own
+    """
+
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _report(self) -> None:
+        admission_in_flight.set((), self.in_flight)
+        admission_queue_depth.set((), self.queue_depth)
+
+    async def acquire(self) -> bool:
+        """Waits for a slot, False if the queue is full or we waited too long"""
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self._report()
+            return True
+        if len(self._waiters) >= self.max_queue:
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self._report()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        except BaseException:
+            # Cancelled just as release handed us its slot, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self._report()
+        return True
+
+    def release(self) -> None:
+        # Hand our slot straight to the next request still waiting, if any
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._report()
+                return
+        self.in_flight -= 1
+        self._report()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "max_queue": self.max_queue,
+            "queue_depth": self.queue_depth,
+        }
+
+
+def token_subject(scope: Scope) -> Optional[str]:
+    """
+    Reads the subject out of a request's bearer token, None unless it's a
+    token we signed
+
+    Keying buckets by a made up sub would hand out a fresh burst per request,
+    so the signature is checked first. That goes through our claim cache, so
+    it's a lookup for any token we've seen before
+    """
+    for name, value in scope["headers"]:
+        if name != b"authorization":
+            continue
+        scheme, _, token = value.decode("latin-1").partition(" ")
+        if scheme.lower() != "bearer":
+            return None
+        try:
+            claims = CachedAuthJWT()._verified_token(token)
+        except Exception:
+            # However it failed (bad signature, expired, an alg we don't
+            # use), it's not a token we can key anything by
+            return None
+        subject = claims.get("sub")
+        return str(subject) if subject is not None else None
+    return None
+
+
+def client_ip(scope: Scope) -> str:
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+buckets = TokenBuckets(
+    settings.ADMISSION_RATE, settings.ADMISSION_BURST, settings.ADMISSION_MAX_CLIENTS
+)
+login_buckets = TokenBuckets(
+    settings.LOGIN_RATE, settings.LOGIN_BURST, settings.ADMISSION_MAX_CLIENTS
+)
+db_limiter = ConcurrencyLimiter(
+    settings.DB_CONCURRENCY_LIMIT,
+    settings.ADMISSION_MAX_QUEUE,
+    settings.ADMISSION_QUEUE_TIMEOUT,
+)
+
+
+class AdmissionMiddleware:
+    """Rate limits clients and caps concurrent DB bound requests"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # CORS preflights never reach a route, they cost us nothing
+        if (
+            scope["type"] != "http"
+            or scope["method"] == "OPTIONS"
+            or not scope["path"].startswith(DB_BOUND_PREFIXES)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        if scope["path"] == LOGIN_PATH:
+            retry_after = login_buckets.take(f"ip:{client_ip(scope)}")
+        else:
+            subject = token_subject(scope)
+            key = f"sub:{subject}" if subject is not None else f"ip:{client_ip(scope)}"
+            retry_after = buckets.take(key)
+        if retry_after:
+            await self.reject(
+                scope,
+                receive,
+                send,
+                429,
+                "rate_limited",
+                "Too many requests",
+                retry_after,
+            )
+            return
+
+        if not await db_limiter.acquire():
+            await self.reject(
+                scope,
+                receive,
+                send,
+                503,
+                "overloaded",
+                "Too busy, try again shortly",
+                db_limiter.queue_timeout,
+            )
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            db_limiter.release()
+
+    async def reject(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        status: int,
+        reason: str,
+        message: str,
+        retry_after: float,
+    ) -> None:
+        admission_rejections_total.inc((scope["method"], route_label(scope), reason))
+        response = JSONResponse(
+            status_code=status,
+            content={"admission_error": message},
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+        await response(scope, receive, send)
@@ -1,13 +1,21 @@
 """
 Functions for password hashing and verification
 """
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
 from fastapi_jwt_auth import AuthJWT
 
 from passlib.context import CryptContext
 
+from app.core.config import settings
+from app.core.services.denylist import get_denylist
 
-# Typically you'd store the deny list on something like redis, but for this demo, a set is ok
-denylist = set()
+# Revoked token ids, kept until the token would have expired anyway
+denylist = get_denylist()
 
 # Passlib context that we will hash/verify password with using bcrypt
 passwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
@@ -20,6 +28,99 @@ def check_if_in_denylist(plaintext_token):
     return jti in denylist
 
 
+class ClaimCache:
+    """
+    Bounded cache of verified JWT claims keyed by the raw token
+
+    Entries live until their token's exp, and can be purged by jti when a
+    token gets revoked
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Tuple[str, Optional[str]], Tuple[float, dict]]" = (
+            OrderedDict()
+        )
+        self._by_jti: Dict[str, Set[Tuple[str, Optional[str]]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, Optional[str]]) -> Optional[dict]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        exp, claims = entry
+        if exp < time.time():
+            # Let the JWT lib raise its usual expired error
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return claims
+
+    def put(self, key: Tuple[str, Optional[str]], claims: dict) -> None:
+        # Tokens without an exp or jti are rare enough to just not cache
+        if self.maxsize <= 0 or "exp" not in claims or "jti" not in claims:
+            return
+        self._data[key] = (claims["exp"], claims)
+        self._data.move_to_end(key)
+        self._by_jti.setdefault(claims["jti"], set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._drop(next(iter(self._data)))
+
+    def _drop(self, key: Tuple[str, Optional[str]]) -> None:
+        _, claims = self._data.pop(key)
+        keys = self._by_jti.get(claims["jti"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_jti[claims["jti"]]
+
+    def purge_jti(self, jti: str) -> None:
+        for key in list(self._by_jti.get(jti, ())):
+            self._drop(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+claim_cache = ClaimCache(settings.JWT_CLAIM_CACHE_SIZE)
+
+
+class CachedAuthJWT(AuthJWT):
+    """
+    AuthJWT that only verifies a token's signature the first time it sees it
+
+    jwt_required() alone decodes the same token twice, and routes decode it
+    again to read claims, so verified claims are cached until the token
+    expires. Revocation is still checked on every request through our
+    denylist, since a token can be revoked by another worker
+    """
+
+    def _verified_token(
+        self, encoded_token: str, issuer: Optional[str] = None
+    ) -> Dict[str, Any]:
+        key = (encoded_token, issuer)
+        claims = claim_cache.get(key)
+        if claims is None:
+            claims = super()._verified_token(encoded_token, issuer)
+            claim_cache.put(key, claims)
+        return claims
+
+
+# Revoke a token, denying it everywhere and dropping its cached claims here
+def revoke_token(raw_jwt: dict) -> None:
+    denylist.add(raw_jwt['jti'], raw_jwt.get('exp'))
+    claim_cache.purge_jti(raw_jwt['jti'])
+
+
 # Gets password from login request and returns hash
 def get_password_hash(password: str):
     return passwd_context.hash(password)
@@ -29,3 +130,83 @@ def get_password_hash(password: str):
 def verify_password(plain_text, hashed_pw):
     return passwd_context.verify(plain_text, hashed_pw)
 
+
+class HashPoolSaturated(Exception):
+    """Raised when too many hashing jobs are already waiting on the pool"""
+
+
+def _timed(fn: Callable, *args) -> Tuple[float, Any]:
+    # Runs in the worker, hands back when we started so we know how long we queued
+    return time.time(), fn(*args)
+
+
+class HashPool:
+    """
+    Small process pool that bcrypt runs in, so hashing never blocks the event loop
+
+    Only max_pending jobs may be queued or running at once, past that we
+    refuse new ones straight away instead of letting logins pile up
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def run(self, fn: Callable, *args) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HashPoolSaturated()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.pending += 1
+        submitted = time.time()
+        try:
+            loop = asyncio.get_event_loop()
+            started, result = await loop.run_in_executor(
+                self._executor, _timed, fn, *args
+            )
+        finally:
+            self.pending -= 1
+        wait = max(started - submitted, 0.0)
+        self.completed += 1
+        self.wait_seconds_total += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_avg": (
+                self.wait_seconds_total / self.completed if self.completed else 0.0
+            ),
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+hash_pool = HashPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_PENDING)
+
+
+# Same as get_password_hash, but runs in our hashing pool
+async def hash_password(password: str) -> str:
+    return await hash_pool.run(get_password_hash, password)
+
+
+# Same as verify_password, but runs in our hashing pool
+async def check_password(plain_text, hashed_pw) -> bool:
+    return await hash_pool.run(verify_password, plain_text, hashed_pw)
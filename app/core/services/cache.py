@@ -0,0 +1,100 @@
+"""
+Cache for comparison results
+
+A comparison only depends on the request and what's in census_records, so we
+key results on the normalized request plus a dataset version that gets bumped
+on every write to the table
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from app.core.config import settings
+from app.schemas.request import Request
+
+
+class LRUCache:
+    """
+    Bounded least recently used cache whose entries also expire after a TTL
+
+    Not thread safe, but we only touch it from the event loop without
+    awaiting in between, so that's fine
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        # Mark as most recently used
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        # Drop least recently used entries until we're back in bounds
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+comparison_cache = LRUCache(
+    settings.COMPARISON_CACHE_SIZE, settings.COMPARISON_CACHE_TTL
+)
+
+# Bumped every time census_records changes, part of every cache key so results
+# computed against older data can never be served
+dataset_version = 0
+
+
+def bump_dataset_version() -> int:
+    """Call after writing to census_records, invalidates every cached comparison"""
+    global dataset_version
+    dataset_version += 1
+    comparison_cache.clear()
+    return dataset_version
+
+
+def comparison_key(request: Request, age_range: str) -> Tuple:
+    # Many ages share an age range, and the result doesn't depend on anything
+    # else, so key on the range rather than the raw age. Sex and age are just
+    # echoed back, so they're left out too
+    return (
+        dataset_version,
+        request.year,
+        request.base_year if request.base_year else None,
+        age_range,
+        request.race,
+    )
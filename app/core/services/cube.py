@@ -0,0 +1,434 @@
+"""
+In-memory columnar cube of our census data
+
+The census table only changes on /data/load_pickle and /data/new_record, so
+instead of hitting the DB for every comparison we keep a copy of it in NumPy
+arrays indexed by (race, year, age_range) and rebuild it after every write
+
+With CENSUS_CUBE_SHARED on, whichever worker rebuilds publishes the cube to
+a SharedCubeStore and every worker serves it from there
+"""
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.services import cache
+from app.core.services.shared_cube import SharedCubeStore, owned_by_master, shared_dir
+from app.database import is_replica_session
+from app.models.record import CensusRecord
+
+# Numeric cols of a CensusRecord, in the order they're stored in the cube
+VALUE_FIELDS = (
+    "num_males_with_income",
+    "male_median_income_curr_dollars",
+    "male_median_income_2019_dollars",
+    "num_females_with_income",
+    "female_median_income_curr_dollars",
+    "female_median_income_2019_dollars",
+)
+# Cols we need to cast back to int when handing a row out
+COUNT_FIELDS = ("num_males_with_income", "num_females_with_income")
+
+
+# "15-24" and "Over 75", the age ranges process_xls.py writes out
+age_span_re = re.compile(r"^(?P<low>\d+)-(?P<high>\d+)$")
+age_over_re = re.compile(r"^Over (?P<low>\d+)$")
+
+
+class AgeBuckets:
+    """
+    Interval lookup from an age to the age range holding it
+
+    Built from whatever age ranges are in our data, so new ones need no code
+    changes. Ranges we can't parse are ignored
+    """
+
+    def __init__(self, age_ranges: Iterable[str]):
+        spans = []
+        for label in age_ranges:
+            match = age_span_re.match(label)
+            if match:
+                spans.append((int(match.group("low")), int(match.group("high")), label))
+                continue
+            match = age_over_re.match(label)
+            if match:
+                spans.append((int(match.group("low")), np.inf, label))
+        spans.sort()
+        # Sorted lower bounds, so finding an age's range is a binary search
+        self.lows = np.array([low for low, _, _ in spans], dtype=np.float64)
+        self.highs = np.array([high for _, high, _ in spans], dtype=np.float64)
+        self.labels = [label for _, _, label in spans]
+
+    def find(self, ages: Sequence[int]) -> List[Optional[str]]:
+        """Returns the age range for each age, None where no range holds it"""
+        if not self.labels:
+            return [None] * len(ages)
+        ages = np.asarray(ages, dtype=np.float64)
+        # Last range starting at or below each age, which has to reach it too
+        idx = np.searchsorted(self.lows, ages, side="right") - 1
+        found = (idx >= 0) & (ages <= self.highs[np.maximum(idx, 0)])
+        return [
+            self.labels[i] if ok else None
+            for i, ok in zip(idx.tolist(), found.tolist())
+        ]
+
+
+class CubeRow(NamedTuple):
+    """A single cell of the cube, quacks like a CensusRecord for reads"""
+    race: str
+    year: int
+    age_range: str
+    num_males_with_income: int
+    male_median_income_curr_dollars: float
+    male_median_income_2019_dollars: float
+    num_females_with_income: int
+    female_median_income_curr_dollars: float
+    female_median_income_2019_dollars: float
+
+
+class CensusCube:
+    """
+    Dense (race, year, age_range, field) array of our census data
+
+    Cubes are never mutated after being built, a rebuild creates a new one
+    and swaps it in, so readers always see a consistent snapshot
+    """
+
+    def __init__(
+        self,
+        races: Sequence[str],
+        years: Sequence[int],
+        age_ranges: Sequence[str],
+        values: np.ndarray,
+        present: np.ndarray,
+    ):
+        self.races = tuple(races)
+        self.years = tuple(int(y) for y in years)
+        self.age_ranges = tuple(age_ranges)
+        # Lookup tables from a label to its position along each axis
+        self.race_idx: Dict[str, int] = {r: i for i, r in enumerate(self.races)}
+        self.year_idx: Dict[int, int] = {y: i for i, y in enumerate(self.years)}
+        self.age_idx: Dict[str, int] = {a: i for i, a in enumerate(self.age_ranges)}
+        # Shape is (races, years, age_ranges, len(VALUE_FIELDS))
+        self.values = values
+        # Shape is (races, years, age_ranges), False where we have no data
+        self.present = present
+        self.age_buckets = AgeBuckets(self.age_ranges)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple]) -> "CensusCube":
+        """
+        Build a cube from (race, year, age_range, *VALUE_FIELDS) tuples
+
+        Rows must be ordered by id, if a (race, year, age_range) shows up more
+        than once we keep the first one, which is what a .first() query on the
+        table would have given us
+        """
+        rows = list(rows)
+        if not rows:
+            empty = np.empty((0, 0, 0, len(VALUE_FIELDS)), dtype=np.float64)
+            return cls((), (), (), empty, np.zeros((0, 0, 0), dtype=bool))
+
+        races, years, age_ranges, *cols = zip(*rows)
+        race_labels, race_codes = np.unique(
+            np.array(races, dtype=object), return_inverse=True
+        )
+        year_labels, year_codes = np.unique(
+            np.array(years, dtype=np.int64), return_inverse=True
+        )
+        age_labels, age_codes = np.unique(
+            np.array(age_ranges, dtype=object), return_inverse=True
+        )
+        data = np.column_stack([np.asarray(col, dtype=np.float64) for col in cols])
+
+        shape = (len(race_labels), len(year_labels), len(age_labels))
+        # Dedupe on our key, np.unique hands back the first occurrence of each
+        flat_keys = np.ravel_multi_index((race_codes, year_codes, age_codes), shape)
+        _, first = np.unique(flat_keys, return_index=True)
+
+        values = np.full(shape + (len(VALUE_FIELDS),), np.nan, dtype=np.float64)
+        present = np.zeros(shape, dtype=bool)
+        key = (race_codes[first], year_codes[first], age_codes[first])
+        values[key] = data[first]
+        present[key] = True
+        return cls(
+            race_labels.tolist(),
+            year_labels.tolist(),
+            age_labels.tolist(),
+            values,
+            present,
+        )
+
+    def get(self, race: str, year: int, age_range: str) -> Optional[CubeRow]:
+        """Grab a single row from the cube, None if we don't have one"""
+        try:
+            key = (self.race_idx[race], self.year_idx[year], self.age_idx[age_range])
+        except KeyError:
+            return None
+        if not self.present[key]:
+            return None
+        fields = dict(zip(VALUE_FIELDS, self.values[key].tolist()))
+        for field in COUNT_FIELDS:
+            fields[field] = int(fields[field])
+        return CubeRow(race=race, year=year, age_range=age_range, **fields)
+
+    def take(
+        self,
+        races: Sequence[str],
+        years: Sequence[Optional[int]],
+        age_ranges: Sequence[str],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized .get(), grabs one row per (race, year, age_range) key
+
+        Returns a (keys, len(VALUE_FIELDS)) array of values, NaN where we have
+        no data, and a bool array flagging which keys we found
+        """
+        race_codes = np.array([self.race_idx.get(r, -1) for r in races], dtype=np.intp)
+        year_codes = np.array(
+            [self.year_idx.get(y, -1) for y in years], dtype=np.intp
+        )
+        age_codes = np.array(
+            [self.age_idx.get(a, -1) for a in age_ranges], dtype=np.intp
+        )
+
+        values = np.full((len(race_codes), len(VALUE_FIELDS)), np.nan, dtype=np.float64)
+        present = np.zeros(len(race_codes), dtype=bool)
+        known = (race_codes >= 0) & (year_codes >= 0) & (age_codes >= 0)
+        key = (race_codes[known], year_codes[known], age_codes[known])
+        values[known] = self.values[key]
+        present[known] = self.present[key]
+        return values, present
+
+    def take_races(
+        self,
+        years: Sequence[Optional[int]],
+        age_ranges: Sequence[Optional[str]],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Grabs every race's row for each (year, age_range) key at once
+
+        Returns a (keys, races, len(VALUE_FIELDS)) array of values, NaN where
+        we have no data, and a (keys, races) bool array flagging which we found
+        """
+        year_codes = np.array(
+            [self.year_idx.get(y, -1) for y in years], dtype=np.intp
+        )
+        age_codes = np.array(
+            [self.age_idx.get(a, -1) for a in age_ranges], dtype=np.intp
+        )
+
+        n, r = len(year_codes), len(self.races)
+        values = np.full((n, r, len(VALUE_FIELDS)), np.nan, dtype=np.float64)
+        present = np.zeros((n, r), dtype=bool)
+        known = (year_codes >= 0) & (age_codes >= 0)
+        # Indexing (races, years, age_ranges) by year and age codes gives us
+        # (races, keys), flip it around to (keys, races)
+        values[known] = self.values[
+            :, year_codes[known], age_codes[known]
+        ].swapaxes(0, 1)
+        present[known] = self.present[:, year_codes[known], age_codes[known]].T
+        return values, present
+
+    def labels(self) -> Dict[str, list]:
+        """Our axis labels, enough to rebuild us around the same arrays"""
+        return {
+            "races": list(self.races),
+            "years": list(self.years),
+            "age_ranges": list(self.age_ranges),
+        }
+
+
+# The cube currently being served, swapped out whole on rebuild
+_cube: Optional[CensusCube] = None
+# Labels for when we have no cube, with the dataset version they were read at
+_labels: Optional[Tuple[int, "CensusLabels"]] = None
+# Make sure two writes don't race each other rebuilding, created lazily so
+# it binds to the loop we're served from
+_rebuild_lock: Optional[asyncio.Lock] = None
+# Store we share our cube through, and the generation of it _cube is
+_store: Optional[SharedCubeStore] = None
+_generation = 0
+
+
+async def load_cube(
+    session: AsyncSession,
+    races: Optional[Iterable[str]] = None,
+    years: Optional[Iterable[int]] = None,
+    age_ranges: Optional[Iterable[str]] = None,
+) -> CensusCube:
+    """
+    Builds a cube out of census_records in a single query
+
+    Any of races/years/age_ranges narrows down what we read, leave them out
+    to load the whole table
+    """
+    query = select(
+        CensusRecord.race,
+        CensusRecord.year,
+        CensusRecord.age_range,
+        *[getattr(CensusRecord, field) for field in VALUE_FIELDS],
+    ).order_by(CensusRecord.id)
+    if races is not None:
+        query = query.where(CensusRecord.race.in_(list(races)))
+    if years is not None:
+        query = query.where(CensusRecord.year.in_(list(years)))
+    if age_ranges is not None:
+        query = query.where(CensusRecord.age_range.in_(list(age_ranges)))
+    result = await session.execute(query)
+    return CensusCube.from_rows(result.all())
+
+
+def shared_store() -> Optional[SharedCubeStore]:
+    """Returns the store we share our cube through, None if we don't"""
+    global _store
+    # Opened on first use, so a forked worker finds its master's store
+    if _store is None and settings.CENSUS_CUBE_ENABLED and settings.CENSUS_CUBE_SHARED:
+        _store = SharedCubeStore(shared_dir())
+    return _store
+
+
+def _attach(store: SharedCubeStore, generation: int) -> bool:
+    # Swaps in a generation of the shared cube, False if it's already gone
+    global _cube, _generation
+    try:
+        labels, arrays = store.attach(generation)
+    except FileNotFoundError:
+        # Replaced again while we were getting to it, we'll pick up the
+        # newer one on our next read
+        return False
+    _cube = CensusCube(
+        labels["races"],
+        labels["years"],
+        labels["age_ranges"],
+        arrays["values"],
+        arrays["present"],
+    )
+    _generation = generation
+    return True
+
+
+def get_cube() -> Optional[CensusCube]:
+    """Returns the current cube, or None if it's disabled or not built yet"""
+    if not settings.CENSUS_CUBE_ENABLED:
+        return None
+    store = shared_store()
+    if store is not None:
+        generation = store.generation()
+        # Another worker changed the data, results we cached from the old
+        # cube are stale now too
+        if generation != _generation and _attach(store, generation):
+            cache.bump_dataset_version()
+    return _cube
+
+
+def get_generation() -> int:
+    """Generation of the shared cube we're serving, 0 if we're not sharing one"""
+    # Catch up first, we may not have read the cube since it last changed
+    get_cube()
+    return _generation
+
+
+async def rebuild_cube(session: AsyncSession) -> Optional[CensusCube]:
+    """Reads census_records and atomically swaps in a fresh cube"""
+    global _cube, _rebuild_lock
+    if not settings.CENSUS_CUBE_ENABLED:
+        return None
+    if _rebuild_lock is None:
+        _rebuild_lock = asyncio.Lock()
+    store = shared_store()
+    async with _rebuild_lock:
+        if store is None:
+            cube = await load_cube(session)
+            # Single reference assignment, readers get either the old or new cube
+            _cube = cube
+            return cube
+        loop = asyncio.get_event_loop()
+        while True:
+            # Only publish if no other worker has since we started reading,
+            # theirs may have read the table after us, so read it again. The
+            # store's lock is only held for the publish, on a thread of its own
+            expected = store.generation()
+            cube = await load_cube(session)
+            arrays = {"values": cube.values, "present": cube.present}
+            generation = await loop.run_in_executor(
+                None, store.publish, cube.labels(), arrays, expected
+            )
+            if generation is not None:
+                break
+        # Serve the shared copy rather than keeping our own around
+        _attach(store, generation)
+    return _cube
+
+
+@asynccontextmanager
+async def startup_lock():
+    """Held across workers starting up, so only one of them builds our cube"""
+    store = shared_store()
+    if store is None:
+        yield
+        return
+    held = store.lock("startup")
+    # Waiting on the worker that has it blocks, so do it off our loop
+    await asyncio.get_event_loop().run_in_executor(None, held.__enter__)
+    try:
+        yield
+    finally:
+        held.__exit__(None, None, None)
+
+
+async def init_cube(
+    session: AsyncSession, reload: bool = False
+) -> Optional[CensusCube]:
+    """
+    Gets us a cube on startup, building it unless we're sharing one another
+    worker already built and reload isn't set
+    """
+    store = shared_store()
+    if store is None or reload or not store.generation():
+        return await rebuild_cube(session)
+    return get_cube()
+
+
+def close_cube() -> None:
+    """Removes our shared cube on shutdown, unless a gunicorn master owns it"""
+    if _store is not None and not owned_by_master():
+        _store.remove()
+
+
+class CensusLabels(NamedTuple):
+    """The races and age ranges in census_records, same as a cube has"""
+    races: Tuple[str, ...]
+    age_buckets: AgeBuckets
+
+
+async def get_labels(session: AsyncSession):
+    """
+    Returns something with the races and age buckets in census_records, our
+    cube if we have one
+    """
+    global _labels
+    cube = get_cube()
+    if cube is not None:
+        return cube
+    # Without a cube, read the distinct labels once per dataset version
+    if _labels is None or _labels[0] != cache.dataset_version:
+        result = await session.execute(
+            select(CensusRecord.race, CensusRecord.age_range).distinct()
+        )
+        races, age_ranges = set(), set()
+        for race, age_range in result.all():
+            races.add(race)
+            age_ranges.add(age_range)
+        labels = CensusLabels(tuple(sorted(races)), AgeBuckets(age_ranges))
+        # Same as cached comparisons, a replica may lag behind this version
+        if is_replica_session(session):
+            return labels
+        _labels = (cache.dataset_version, labels)
+    return _labels[1]
@@ -0,0 +1,86 @@
+"""
+Reading the census dataset written by data_processing/process_xls.py
+
+The dataset is an uncompressed Arrow IPC file with a JSON manifest next to it,
+we memory map the file so only the columns and batches we touch get paged in.
+pyarrow is only imported once we actually open it, serving doesn't need it
+"""
+import json
+import os
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+class DatasetError(Exception):
+    """Raised when the dataset on disk doesn't match its manifest"""
+
+
+def manifest_path(path: str) -> str:
+    # census.arrow -> census.manifest.json
+    return os.path.splitext(path)[0] + ".manifest.json"
+
+
+def read_manifest(path: Optional[str] = None) -> Dict[str, Any]:
+    """Reads the manifest describing the dataset at path"""
+    path = path or settings.CENSUS_DATASET_PATH
+    with open(manifest_path(path)) as f:
+        return json.load(f)
+
+
+def open_dataset(
+    path: Optional[str] = None,
+    columns: Optional[Sequence[str]] = None,
+    races: Optional[Iterable[str]] = None,
+) -> "pa.Table":
+    """
+    Memory maps the dataset at path and returns it as an Arrow table
+
+    Leave columns/races out to read everything, otherwise only the columns
+    asked for and the record batches holding those races are read. Arrow
+    hands us buffers backed by the map, so nothing is copied until we convert
+    """
+    import pyarrow as pa
+
+    path = path or settings.CENSUS_DATASET_PATH
+    manifest = read_manifest(path)
+    reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+
+    # Make sure what's on disk is what the manifest says we wrote
+    schema = [{"name": field.name, "type": str(field.type)} for field in reader.schema]
+    if schema != manifest["schema"]:
+        raise DatasetError(f"{path} schema does not match its manifest")
+    if reader.num_record_batches != len(manifest["batches"]):
+        raise DatasetError(f"{path} record batches do not match its manifest")
+
+    # Pick out the batches we need using the manifest, skipping the rest
+    batch_ids = range(reader.num_record_batches)
+    if races is not None:
+        races = set(races)
+        batch_ids = [
+            i for i, batch in enumerate(manifest["batches"]) if batch["race"] in races
+        ]
+    batches = [reader.get_batch(i) for i in batch_ids]
+
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    if columns is not None:
+        table = table.select(list(columns))
+    return table
+
+
+def iter_rows(table: "pa.Table", columns: Sequence[str]) -> Iterator[Tuple]:
+    """Yields table rows as tuples of python values, one batch at a time"""
+    for batch in table.select(list(columns)).to_batches():
+        yield from zip(*(col.to_pylist() for col in batch.columns))
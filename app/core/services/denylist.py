@@ -0,0 +1,199 @@
+"""
+Stores for revoked token identifiers (JTIs)
+
+A revoked token only needs to stay denied until it would have expired anyway,
+so every entry is stored with its token's exp and dropped once that passes.
+Entries are grouped into time buckets so expiring them never means scanning
+everything we hold
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from app.core.config import settings
+
+
+class DenylistError(Exception):
+    """Raised when our denylist can't be opened"""
+
+
+class MemoryDenylist:
+    """
+    Per-process denylist, entries are bucketed by when they expire
+
+    Lookups and adds are O(1), and expired buckets are dropped whole
+    """
+
+    def __init__(self, bucket_seconds: int, default_ttl: int):
+        self.bucket_seconds = bucket_seconds
+        self.default_ttl = default_ttl
+        # jti -> exp
+        self._expiry: Dict[str, float] = {}
+        # bucket -> jtis expiring in it
+        self._buckets: Dict[int, Set[str]] = {}
+        # Oldest bucket we might still be holding
+        self._oldest = self._bucket(time.time())
+
+    def _bucket(self, ts: float) -> int:
+        return int(ts // self.bucket_seconds)
+
+    def _evict(self, now: float) -> None:
+        # Drop every bucket that has fully expired since we last looked
+        current = self._bucket(now)
+        while self._oldest < current:
+            for jti in self._buckets.pop(self._oldest, ()):
+                self._expiry.pop(jti, None)
+            self._oldest += 1
+
+    def add(self, jti: str, exp: Optional[float] = None) -> None:
+        now = time.time()
+        exp = exp or now + self.default_ttl
+        if exp < now:
+            # Token's already expired, nothing to deny
+            return
+        self._evict(now)
+        self._expiry[jti] = exp
+        self._buckets.setdefault(self._bucket(exp), set()).add(jti)
+
+    def __contains__(self, jti: str) -> bool:
+        exp = self._expiry.get(jti)
+        if exp is None:
+            return False
+        now = time.time()
+        self._evict(now)
+        return exp >= now
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def open(self) -> None:
+        """Nothing to open, kept in memory"""
+
+
+class SQLiteDenylist:
+    """
+    Denylist kept in a SQLite file, shared by every worker process on the host
+    and kept across restarts
+
+    Lookups go through the jti primary key, and expired rows are purged at
+    most once per bucket. Lookups run on the event loop, so JTIs we found not
+    revoked are remembered for cache_seconds and skip the file. A token
+    revoked by another worker can take that long to be denied here
+    """
+
+    def __init__(
+        self,
+        path: str,
+        bucket_seconds: int,
+        default_ttl: int,
+        cache_seconds: float = 0,
+        cache_size: int = 0,
+    ):
+        self.path = path
+        self.bucket_seconds = bucket_seconds
+        self.default_ttl = default_ttl
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._last_purge = 0
+        # jti -> when we last found it not revoked, least recently checked first
+        self._known_good: "OrderedDict[str, float]" = OrderedDict()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be shared across a fork, so each worker opens its own
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=5, check_same_thread=False, isolation_level=None
+            )
+            # WAL lets readers in every worker run alongside a writer
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS denylist "
+                "(jti TEXT PRIMARY KEY, exp REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_denylist_exp ON denylist (exp)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def open(self) -> None:
+        """
+        Opens our file up front, so a path we can't write to fails once on
+        startup instead of on every request that checks a token
+        """
+        try:
+            with self._lock:
+                self._connect()
+        except (OSError, sqlite3.Error) as e:
+            raise DenylistError(
+                f"can't open the denylist at {os.path.abspath(self.path)}: {e}. "
+                "Point DENYLIST_PATH somewhere this process can write, or set "
+                "DENYLIST_BACKEND=memory"
+            ) from e
+
+    def _purge(self, conn: sqlite3.Connection, now: float) -> None:
+        bucket = int(now // self.bucket_seconds)
+        if bucket > self._last_purge:
+            conn.execute("DELETE FROM denylist WHERE exp < ?", (now,))
+            self._last_purge = bucket
+
+    def add(self, jti: str, exp: Optional[float] = None) -> None:
+        now = time.time()
+        exp = exp or now + self.default_ttl
+        if exp < now:
+            return
+        with self._lock:
+            self._known_good.pop(jti, None)
+            conn = self._connect()
+            self._purge(conn, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO denylist (jti, exp) VALUES (?, ?)", (jti, exp)
+            )
+
+    def __contains__(self, jti: str) -> bool:
+        now = time.time()
+        with self._lock:
+            checked = self._known_good.get(jti)
+            if checked is not None and now - checked < self.cache_seconds:
+                return False
+            conn = self._connect()
+            self._purge(conn, now)
+            row = conn.execute(
+                "SELECT 1 FROM denylist WHERE jti = ? AND exp >= ?", (jti, now)
+            ).fetchone()
+            if row is None and self.cache_size > 0:
+                self._known_good[jti] = now
+                self._known_good.move_to_end(jti)
+                while len(self._known_good) > self.cache_size:
+                    self._known_good.popitem(last=False)
+        return row is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM denylist WHERE exp >= ?", (time.time(),)
+            ).fetchone()[0]
+
+
+def get_denylist():
+    """Builds the denylist store picked in our settings"""
+    if settings.DENYLIST_BACKEND == "memory":
+        return MemoryDenylist(
+            settings.DENYLIST_BUCKET_SECONDS, settings.DENYLIST_DEFAULT_TTL
+        )
+    if settings.DENYLIST_BACKEND == "sqlite":
+        return SQLiteDenylist(
+            settings.DENYLIST_PATH,
+            settings.DENYLIST_BUCKET_SECONDS,
+            settings.DENYLIST_DEFAULT_TTL,
+            settings.DENYLIST_CACHE_SECONDS,
+            settings.DENYLIST_CACHE_SIZE,
+        )
+    raise ValueError(f"unknown DENYLIST_BACKEND {settings.DENYLIST_BACKEND}")
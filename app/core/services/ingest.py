@@ -0,0 +1,210 @@
+"""
+Streaming ingestion of census records posted as NDJSON or CSV
+
+The request body is read as it arrives, split into lines and validated one
+row at a time against RecordIn. Valid rows are inserted a chunk at a time, so
+memory stays bounded by the chunk size however big the upload is
+"""
+import csv
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.services.loader import COLUMNS, insert_chunk
+from app.schemas.record import RecordIn
+
+# Longest line we'll buffer waiting for its newline
+MAX_LINE_BYTES = 1 << 16
+# Validation errors we report back, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+class IngestError(Exception):
+    """Raised when the body can't be read any further"""
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, str]]:
+    """Yields (line number, line) from a stream of bytes, skipping blank lines"""
+    buffer = b""
+    line_no = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                yield line_no, line.decode("utf-8")
+        if len(buffer) > MAX_LINE_BYTES:
+            raise IngestError(
+                f"line {line_no + 1} is longer than {MAX_LINE_BYTES} bytes"
+            )
+    if buffer.strip():
+        yield line_no + 1, buffer.decode("utf-8")
+
+
+async def iter_ndjson(
+    lines: AsyncIterator[Tuple[int, str]]
+) -> AsyncIterator[Tuple[int, Any]]:
+    # Bad JSON is passed along as a ValueError so it gets reported like any
+    # other bad row
+    async for line_no, line in lines:
+        try:
+            yield line_no, json.loads(line)
+        except ValueError:
+            yield line_no, ValueError("invalid JSON")
+
+
+async def iter_csv(
+    lines: AsyncIterator[Tuple[int, str]]
+) -> AsyncIterator[Tuple[int, Any]]:
+    # First line is our header, rows can't have newlines inside quoted values
+    header = None
+    async for line_no, line in lines:
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [col.strip() for col in values]
+            continue
+        if len(values) != len(header):
+            yield line_no, ValueError(
+                f"expected {len(header)} values, got {len(values)}"
+            )
+            continue
+        yield line_no, dict(zip(header, values))
+
+
+class IngestResult:
+    """What happened to an upload, returned as our response body"""
+
+    def __init__(self):
+        self.rows_received = 0
+        self.rows_inserted = 0
+        self.rows_invalid = 0
+        self.chunks_committed = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.failure: Optional[str] = None
+        self.seconds = 0.0
+
+    def add_error(self, line_no: int, errors: Any) -> None:
+        self.rows_invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_no, "errors": errors})
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            "status": "failed" if self.failure else "ok",
+            "failure": self.failure,
+            "rows_received": self.rows_received,
+            "rows_inserted": self.rows_inserted,
+            "rows_invalid": self.rows_invalid,
+            "chunks_committed": self.chunks_committed,
+            "errors": self.errors,
+            "errors_truncated": self.rows_invalid > len(self.errors),
+            "seconds": self.seconds,
+            "rows_per_sec": self.rows_inserted / self.seconds if self.seconds else 0.0,
+        }
+
+
+def _parse_row(row: Any) -> Tuple[Optional[Tuple], Optional[List[Dict[str, Any]]]]:
+    """
+    Validates a row as a RecordIn, returns its COLUMNS values, or the errors
+    that make it invalid
+    """
+    if isinstance(row, ValueError):
+        return None, [{"msg": str(row)}]
+    try:
+        record = RecordIn.parse_obj(row)
+    except ValidationError as e:
+        return None, e.errors()
+    return tuple(getattr(record, col) for col in COLUMNS), None
+
+
+class _ChunkWriter:
+    """
+    Inserts rows a chunk at a time, committing after each chunk or once at
+    the end, and counts what got committed in result
+    """
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        result: IngestResult,
+        commit_each_chunk: bool,
+        chunk_size: int,
+    ):
+        self.session = session
+        self.result = result
+        self.commit_each_chunk = commit_each_chunk
+        self.chunk_size = chunk_size
+        self.chunk: List[Tuple] = []
+        # Rows inserted but not committed yet
+        self.pending = 0
+
+    async def add(self, values: Tuple) -> None:
+        self.chunk.append(values)
+        if len(self.chunk) >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.chunk:
+            return
+        await insert_chunk(self.session, self.chunk)
+        self.pending += len(self.chunk)
+        self.chunk = []
+        if self.commit_each_chunk:
+            await self.commit()
+
+    async def commit(self) -> None:
+        await self.session.commit()
+        self.result.rows_inserted += self.pending
+        self.result.chunks_committed += 1
+        self.pending = 0
+
+    async def finish(self) -> None:
+        await self.flush()
+        if not self.commit_each_chunk:
+            await self.commit()
+
+
+async def ingest_records(
+    session: AsyncSession,
+    body: AsyncIterator[bytes],
+    fmt: str,
+    commit_each_chunk: bool = False,
+) -> IngestResult:
+    """
+    Validates and inserts the records in body, skipping (and reporting) rows
+    that aren't valid RecordIns
+
+    Everything goes in one transaction unless commit_each_chunk is set, in
+    which case a failure only loses the chunk it happened in
+    """
+    result = IngestResult()
+    start = time.perf_counter()
+    lines = iter_lines(body)
+    rows = iter_csv(lines) if fmt == "csv" else iter_ndjson(lines)
+    writer = _ChunkWriter(
+        session, result, commit_each_chunk, settings.BULK_LOAD_CHUNK_SIZE
+    )
+    try:
+        async for line_no, row in rows:
+            result.rows_received += 1
+            values, errors = _parse_row(row)
+            if errors is not None:
+                result.add_error(line_no, errors)
+                continue
+            await writer.add(values)
+        await writer.finish()
+    except (IngestError, UnicodeDecodeError) as e:
+        # Whatever we haven't committed yet is lost
+        await session.rollback()
+        result.failure = str(e)
+    except Exception:
+        await session.rollback()
+        # Don't hand DB internals back to the client
+        result.failure = "DB error inserting records"
+    result.seconds = time.perf_counter() - start
+    return result
@@ -0,0 +1,215 @@
+"""
+Background load jobs
+
+Loading a dataset can take longer than a proxy will hold a request open, so
+/data/load_pickle hands loads to our job runner and answers with a job id
+straight away. Jobs run on the event loop in their own session, at most
+LOAD_JOB_WORKERS at a time and only one per dataset. Like our metrics, jobs
+are kept per worker process
+"""
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import text
+
+from app.core.config import settings
+from app.core.services.cache import bump_dataset_version
+from app.core.services.cube import rebuild_cube
+from app.core.services.dataset import DatasetError, read_manifest
+from app.core.services.loader import LOAD_LOCK_ID, load_census_dataset
+from app.database import AsyncSessionLocal
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    # Load is done and being committed, too late to cancel
+    committing = "committing"
+    succeeded = "succeeded"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+FINISHED = (JobStatus.succeeded, JobStatus.failed, JobStatus.cancelled)
+
+
+class LoadCancelled(Exception):
+    """Raised from a job's progress callback to abort and roll back its load"""
+
+
+class JobConflict(Exception):
+    """Raised when a dataset already has a load queued or running"""
+
+    def __init__(self, dataset: str, job: Optional["LoadJob"] = None):
+        by = f"job {job.id}" if job is not None else "another worker"
+        super().__init__(f"{dataset} is already being loaded by {by}")
+        self.job = job
+
+
+class LoadJob:
+    """A single dataset load and how far it has got"""
+
+    def __init__(self, dataset: str):
+        self.id = uuid.uuid4().hex
+        self.dataset = dataset
+        self.status = JobStatus.queued
+        self.rows_processed = 0
+        self.rows_total: Optional[int] = None
+        self.error: Optional[str] = None
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Future] = None
+
+    def progress(self, rows: int, final: bool = False) -> None:
+        """Progress callback for bulk_load, also where cancelling takes effect"""
+        self.rows_processed = rows
+        if self.cancel_requested:
+            raise LoadCancelled()
+        if final:
+            self.status = JobStatus.committing
+
+    @property
+    def seconds(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def dict(self) -> Dict[str, Any]:
+        seconds = self.seconds
+        return {
+            "job_id": self.id,
+            "dataset": self.dataset,
+            "status": self.status.value,
+            "rows_processed": self.rows_processed,
+            "rows_total": self.rows_total,
+            "rows_per_sec": self.rows_processed / seconds if seconds else 0.0,
+            "seconds": seconds,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class LoadJobRunner:
+    """
+    Runs load jobs in the background, a bounded number at a time
+
+    Only touched from the event loop, so needs no locking of its own
+    """
+
+    def __init__(self, workers: int, history: int):
+        self.workers = workers
+        self.history = history
+        self.jobs: "OrderedDict[str, LoadJob]" = OrderedDict()
+        # Job queued or running for each dataset
+        self._active: Dict[str, LoadJob] = {}
+        # Created lazily so it binds to the loop we're served from
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def submit(self, dataset: str, run: Callable[[LoadJob], Awaitable[Any]]) -> LoadJob:
+        """Queues run(job) for dataset, raises JobConflict if it already has one"""
+        active = self._active.get(dataset)
+        if active is not None:
+            raise JobConflict(dataset, active)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        job = LoadJob(dataset)
+        self.jobs[job.id] = job
+        self._active[dataset] = job
+        job.task = asyncio.ensure_future(self._run(job, run))
+        self._trim()
+        return job
+
+    async def _run(
+        self, job: LoadJob, run: Callable[[LoadJob], Awaitable[Any]]
+    ) -> None:
+        try:
+            async with self._slots:
+                # Cancelled before it got a slot, nothing to roll back
+                if job.cancel_requested:
+                    job.status = JobStatus.cancelled
+                    return
+                job.status = JobStatus.running
+                job.started_at = time.time()
+                await run(job)
+            job.status = JobStatus.succeeded
+        except LoadCancelled:
+            job.status = JobStatus.cancelled
+        except Exception as e:
+            job.status = JobStatus.failed
+            # Don't hand DB internals out through our status endpoint
+            if isinstance(e, (DatasetError, JobConflict, OSError)):
+                job.error = str(e)
+            else:
+                job.error = "DB error loading dataset"
+        finally:
+            job.finished_at = time.time()
+            if self._active.get(job.dataset) is job:
+                del self._active[job.dataset]
+
+    def _trim(self) -> None:
+        # Forget the oldest finished jobs once we're over our history
+        finished = [
+            job_id for job_id, job in self.jobs.items() if job.status in FINISHED
+        ]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[LoadJob]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[LoadJob]:
+        """
+        Asks a job to stop, it rolls back at its next chunk. Finished jobs,
+        and ones already committing, are left as they are
+        """
+        job = self.jobs.get(job_id)
+        if (
+            job is not None
+            and job.status not in FINISHED
+            and job.status != JobStatus.committing
+        ):
+            job.cancel_requested = True
+        return job
+
+    async def wait(self, job: LoadJob) -> LoadJob:
+        """Waits for job to finish, without cancelling it if we're cancelled"""
+        await asyncio.shield(job.task)
+        return job
+
+    async def shutdown(self) -> None:
+        """Cancels whatever is still running and waits for it to roll back"""
+        tasks = []
+        for job in self._active.values():
+            job.cancel_requested = True
+            tasks.append(job.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_census_load(job: LoadJob, upsert: bool = False) -> None:
+    """Loads our census dataset as job, then swaps in a fresh cube"""
+    job.rows_total = read_manifest()["num_rows"]
+    async with AsyncSessionLocal() as session:
+        if session.bind.dialect.name == "postgresql":
+            # Other workers run their own jobs, held until our load commits
+            result = await session.execute(
+                text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": LOAD_LOCK_ID}
+            )
+            if not result.scalar():
+                await session.rollback()
+                raise JobConflict(job.dataset)
+        await load_census_dataset(session, upsert=upsert, progress=job.progress)
+        # Table changed, swap in a fresh census cube and drop cached comparisons
+        await rebuild_cube(session)
+        bump_dataset_version()
+
+
+job_runner = LoadJobRunner(settings.LOAD_JOB_WORKERS, settings.LOAD_JOB_HISTORY)
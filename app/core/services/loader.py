@@ -0,0 +1,307 @@
+"""
+Bulk loading of census data into census_records
+
+On Postgres rows are streamed in chunks through asyncpg's binary COPY, which
+skips building ORM objects and per-row INSERTs entirely, other DBs fall back
+to chunked executemany INSERTs
+"""
+import time
+from itertools import islice
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from sqlalchemy import bindparam, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.services.cube import VALUE_FIELDS
+from app.core.services.dataset import iter_rows, open_dataset, read_manifest
+from app.models.dataset import LoadedDataset
+from app.models.record import CensusRecord
+
+# Cols we load, in the order rows are handed to us
+COLUMNS = ("race", "age_range", "year", *VALUE_FIELDS)
+# What makes a census row unique when upserting
+KEY_COLUMNS = ("race", "year", "age_range")
+
+STAGING_TABLE = "census_records_staging"
+# What we record our census dataset as in loaded_datasets
+DATASET_NAME = "census"
+# Arbitrary key for the Postgres advisory lock that keeps workers from
+# loading the census dataset at the same time
+LOAD_LOCK_ID = 720_816
+
+
+class LoadResult(NamedTuple):
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def _chunks(rows: Iterable[Tuple], size: int) -> Iterator[List[Tuple]]:
+    # Split our rows into lists of at most size rows without materializing them all
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _asyncpg_connection(session: AsyncSession):
+    # SQLAlchemy only opens the asyncpg transaction once it runs a statement,
+    # make sure it's open so our COPY commits or rolls back with the session
+    await session.execute(text("SELECT 1"))
+    # Grab the asyncpg connection under our session's transaction, the one
+    # SQLAlchemy's DBAPI adapter wraps
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    return raw.driver_connection
+
+
+async def insert_chunk(session: AsyncSession, chunk: List[Tuple]) -> None:
+    """
+    Inserts a chunk of (race, age_range, year, *VALUE_FIELDS) tuples as part
+    of session's transaction, leaving committing up to the caller
+    """
+    if session.bind.dialect.driver == "asyncpg":
+        pg = await _asyncpg_connection(session)
+        await pg.copy_records_to_table(
+            CensusRecord.__tablename__, records=chunk, columns=COLUMNS
+        )
+    else:
+        await session.execute(
+            insert(CensusRecord), [dict(zip(COLUMNS, row)) for row in chunk]
+        )
+
+
+# Called with the rows loaded so far after every chunk, and once more with
+# final set right before we commit. Raising from it aborts and rolls back the
+# load
+Progress = Optional[Callable[[int, bool], None]]
+
+
+def _report(progress: Progress, total: int, final: bool = False) -> None:
+    if progress is not None:
+        progress(total, final)
+
+
+async def _copy_load(
+    session: AsyncSession,
+    rows: Iterable[Tuple],
+    upsert: bool,
+    chunk_size: int,
+    progress: Progress,
+) -> int:
+    pg = await _asyncpg_connection(session)
+
+    table = CensusRecord.__tablename__
+    # Without upsert we can COPY straight into the table
+    target = table
+    if upsert:
+        # Otherwise COPY into a temp table and merge it in, seq keeps track of
+        # the order rows came in so the first copy of a key wins
+        target = STAGING_TABLE
+        await pg.execute(f"""
+            CREATE TEMP TABLE {STAGING_TABLE} (
+                seq bigserial,
+                race varchar(10),
+                age_range varchar(10),
+                year smallint,
+                num_males_with_income smallint,
+                male_median_income_curr_dollars double precision,
+                male_median_income_2019_dollars double precision,
+                num_females_with_income smallint,
+                female_median_income_curr_dollars double precision,
+                female_median_income_2019_dollars double precision
+            ) ON COMMIT DROP
+        """)
+
+    total = 0
+    for chunk in _chunks(rows, chunk_size):
+        await pg.copy_records_to_table(target, records=chunk, columns=COLUMNS)
+        total += len(chunk)
+        _report(progress, total)
+
+    if upsert:
+        cols = ", ".join(COLUMNS)
+        keys = " AND ".join(f"c.{k} = s.{k}" for k in KEY_COLUMNS)
+        deduped = (
+            f"SELECT DISTINCT ON ({', '.join(KEY_COLUMNS)}) * FROM {STAGING_TABLE} "
+            f"ORDER BY {', '.join(KEY_COLUMNS)}, seq"
+        )
+        # Update rows we already have in place so their ids don't change...
+        await pg.execute(
+            f"UPDATE {table} c SET "
+            + ", ".join(f"{f} = s.{f}" for f in VALUE_FIELDS)
+            + f" FROM ({deduped}) s WHERE {keys}"
+        )
+        # ...then add the ones we don't
+        await pg.execute(
+            f"INSERT INTO {table} ({cols}) SELECT {cols} FROM ({deduped}) s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {table} c WHERE {keys}) ORDER BY s.seq"
+        )
+    return total
+
+
+async def _existing_ids(session: AsyncSession) -> Dict[Tuple, int]:
+    # Map each key we already have to its id so we can update in place
+    result = await session.execute(
+        select(CensusRecord.id, *[getattr(CensusRecord, k) for k in KEY_COLUMNS])
+        .order_by(CensusRecord.id)
+    )
+    existing: Dict[Tuple, int] = {}
+    for row_id, *key in result.all():
+        existing.setdefault(tuple(key), row_id)
+    return existing
+
+
+def _split_upserts(
+    chunk: List[Tuple], existing: Dict[Tuple, int], seen: Set[Tuple]
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    # Splits a chunk into rows to insert and updates to rows we already have
+    inserts, updates = [], []
+    for row in chunk:
+        values = dict(zip(COLUMNS, row))
+        key = tuple(values[k] for k in KEY_COLUMNS)
+        # First copy of a key wins, just like the COPY path
+        if key in seen:
+            continue
+        seen.add(key)
+        if key in existing:
+            updates.append(
+                {"_id": existing[key], **{f"_{f}": values[f] for f in VALUE_FIELDS}}
+            )
+        else:
+            inserts.append(values)
+    return inserts, updates
+
+
+async def _write_chunk(
+    session: AsyncSession,
+    inserts: List[Dict[str, Any]],
+    updates: List[Dict[str, Any]],
+) -> None:
+    if inserts:
+        await session.execute(insert(CensusRecord), inserts)
+    if updates:
+        await session.execute(
+            update(CensusRecord.__table__)
+            .where(CensusRecord.id == bindparam("_id"))
+            .values({f: bindparam(f"_{f}") for f in VALUE_FIELDS}),
+            updates,
+        )
+
+
+async def _insert_load(
+    session: AsyncSession,
+    rows: Iterable[Tuple],
+    upsert: bool,
+    chunk_size: int,
+    progress: Progress,
+) -> int:
+    existing = await _existing_ids(session) if upsert else {}
+    seen: Set[Tuple] = set()
+    total = 0
+    for chunk in _chunks(rows, chunk_size):
+        total += len(chunk)
+        if upsert:
+            await _write_chunk(session, *_split_upserts(chunk, existing, seen))
+        else:
+            await _write_chunk(session, [dict(zip(COLUMNS, row)) for row in chunk], [])
+        _report(progress, total)
+    return total
+
+
+async def bulk_load(
+    session: AsyncSession,
+    rows: Iterable[Tuple],
+    upsert: bool = False,
+    manifest: Optional[Dict[str, Any]] = None,
+    progress: Progress = None,
+) -> LoadResult:
+    """
+    Loads (race, age_range, year, *VALUE_FIELDS) tuples into census_records
+
+    If upsert is set, rows whose (race, year, age_range) we already have get
+    updated in place instead of duplicated, so loading the same data twice is
+    a no-op. If the manifest of the dataset the rows came from is given, we
+    record its hash in the same transaction. progress is called after every
+    chunk and before committing. Commits on success, rolls back and re-raises
+    on failure
+    """
+    chunk_size = settings.BULK_LOAD_CHUNK_SIZE
+    start = time.perf_counter()
+    try:
+        if session.bind.dialect.driver == "asyncpg":
+            total = await _copy_load(session, rows, upsert, chunk_size, progress)
+        else:
+            total = await _insert_load(session, rows, upsert, chunk_size, progress)
+        if manifest is not None:
+            await session.merge(
+                LoadedDataset(
+                    name=DATASET_NAME,
+                    sha256=manifest["sha256"],
+                    num_rows=manifest["num_rows"],
+                )
+            )
+        # Last chance to back out, so a cancel after our last chunk still counts
+        _report(progress, total, final=True)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return LoadResult(rows=total, seconds=time.perf_counter() - start)
+
+
+async def load_census_dataset(
+    session: AsyncSession, upsert: bool = False, progress: Progress = None
+) -> LoadResult:
+    """Loads our Arrow census dataset into census_records"""
+    manifest = read_manifest()
+    # Memory map our dataset, only reading the cols we load
+    table = open_dataset(columns=COLUMNS)
+    # Stream the rows into the DB in chunks, skipping ORM objects entirely
+    return await bulk_load(
+        session,
+        iter_rows(table, COLUMNS),
+        upsert=upsert,
+        manifest=manifest,
+        progress=progress,
+    )
+
+
+async def bootstrap_census_dataset(session: AsyncSession) -> Optional[LoadResult]:
+    """
+    Loads our census dataset on startup, unless the copy we last loaded has
+    the same content hash as what's on disk
+
+    Upserts, so a changed dataset updates rows in place. Returns None if
+    there was nothing to do
+    """
+    manifest = read_manifest()
+    if session.bind.dialect.name == "postgresql":
+        # Workers starting together wait their turn, held until our load
+        # commits, so the ones after us find it already loaded
+        await session.execute(
+            text("SELECT pg_advisory_xact_lock(:id)"), {"id": LOAD_LOCK_ID}
+        )
+    loaded = await session.get(LoadedDataset, DATASET_NAME)
+    if loaded is not None and loaded.sha256 == manifest["sha256"]:
+        # Let go of our lock
+        await session.rollback()
+        return None
+    return await load_census_dataset(session, upsert=True)
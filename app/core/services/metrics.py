@@ -0,0 +1,263 @@
+"""
+Request and DB metrics, exposed in the Prometheus text format
+
+Every HTTP request is timed by our middleware and labelled with the route it
+matched (its path template, so /data/1 and /data/2 count as /data/{record_id}).
+SQLAlchemy engine events add the queries a request ran, and how long they
+took, to whichever request is active, so we can tell DB time from everything
+else. Metrics are kept per process
+"""
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Same as the Prometheus client defaults, in seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0
+)
+
+Labels = Tuple[str, ...]
+
+
+class Histogram:
+    """Cumulative histogram with one series per set of label values"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str],
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self._series: Dict[Labels, List] = {}
+
+    def observe(self, labels: Labels, value: float) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            base = _format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+        return lines
+
+
+class Counter:
+    """Counter (or gauge, it can go down) with one series per set of labels"""
+
+    def __init__(
+        self, name: str, help: str, label_names: Sequence[str], kind: str = "counter"
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.kind = kind
+        self._series: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels, amount: float = 1) -> None:
+        self._series[labels] = self._series.get(labels, 0) + amount
+
+    def set(self, labels: Labels, value: float) -> None:
+        self._series[labels] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self._series.items()):
+            base = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}{{{base}}} {value}")
+        return lines
+
+
+def _format_labels(names: Sequence[str], values: Labels) -> str:
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+ROUTE_LABELS = ("method", "route")
+
+request_duration = Histogram(
+    "http_request_duration_seconds", "Time spent handling requests", ROUTE_LABELS
+)
+requests_total = Counter(
+    "http_requests_total",
+    "Requests handled, by status code",
+    ROUTE_LABELS + ("status",),
+)
+requests_in_flight = Counter(
+    "http_requests_in_flight",
+    "Requests being handled right now",
+    ROUTE_LABELS,
+    kind="gauge",
+)
+request_db_duration = Histogram(
+    "http_request_db_duration_seconds",
+    "Time each request spent waiting on DB queries",
+    ROUTE_LABELS,
+)
+db_queries_total = Counter(
+    "db_queries_total", "DB queries run while handling requests", ROUTE_LABELS
+)
+db_seconds_total = Counter(
+    "db_query_seconds_total",
+    "Time spent on DB queries while handling requests",
+    ROUTE_LABELS,
+)
+admission_rejections_total = Counter(
+    "admission_rejections_total",
+    "Requests turned away by admission control, by why",
+    ROUTE_LABELS + ("reason",),
+)
+admission_in_flight = Counter(
+    "admission_in_flight",
+    "DB bound requests holding a concurrency slot",
+    (),
+    kind="gauge",
+)
+admission_queue_depth = Counter(
+    "admission_queue_depth",
+    "DB bound requests waiting for a concurrency slot",
+    (),
+    kind="gauge",
+)
+
+METRICS = (
+    request_duration,
+    requests_total,
+    requests_in_flight,
+    request_db_duration,
+    db_queries_total,
+    db_seconds_total,
+    admission_rejections_total,
+    admission_in_flight,
+    admission_queue_depth,
+)
+
+
+class RequestDBStats:
+    """DB work done by a single request"""
+
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+# DB stats of the request being handled, set by our middleware
+_request_db_stats: ContextVar[Optional[RequestDBStats]] = ContextVar(
+    "request_db_stats", default=None
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += elapsed
+
+
+def _handle_error(exception_context):
+    # Failed queries never reach after_cursor_execute, don't leak their start
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Hooks our engine so the queries it runs count towards the active request"""
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+def route_label(scope: Scope) -> str:
+    # Label requests by the path template of the route they hit, so the
+    # number of series stays bounded no matter what paths get requested
+    partial = None
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "<unmatched>"
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and attributes DB work to it"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        labels = (scope["method"], route_label(scope))
+        status = 500
+        stats = RequestDBStats()
+        token = _request_db_stats.set(stats)
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        requests_in_flight.inc(labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_duration.observe(labels, time.perf_counter() - start)
+            requests_in_flight.inc(labels, -1)
+            requests_total.inc(labels + (str(status),))
+            request_db_duration.observe(labels, stats.seconds)
+            db_queries_total.inc(labels, stats.queries)
+            db_seconds_total.inc(labels, stats.seconds)
+            _request_db_stats.reset(token)
+
+
+def render_metrics() -> str:
+    """Everything we track, in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
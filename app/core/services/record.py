@@ -1,204 +1,308 @@
-from sqlalchemy import select
-from sqlalchemy.exc import NoResultFound
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.models.record import *
-from app.schemas.comparison import Comparison
+from app.core.services.cache import comparison_cache, comparison_key
+from app.core.services.cube import VALUE_FIELDS, get_cube, get_labels, load_cube
+from app.core.services.serialize import comparison as build_comparison
+from app.database import is_replica_session
 from app.schemas.request import Request
+from app.schemas.trend import TrendRequest
+
+
+# Races our trends report the income and population gap between
+GAP_RACES = ("white", "asian")
+# Cols of _incomes/_pops output
+SEXES = ("male", "female")
+# Where each col we need lives in a cube row
+NUM_MALES = VALUE_FIELDS.index("num_males_with_income")
+MALE_CURR = VALUE_FIELDS.index("male_median_income_curr_dollars")
+MALE_2019 = VALUE_FIELDS.index("male_median_income_2019_dollars")
+NUM_FEMALES = VALUE_FIELDS.index("num_females_with_income")
+FEMALE_CURR = VALUE_FIELDS.index("female_median_income_curr_dollars")
+FEMALE_2019 = VALUE_FIELDS.index("female_median_income_2019_dollars")
+# What we key requests whose age no age range holds by
+NO_AGE_RANGE = "age_error"
 
 
-async def get_age_range_from_req(age: int) -> str:
+async def get_age_ranges(ages: List[int], session: AsyncSession) -> List[str]:
+    # Look up the age range each age is in, out of the age ranges in our data
+    labels = await get_labels(session)
+    return [age_range or NO_AGE_RANGE for age_range in labels.age_buckets.find(ages)]
+
+
+async def get_age_range_from_req(age: int, session: AsyncSession) -> str:
     # Figure out what age range our request is in to query data
-    if age < 15:
-        return "age_too_low"
-    elif 15 <= age <= 24:
-        return "15-24"
-    elif 25 <= age <= 34:
-        return "25-34"
-    elif 35 <= age <= 44:
-        return "35-44"
-    elif 45 <= age <= 54:
-        return "45-54"
-    return "age_error"
+    return (await get_age_ranges([age], session))[0]
 
 
 # This is what actually does the bulk of the work in this API, it takes in a request
 # as per the spec and then does the comparison
 async def make_comparison(request: Request, session: AsyncSession):
-    age_range = await get_age_range_from_req(request.age)
-    # To make the comparison, we need to grab pertinent data for both races
-    try:
-        # Get a sample of our data for w race
-        w_data_req = await session.execute(
-            select(CensusRecord).where(
-                CensusRecord.race == "white",
-                CensusRecord.year == request.year,
-                CensusRecord.age_range == age_range,
+    return (await make_comparisons([request], session))[0]
+
+
+# Serve comparisons out of our result cache, only computing them on a miss
+async def get_cached_comparison(request: Request, session: AsyncSession):
+    age_range = await get_age_range_from_req(request.age, session)
+    key = comparison_key(request, age_range)
+    result = comparison_cache.get(key)
+    if result is None:
+        result = await make_comparison(request, session)
+        # Without our cube this was read from session, and a lagging replica
+        # may not have what the dataset version we'd cache it under has yet
+        if get_cube() is not None or not is_replica_session(session):
+            comparison_cache.put(key, result)
+    if "comparison" not in result:
+        return result
+    # The cached result may have come from a request with a different age or
+    # sex in the same bucket, so echo back what this request asked for
+    return {**result, "sex": request.sex if request.sex else None, "age": request.age}
+
+
+def _incomes(values: np.ndarray) -> np.ndarray:
+    # Specs said get largest number for comp, swaps our last axis of fields
+    # for one of male/female
+    return np.stack([
+        np.maximum(values[..., MALE_CURR], values[..., MALE_2019]),
+        np.maximum(values[..., FEMALE_CURR], values[..., FEMALE_2019]),
+    ], axis=-1)
+
+
+def _pops(values: np.ndarray) -> np.ndarray:
+    # Swaps our last axis of fields for male/female population with income
+    return values[..., [NUM_MALES, NUM_FEMALES]]
+
+
+def _percent_or_none(value: float) -> Optional[float]:
+    # A zero base gives us inf/nan, which we can't send back as JSON
+    return value if math.isfinite(value) else None
+
+
+def _comparison_error(
+    request: Request,
+    age_range: str,
+    known_race: bool,
+    any_found: bool,
+    own_found: bool,
+    own_base_found: bool,
+) -> Optional[dict]:
+    # Why we can't answer a request, None if we can
+    if age_range == NO_AGE_RANGE:
+        return {"error": f"query does not match any data for age {request.age}"}
+    if not any_found:
+        return {"error": f"query does not match any data for year {request.year}"}
+    # Races we have no data for at all are just left out of the percent
+    # changes, but ones we do have need data for this request
+    if known_race and not own_found:
+        return {"error": f"query does not match any data for race {request.race}"}
+    if known_race and request.base_year and not own_base_found:
+        return {
+            "error": (
+                f"query does not match any data for race {request.race}"
+                f" in {request.base_year}"
             )
+        }
+    return None
+
+
+# Compares every race we have data for, for a whole batch of requests out of a
+# single fetch, with the ranking and differences done as array math
+async def make_comparisons(
+    requests: List[Request], session: AsyncSession
+) -> List[dict]:
+    n = len(requests)
+    if not n:
+        return []
+    labels = await get_labels(session)
+    age_ranges = await get_age_ranges([req.age for req in requests], session)
+    years = [req.year for req in requests]
+    base_years = [req.base_year if req.base_year else None for req in requests]
+    known_races = [req.race in labels.races for req in requests]
+
+    # Serve from our census cube if we have one, otherwise grab every race's
+    # rows the batch needs in one query and index it the same way
+    cube = get_cube()
+    if cube is None:
+        cube = await load_cube(
+            session,
+            years={*years, *(y for y in base_years if y is not None)},
+            age_ranges=set(age_ranges),
         )
-        # Convert our results list into into a single obj
-        w_data = w_data_req.scalars().first()
-        # Specs said get largest number for comp for both sexes
-        wm_income = max(
-            w_data.male_median_income_curr_dollars,
-            w_data.male_median_income_2019_dollars,
+    if not cube.races:
+        return [
+            _comparison_error(req, age_range, known, False, False, False)
+            for req, age_range, known in zip(requests, age_ranges, known_races)
+        ]
+
+    # Shapes are (requests, races, fields) and (requests, races)
+    data, found = cube.take_races(years, age_ranges)
+    base, base_found = cube.take_races(base_years, age_ranges)
+
+    # Columns are [male, female] from here on out, so (requests, races, 2)
+    incomes, pops = _incomes(data), _pops(data)
+    # Races without data for a request sit out its ranking. Races are sorted,
+    # so on a tie argmax hands the head to the one that sorts first
+    has_data = found[..., None]
+    income_hi = np.where(has_data, incomes, -np.inf)
+    head = income_hi.argmax(axis=1)
+    # Largest minus smallest across the races we have
+    income_lo = np.where(has_data, incomes, np.inf)
+    income_difference = income_hi.max(axis=1) - income_lo.min(axis=1)
+    pop_hi = np.where(has_data, pops, -np.inf)
+    pop_lo = np.where(has_data, pops, np.inf)
+    population_difference = pop_hi.max(axis=1) - pop_lo.min(axis=1)
+
+    # Percent changes are only for the race that was requested
+    rows = np.arange(n)
+    own = np.array([cube.race_idx.get(req.race, -1) for req in requests], dtype=np.intp)
+    has_own = own >= 0
+    own_found = found[rows, own] & has_own
+    own_base_found = base_found[rows, own] & has_own
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percent_change_income = (
+            _incomes(data[rows, own]) / _incomes(base[rows, own]) * 100
         )
-        wf_income = max(
-            w_data.female_median_income_curr_dollars,
-            w_data.female_median_income_2019_dollars,
+        percent_change_pop = _pops(data[rows, own]) / _pops(base[rows, own]) * 100
+    with_percent = np.array([y is not None for y in base_years]) & has_own
+
+    # Back to plain python values before we build our output
+    head = head.tolist()
+    income_difference = income_difference.tolist()
+    population_difference = population_difference.tolist()
+    percent_change_income = percent_change_income.tolist()
+    percent_change_pop = percent_change_pop.tolist()
+
+    results = []
+    for i, req in enumerate(requests):
+        error = _comparison_error(
+            req,
+            age_ranges[i],
+            known_races[i],
+            found[i].any(),
+            own_found[i],
+            own_base_found[i],
         )
-        """
-        If we have a base year in our req, we'll
-        also need data for a diff year for comp
-
-        The spec said do that only when sending all params but really,
-        since you're outputting a Comparison for either gender, and only
-        comparing two races, you only need to detect if the req contained base_year
-        and then calculate percent changes only for the race requested
-        """
-        if request.base_year:
-            # If it did, get another sample of our data to compare
-            # and calc percent change
-            w_data1_req = await session.execute(
-                select(CensusRecord).where(
-                    CensusRecord.race == "white",
-                    CensusRecord.year == request.base_year,
-                    CensusRecord.age_range == age_range,
-                )
+        if error is not None:
+            results.append(error)
+            continue
+        comparison = {}
+        for col, sex in enumerate(SEXES):
+            comparison[sex] = build_comparison(
+                income_difference=income_difference[i][col],
+                head=cube.races[head[i][col]],
+                population_difference=population_difference[i][col],
+                percent_change_income=(
+                    _percent_or_none(percent_change_income[i][col])
+                    if with_percent[i]
+                    else None
+                ),
+                percent_change_pop=(
+                    _percent_or_none(percent_change_pop[i][col])
+                    if with_percent[i]
+                    else None
+                ),
             )
-            w_data1 = w_data1_req.scalars().first()
+        results.append({
+            "year": req.year,
+            "sex": req.sex if req.sex else None,
+            "age": req.age,
+            "comparison": comparison,
+        })
+    return results
 
-            wm_base_income = max(
-                w_data1.male_median_income_curr_dollars,
-                w_data1.male_median_income_2019_dollars,
-            )
-            wf_base_income = max(
-                w_data1.female_median_income_curr_dollars,
-                w_data1.female_median_income_2019_dollars
-            )
-            # Calculate percent change if needed
-            if request.race == 'white':
-                wm_percent_change_income = wm_income / wm_base_income * 100
-                wf_percent_change_income = wf_income / wf_base_income * 100
-                wm_percent_change_pop = w_data.num_males_with_income / w_data1.num_males_with_income * 100
-                wf_percent_change_pop = w_data.num_females_with_income / w_data1.num_females_with_income * 100
-        else:
-            # Set them all to None
-            wm_percent_change_income = None
-            wf_percent_change_income = None
-            wm_percent_change_pop = None
-            wf_percent_change_pop = None
-    except NoResultFound:
-        return {"error": "query does not match any data for race w"}
-
-    # Now that we have our w data, we grab our a data
-    try:
-        # Get a sample of our data for a race
-        a_data_req = await session.execute(
-            select(CensusRecord).where(
-                CensusRecord.race == "asian",
-                CensusRecord.year == request.year,
-                CensusRecord.age_range == age_range,
-            )
-        )
-        a_data = a_data_req.scalars().first()
 
-        am_income = max(
-            a_data.male_median_income_curr_dollars,
-            a_data.male_median_income_2019_dollars,
-        )
-        af_income = max(
-            a_data.female_median_income_curr_dollars,
-            a_data.female_median_income_2019_dollars,
-        )
+# Keys of each point in a trend, in the order make_trend builds them
+TREND_FIELDS = (
+    "year",
+    "income",
+    "population",
+    "percent_change_income_yoy",
+    "percent_change_pop_yoy",
+    "percent_change_income_cumulative",
+    "percent_change_pop_cumulative",
+    "income_gap",
+    "population_gap",
+)
 
-        if request.base_year:
-            a_data1_req = await session.execute(
-                select(CensusRecord).where(
-                    CensusRecord.race == "asian",
-                    CensusRecord.year == request.base_year,
-                    CensusRecord.age_range == age_range,
-                )
-            )
-            a_data1 = a_data1_req.scalars().first()
 
-            am_base_income = max(
-                a_data1.male_median_income_curr_dollars,
-                a_data1.male_median_income_2019_dollars,
-            )
-            af_base_income = max(
-                a_data1.female_median_income_curr_dollars,
-                a_data1.female_median_income_2019_dollars,
-            )
+def _percent_changes(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Year over year and cumulative percent changes down the rows of values
 
-            if request.race == "asian":
-                # Calculate percent changes
-                am_percent_change_income = am_income / am_base_income * 100
-                af_percent_change_income = af_income / af_base_income * 100
-                am_percent_change_pop = a_data.num_males_with_income / a_data1.num_males_with_income * 100
-                af_percent_change_pop = a_data.num_females_with_income / a_data1.num_females_with_income * 100
-        else:
-            am_percent_change_income = None
-            af_percent_change_income = None
-            am_percent_change_pop = None
-            af_percent_change_pop = None
-
-    except NoResultFound:
-        return {"error": "query does not match any data for race a"}
-    # Calculate attribs for each sex
-    m_head = "white" if wm_income > am_income else "asian"
-    f_head = "white" if wf_income > af_income else "asian"
-    # See if we need to use percent changes and which to use
-    if request.base_year:
-        # If no race is provided, all of these fields get set to None
-        m_percent_change_income = (
-            wm_percent_change_income if request.race == "white" else am_percent_change_income if request.race == "asian"
-            else None)
-
-        f_percent_change_income = (
-            wf_percent_change_income if request.race == "white" else af_percent_change_income if request.race == "asian"
-            else None)
-
-        m_percent_change_pop = (
-            wm_percent_change_pop if request.race == "white" else am_percent_change_pop if request.race == "asian"
-            else None)
-        f_percent_change_pop = (
-            wf_percent_change_pop if request.race == "white" else af_percent_change_pop if request.race == "asian"
-            else None)
-    # Otherwise, set all those fields to None so we can react accordingly to the request
-    else:
-        m_percent_change_income = None
-        f_percent_change_income = None
-        m_percent_change_pop = None
-        f_percent_change_pop = None
-    m_comparison = Comparison(**{
-        # Make sure we subtract the largest number by the smallest by doing max -
-        # min for all vals
-        "income_difference": max(wm_income, am_income) - min(wm_income, am_income),
-        "head": m_head,
-        "population_difference": max(w_data.num_males_with_income, a_data.num_males_with_income) - min(
-            w_data.num_males_with_income, a_data.num_males_with_income),
-        # If we need to include percent change, serialize it, if not, set to None
-        # and Pydantic will ignore the field
-        "percent_change_income": m_percent_change_income if request.base_year else None,
-        "percent_change_pop": m_percent_change_pop if request.base_year else None,
-    })
-    f_comparison = Comparison(**{"income_difference": max(wf_income, af_income) - min(wf_income, af_income),
-                                 "head": f_head,
-                                 "population_difference": max(w_data.num_females_with_income,
-                                                              a_data.num_females_with_income) - min(
-                                     w_data.num_females_with_income,
-                                     a_data.num_females_with_income),
-                                 "percent_change_income": f_percent_change_income if request.base_year else None,
-                                 "percent_change_pop": f_percent_change_pop if request.base_year else None,
-                                 })
+    Cumulative changes are against the first year we have data for.
+    Anything missing, or divided by zero, comes out as NaN
+    """
+    # Row of the first non NaN value in each col, 0 if there isn't one
+    first = np.argmax(~np.isnan(values), axis=0)
+    base = values[first, np.arange(values.shape[1])]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        yoy = np.full_like(values, np.nan)
+        yoy[1:] = (values[1:] / values[:-1] - 1) * 100
+        cumulative = (values / base - 1) * 100
+    yoy[~np.isfinite(yoy)] = np.nan
+    cumulative[~np.isfinite(cumulative)] = np.nan
+    return yoy, cumulative
 
+
+def _none_if_nan(values: np.ndarray, cast=float) -> list:
+    # NaN isn't valid JSON, missing values go back as null
+    return [None if math.isnan(v) else cast(v) for v in values.tolist()]
+
+
+# Trend of incomes and populations for a race over a range of years, out of a
+# single fetch with all the math done over the whole series at once
+async def make_trend(request: TrendRequest, session: AsyncSession):
+    age_range = request.age_range or await get_age_range_from_req(request.age, session)
+    years = list(range(request.year_from, request.year_to + 1))
+    white, asian = GAP_RACES
+    races = {request.race, white, asian}
+
+    cube = get_cube()
+    if cube is None:
+        cube = await load_cube(
+            session, races=races, years=years, age_ranges=[age_range]
+        )
+
+    n = len(years)
+    own, own_found = cube.take([request.race] * n, years, [age_range] * n)
+    if not own_found.any():
+        return {"error": f"query does not match any data for race {request.race}"}
+    w_data, _ = cube.take([white] * n, years, [age_range] * n)
+    a_data, _ = cube.take([asian] * n, years, [age_range] * n)
+
+    # Columns are [male, female] from here on out
+    income, pop = _incomes(own), _pops(own)
+    income_yoy, income_cumulative = _percent_changes(income)
+    pop_yoy, pop_cumulative = _percent_changes(pop)
+    # NaN wherever either race is missing a year
+    income_gap = _incomes(w_data) - _incomes(a_data)
+    pop_gap = _pops(w_data) - _pops(a_data)
+
+    trend = {}
+    for col, sex in enumerate(SEXES):
+        if request.sex and request.sex != sex:
+            continue
+        trend[sex] = [
+            dict(zip(TREND_FIELDS, point))
+            for point in zip(
+                years,
+                _none_if_nan(income[:, col]),
+                _none_if_nan(pop[:, col], int),
+                _none_if_nan(income_yoy[:, col]),
+                _none_if_nan(pop_yoy[:, col]),
+                _none_if_nan(income_cumulative[:, col]),
+                _none_if_nan(pop_cumulative[:, col]),
+                _none_if_nan(income_gap[:, col]),
+                _none_if_nan(pop_gap[:, col], int),
+            )
+        ]
     return {
-        "year": request.year,
+        "race": request.race,
         "sex": request.sex if request.sex else None,
-        "age": request.age,
-        "comparison": {
-            "male": m_comparison,
-            "female": f_comparison,
-        }
+        "age_range": age_range,
+        "gap": f"{white} - {asian}",
+        "trend": trend,
     }
@@ -0,0 +1,143 @@
+"""
+Census cube shared between worker processes
+
+The cube's arrays are written out once as .npy files under /dev/shm (shared
+memory) and every worker memory maps them read-only, so however many workers
+we run there's a single copy of the data. A generation number, kept in a tiny
+file every worker also maps, is bumped only once a new cube is fully written,
+workers check it on every read and swap over when it changes
+"""
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+
+# Arrays every generation is made of
+ARRAY_NAMES = ("values", "present")
+# Set by our gunicorn config to the master's pid, so every worker it forks
+# finds the same store
+NAMESPACE_ENV = "CENSUS_CUBE_NAMESPACE"
+
+_generation_format = struct.Struct("<Q")
+
+
+def owned_by_master() -> bool:
+    """Whether a gunicorn master set up our store, and cleans it up"""
+    return NAMESPACE_ENV in os.environ
+
+
+def shared_dir(namespace: Optional[str] = None) -> str:
+    """Where the store for namespace lives, our own process's by default"""
+    base = settings.CENSUS_CUBE_SHARED_DIR
+    if base is None:
+        base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    namespace = namespace or os.environ.get(NAMESPACE_ENV) or str(os.getpid())
+    return os.path.join(base, f"census-cube-{namespace}")
+
+
+class SharedCubeStore:
+    """
+    Generations of cube arrays in a directory shared by our workers
+
+    Only ever written to while holding lock(), which is a file lock so it
+    works across processes and threads
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(
+            os.path.join(directory, "generation"), os.O_RDWR | os.O_CREAT, 0o600
+        )
+        try:
+            # New files are zero filled, which is generation 0, no cube yet
+            if os.fstat(fd).st_size < _generation_format.size:
+                os.ftruncate(fd, _generation_format.size)
+            self._generation = mmap.mmap(fd, _generation_format.size)
+        finally:
+            os.close(fd)
+
+    def generation(self) -> int:
+        """The current generation, read straight out of shared memory"""
+        return _generation_format.unpack_from(self._generation)[0]
+
+    @contextmanager
+    def lock(self, name: str = "lock") -> Iterator[None]:
+        """
+        Holds the file lock called name, waiting for whoever has it
+
+        Each call opens the file afresh, so it keeps out other threads of our
+        process as well as other processes. Blocks, so keep it off the loop
+        """
+        with open(os.path.join(self.directory, name), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _path(self, generation: int, name: str) -> str:
+        return os.path.join(self.directory, f"{generation}.{name}")
+
+    def publish(
+        self,
+        labels: Dict[str, Any],
+        arrays: Dict[str, np.ndarray],
+        expected: Optional[int] = None,
+    ) -> Optional[int]:
+        """
+        Writes out a new generation and makes it current, returns its number
+
+        If expected is given we only publish while it's still the current
+        generation, returning None otherwise. Blocks on lock() and disk
+        """
+        with self.lock():
+            current = self.generation()
+            if expected is not None and current != expected:
+                return None
+            generation = current + 1
+            for name in ARRAY_NAMES:
+                np.save(self._path(generation, f"{name}.npy"), arrays[name])
+            with open(self._path(generation, "labels.json"), "w") as f:
+                json.dump(labels, f)
+            # Everything's written, only now point workers at it
+            _generation_format.pack_into(self._generation, 0, generation)
+            self._drop_before(generation - 1)
+        return generation
+
+    def _drop_before(self, generation: int) -> None:
+        # We keep the previous generation around for workers that are just
+        # attaching to it. Workers still mapping older ones keep their pages
+        # until they let go, unlinking doesn't pull them out from under them
+        for name in os.listdir(self.directory):
+            prefix = name.split(".", 1)[0]
+            if prefix.isdigit() and int(prefix) < generation:
+                os.remove(os.path.join(self.directory, name))
+
+    def attach(self, generation: int) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+        """
+        Maps a generation's arrays read-only, zero copy
+
+        Raises FileNotFoundError if it's already been dropped
+        """
+        with open(self._path(generation, "labels.json")) as f:
+            labels = json.load(f)
+        arrays = {
+            name: np.load(self._path(generation, f"{name}.npy"), mmap_mode="r")
+            for name in ARRAY_NAMES
+        }
+        return labels, arrays
+
+    def remove(self) -> None:
+        """Deletes the whole store, for when no worker will use it again"""
+        self._generation.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,16 +1,270 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import exc, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 # Grab our app settings
 from app.core.config import settings
 
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Our connection pool, which also keeps track of how long checkouts wait
+
+    Wait time covers queueing for a free connection and opening a new one
+    when we're allowed to overflow
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            # Nothing freed up within pool_timeout
+            self.timeouts += 1
+            raise
+        wait = time.perf_counter() - start
+        self.checkouts += 1
+        self.wait_seconds_total += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+        return conn
+
+    def recreate(self):
+        # Carry our counters over when SQLAlchemy swaps the pool out
+        pool = super().recreate()
+        pool.checkouts, pool.timeouts = self.checkouts, self.timeouts
+        pool.wait_seconds_total = self.wait_seconds_total
+        pool.wait_seconds_max = self.wait_seconds_max
+        return pool
+
+
+def engine_options(uri: str, connect_timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Builds create_async_engine kwargs from our pool settings, giving up on
+    connecting after connect_timeout seconds if it's set
+    """
+    options: Dict[str, Any] = {
+        "echo": settings.DB_ECHO,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+    url = make_url(uri)
+    # SQLite is only used for local runs and picks its own pool
+    if url.get_backend_name() != "sqlite":
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+        )
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {
+            "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE
+        }
+        if connect_timeout is not None:
+            options["connect_args"]["timeout"] = connect_timeout
+    return options
+
+
 # Instantiate Async PG SQLAlchemy engine
-engine = create_async_engine(settings.DATABASE_URI, echo=True)
+engine = create_async_engine(
+    settings.DATABASE_URI, **engine_options(settings.DATABASE_URI)
+)
 # Turn off expire on commit to prevent DB inconsistencies with async
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+def pool_stats(engine: AsyncEngine = engine) -> Dict[str, Any]:
+    """Reports what our connection pool is doing right now"""
+    pool = engine.sync_engine.pool
+    stats: Dict[str, Any] = {
+        "pool": type(pool).__name__,
+        "status": pool.status(),
+    }
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            # Negative until the pool has opened all pool_size connections
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, TimedQueuePool):
+        checkouts = pool.checkouts
+        stats.update(
+            checkouts=checkouts,
+            timeouts=pool.timeouts,
+            wait_seconds_total=pool.wait_seconds_total,
+            wait_seconds_avg=pool.wait_seconds_total / checkouts if checkouts else 0.0,
+            wait_seconds_max=pool.wait_seconds_max,
+        )
+    return stats
+
+
+def is_connection_error(e: BaseException) -> bool:
+    """Whether e means we couldn't reach the DB, rather than a bad query"""
+    if isinstance(e, (OSError, exc.TimeoutError, exc.DisconnectionError)):
+        return True
+    return isinstance(e, exc.DBAPIError) and (
+        e.connection_invalidated
+        or isinstance(e, (exc.OperationalError, exc.InterfaceError))
+    )
+
+
+class Replica:
+    """A read replica, with its own engine and how it's been doing"""
+
+    def __init__(self, uri: str, connect_timeout: Optional[float] = None):
+        # repr hides the password
+        self.name = repr(make_url(uri))
+        self.engine = create_async_engine(uri, **engine_options(uri, connect_timeout))
+        self.session_factory = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+        # None until we've connected to it, False once it's failed us
+        self.healthy: Optional[bool] = None
+        self.retry_at = 0.0
+        self.in_flight = 0
+        self.sessions = 0
+        self.failures = 0
+        # Background check that it's up, while one is running
+        self.probe: Optional[asyncio.Future] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replica": self.name,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "sessions": self.sessions,
+            "failures": self.failures,
+            "pool": pool_stats(self.engine),
+        }
+
+
+class ReplicaSet:
+    """
+    Read replicas we spread read-only sessions over
+
+    Replicas are picked round robin or by fewest sessions in flight. One that
+    can't be reached is skipped for retry_seconds, then probed in the
+    background before it gets traffic again, so requests never wait on a
+    replica that may be dead. With none up reads go to the primary
+    """
+
+    def __init__(
+        self,
+        uris: List[str],
+        selection: str,
+        retry_seconds: float,
+        connect_timeout: float,
+    ):
+        if selection not in ("round_robin", "least_busy"):
+            raise ValueError(f"unknown replica selection {selection!r}")
+        self.replicas = [Replica(uri, connect_timeout) for uri in uris]
+        self.selection = selection
+        self.retry_seconds = retry_seconds
+        self.connect_timeout = connect_timeout
+        self.fallbacks = 0
+        self._next = 0
+
+    def candidates(self) -> List[Replica]:
+        """Replicas worth trying, best first"""
+        now = time.monotonic()
+        # Rotate where we start so ties are spread evenly
+        start = self._next % len(self.replicas) if self.replicas else 0
+        self._next += 1
+        ordered = self.replicas[start:] + self.replicas[:start]
+        if self.selection == "least_busy":
+            # sorted is stable, so equally busy replicas keep the rotation
+            ordered = sorted(ordered, key=lambda replica: replica.in_flight)
+        return [
+            replica
+            for replica in ordered
+            if replica.healthy is not False or replica.retry_at <= now
+        ]
+
+    def mark_down(self, replica: Replica) -> None:
+        replica.healthy = False
+        replica.failures += 1
+        replica.retry_at = time.monotonic() + self.retry_seconds
+
+    async def probe(self, replica: Replica) -> bool:
+        """Checks replica is up within connect_timeout, marking it up or down"""
+        async def select_one():
+            async with replica.engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+
+        try:
+            await asyncio.wait_for(select_one(), self.connect_timeout)
+        except Exception:
+            # Unreachable, too slow or not answering queries, it gets no
+            # traffic either way
+            self.mark_down(replica)
+            return False
+        replica.healthy = True
+        return True
+
+    async def check(self) -> None:
+        """Probes every replica that isn't known to be up, and waits for them"""
+        now = time.monotonic()
+        due = [
+            replica
+            for replica in self.replicas
+            if replica.healthy is not True and replica.retry_at <= now
+        ]
+        await asyncio.gather(*(self.probe(replica) for replica in due))
+
+    def pick(self) -> Optional[Replica]:
+        """Returns a replica that's up, None to fall back to the primary"""
+        picked = None
+        for replica in self.candidates():
+            if replica.healthy is True:
+                if picked is None:
+                    picked = replica
+            elif replica.probe is None or replica.probe.done():
+                # New or due a retry, check on it without holding this request up
+                replica.probe = asyncio.ensure_future(self.probe(replica))
+        if picked is None and self.replicas:
+            self.fallbacks += 1
+        return picked
+
+    async def close(self) -> None:
+        """Stops running probes and closes every replica's connections"""
+        for replica in self.replicas:
+            if replica.probe is not None:
+                replica.probe.cancel()
+            await replica.engine.dispose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "selection": self.selection,
+            "fallbacks": self.fallbacks,
+            "replicas": [replica.stats() for replica in self.replicas],
+        }
+
+
+replicas = ReplicaSet(
+    [uri.strip() for uri in settings.DATABASE_REPLICA_URIS.split(",") if uri.strip()],
+    settings.DB_REPLICA_SELECTION,
+    settings.DB_REPLICA_RETRY_SECONDS,
+    settings.DB_REPLICA_CONNECT_TIMEOUT,
+)
+
+
 # Declare our base schema class
 @as_declarative()
 class Base:
@@ -26,13 +280,28 @@ async def get_session() -> AsyncSession:
         yield session
 
 
-"""
-Typically you'd want to use Alembric or something else to manage
-your database migrations, in this case, we are doing it manually on startup
-"""
+# Same for routes that only read, on a replica when we have one up. Replicas
+# may lag behind, so routes reading back what they just wrote shouldn't use it
+async def get_read_session() -> AsyncSession:
+    replica = replicas.pick()
+    if replica is None:
+        async with AsyncSessionLocal() as session:
+            yield session
+        return
+    replica.sessions += 1
+    replica.in_flight += 1
+    try:
+        async with replica.session_factory() as session:
+            yield session
+    except Exception as e:
+        # Lost it mid request, send everyone else elsewhere for a while
+        if is_connection_error(e):
+            replicas.mark_down(replica)
+        raise
+    finally:
+        replica.in_flight -= 1
 
 
-async def init_models():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
+def is_replica_session(session: AsyncSession) -> bool:
+    """True if session reads from a replica, so may not have the latest writes"""
+    return any(session.bind is replica.engine for replica in replicas.replicas)
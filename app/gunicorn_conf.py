@@ -0,0 +1,33 @@
+"""
+Gunicorn config for serving our app from WORKERS uvicorn workers
+
+    gunicorn app.main:app -c python:app.gunicorn_conf
+"""
+import os
+import shutil
+
+from app.core.config import settings
+from app.core.services.shared_cube import NAMESPACE_ENV, shared_dir
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = settings.WORKERS
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Workers only find out about writes their siblings handled through the shared
+# cube's generation, without it each keeps serving its own stale cube, labels
+# and cached comparisons
+if workers > 1 and not (settings.CENSUS_CUBE_ENABLED and settings.CENSUS_CUBE_SHARED):
+    raise RuntimeError(
+        "WORKERS > 1 needs CENSUS_CUBE_ENABLED=true and CENSUS_CUBE_SHARED=true"
+    )
+
+
+def on_starting(server):
+    # Our workers are forked from us and inherit this, so they all find the
+    # shared cube under our pid, and a restart never picks up a stale one
+    os.environ[NAMESPACE_ENV] = str(os.getpid())
+
+
+def on_exit(server):
+    # Our workers are gone, nothing is using the shared cube anymore
+    shutil.rmtree(shared_dir(), ignore_errors=True)
@@ -1,27 +1,41 @@
 import time
 
-import pandas as pd
-
 from fastapi import FastAPI, Request, Depends
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.openapi.utils import get_openapi
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
 
 from app.core.config import settings
-from app.database import init_models, get_session
+from app.core.services.admission import AdmissionMiddleware
+from app.core.services.auth import HashPoolSaturated, denylist, hash_pool
+from app.core.services.metrics import (
+    MetricsMiddleware,
+    instrument_engine,
+    render_metrics,
+)
+from app.database import AsyncSessionLocal, engine, replicas
+from app.migrations import init_models
+from app.core.services.cache import bump_dataset_version
+from app.core.services.cube import close_cube, init_cube, startup_lock
+from app.core.services.jobs import job_runner
+from app.core.services.loader import bootstrap_census_dataset
 from .models.record import CensusRecord
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # Import our routers
-from app.routers import auth, record, user
+from app.routers import auth, record, status, user
 
 
 def get_application():
     _app = FastAPI(title=settings.PROJECT_NAME)
 
+    # Shed load before it reaches the DB. Added first so CORS wraps it and
+    # browsers can read our 429s/503s, and inside our metrics so they get counted
+    if settings.ADMISSION_CONTROL:
+        _app.add_middleware(AdmissionMiddleware)
     _app.add_middleware(
         CORSMiddleware,
         allow_origins=[str(origin) for origin in settings.BACKEND_CORS_ORIGINS],
@@ -29,11 +43,17 @@ def get_application():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # Added last so it wraps everything else, timing whole requests
+    _app.add_middleware(MetricsMiddleware)
 
     return _app
 
 
 app = get_application()
+# Attribute queries and DB time to the request that ran them
+instrument_engine(engine)
+for replica in replicas.replicas:
+    instrument_engine(replica.engine)
 
 
 # Load env vars for fastapi_jwt_auth
@@ -51,10 +71,72 @@ def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     )
 
 
-# Pop DB on startup
+# Turn away logins/sign ups when our hashing pool is saturated
+@app.exception_handler(HashPoolSaturated)
+def hash_pool_saturated_handler(request: Request, exc: HashPoolSaturated):
+    return JSONResponse(
+        status_code=503,
+        content={
+            "auth_error": "Too many password checks in progress, try again shortly"
+        },
+        headers={"Retry-After": "1"},
+    )
+
+
+# Open our token denylist before taking traffic, a bad DENYLIST_PATH fails here
+@app.on_event("startup")
+def denylist_init():
+    denylist.open()
+
+
+# Migrate DB on startup
 @app.on_event("startup")
 async def db_init():
+    # Only applies schema changes we haven't applied yet
     await init_models()
+    # Workers sharing our cube take turns, so only the first one builds it
+    async with startup_lock():
+        async with AsyncSessionLocal() as session:
+            # Load our dataset if what's on disk isn't what we last loaded
+            loaded = (
+                settings.BOOTSTRAP_DATASET
+                and await bootstrap_census_dataset(session) is not None
+            )
+            if loaded:
+                bump_dataset_version()
+            # Build our in-memory census cube from whatever is in the table,
+            # or attach to the one another worker already built
+            await init_cube(session, reload=loaded)
+
+
+# Find out which read replicas are up before we take any traffic
+@app.on_event("startup")
+async def replicas_init():
+    await replicas.check()
+
+
+# Stop probing read replicas and close their connections on shutdown
+@app.on_event("shutdown")
+async def replicas_shutdown():
+    await replicas.close()
+
+
+# Stop our hashing workers on shutdown
+@app.on_event("shutdown")
+async def hash_pool_shutdown():
+    hash_pool.shutdown()
+
+
+# Stop running load jobs, rolling back what they loaded, on shutdown
+@app.on_event("shutdown")
+async def job_runner_shutdown():
+    await job_runner.shutdown()
+
+
+# Clean up our shared cube, if we're the only process using it
+@app.on_event("shutdown")
+async def cube_shutdown():
+    close_cube()
 
 
 # Define root route so that it redirs to /docs
@@ -64,7 +146,14 @@ async def redir_to_docs():
     return response
 
 
+# Expose request and DB metrics for Prometheus to scrape
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 # Link routers to main app
 app.include_router(auth.router)
 app.include_router(record.router)
 app.include_router(user.router)
+app.include_router(status.router)
@@ -0,0 +1,88 @@
+"""
+Versioned schema management
+
+Instead of dropping and recreating every table on boot, we keep the version
+our schema is at in the schema_version table and only apply the migrations
+it's missing, so restarts keep their data
+"""
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select, text
+from sqlalchemy.engine import Connection
+
+from app.core.config import settings
+from app.database import Base, engine
+from app.models.dataset import LoadedDataset
+from app.models.record import CensusRecord
+from app.models.user import User
+
+# Kept apart from Base's metadata so it's only ever managed here
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    version_metadata,
+    Column("version", Integer, nullable=False),
+)
+
+# Arbitrary key for the Postgres advisory lock that keeps two workers from
+# migrating at the same time
+MIGRATION_LOCK_ID = 720_815
+
+
+def _create_base_tables(conn: Connection) -> None:
+    # Tables from before we versioned our schema, skips ones that already exist
+    Base.metadata.create_all(conn, tables=[User.__table__, CensusRecord.__table__])
+
+
+def _index_census_records(conn: Connection) -> None:
+    # Databases created before the index was on our model won't have it
+    existing = {
+        index["name"]
+        for index in inspect(conn).get_indexes(CensusRecord.__tablename__)
+    }
+    for index in CensusRecord.__table__.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+def _create_loaded_datasets(conn: Connection) -> None:
+    Base.metadata.create_all(conn, tables=[LoadedDataset.__table__])
+
+
+# Every change to our schema goes at the end of this list, never edit or
+# reorder ones that have shipped
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create users and census_records", _create_base_tables),
+    (2, "index census_records on race, year and age_range", _index_census_records),
+    (3, "track loaded datasets", _create_loaded_datasets),
+]
+
+
+def _migrate(conn: Connection) -> int:
+    version_metadata.create_all(conn)
+    current = conn.execute(select(schema_version.c.version)).scalar()
+    if current is None:
+        conn.execute(schema_version.insert().values(version=0))
+        current = 0
+    for version, _, apply in MIGRATIONS:
+        if version > current:
+            apply(conn)
+            conn.execute(schema_version.update().values(version=version))
+            current = version
+    return current
+
+
+async def init_models() -> int:
+    """Brings our schema up to date, returns the version it's at"""
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Held until this transaction ends, taken before any reset so a
+            # worker never drops tables out from under one that's migrating
+            await conn.execute(
+                text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID}
+            )
+        if settings.RESET_DB_ON_STARTUP:
+            # Old behaviour, wipe everything and start over
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(version_metadata.drop_all)
+        return await conn.run_sync(_migrate)
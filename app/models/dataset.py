@@ -0,0 +1,23 @@
+from sqlalchemy import Column, DateTime, Integer, String, func
+
+from app.database import Base
+
+"""
+Model for a dataset we've loaded into the DB
+
+We keep the content hash from the dataset manifest so we can tell on
+startup whether what's on disk is already loaded
+"""
+
+
+class LoadedDataset(Base):
+    __tablename__ = 'loaded_datasets'
+
+    # Name of the dataset, i.e. census
+    name = Column(String(50), primary_key=True)
+    # sha256 from the dataset manifest
+    sha256 = Column(String(64), nullable=False)
+    num_rows = Column(Integer, nullable=False)
+    loaded_at = Column(
+        DateTime, nullable=False, server_default=func.now(), onupdate=func.now()
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Float, Integer, SmallInteger, String
+from sqlalchemy import Column, Float, Index, Integer, SmallInteger, String
 
 from app.database import Base
 
@@ -13,6 +13,11 @@ then dump into PG DB
 
 class CensusRecord(Base):
     __tablename__ = 'census_records'
+    # Every comparison looks rows up by race, year and age range, so
+    # index them together instead of scanning the whole table
+    __table_args__ = (
+        Index("ix_census_records_race_year_age_range", "race", "year", "age_range"),
+    )
 
     id = Column(Integer, autoincrement=True, primary_key=True, index=True)
     race = Column(String(10))
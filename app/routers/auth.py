@@ -5,14 +5,17 @@ import datetime
 
 from fastapi import APIRouter, Depends
 
-from fastapi_jwt_auth import AuthJWT
-
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 # Import our dep here to automatically hand db session to routes
 from app.database import get_session
-from app.core.services.auth import verify_password, denylist
+from app.core.services.auth import (
+    CachedAuthJWT,
+    HashPoolSaturated,
+    check_password,
+    revoke_token,
+)
 from app.models.user import User
 from app.schemas.user import UserIn
 
@@ -25,7 +28,11 @@ router = APIRouter(
 
 # Take a username + password, hash PW, verify and return token
 @router.post("/login")
-async def login(req: UserIn, session: AsyncSession = Depends(get_session), auth: AuthJWT = Depends()):
+async def login(
+    req: UserIn,
+    session: AsyncSession = Depends(get_session),
+    auth: CachedAuthJWT = Depends(),
+):
     """Takes in a UserIn schema, generates a JWT token and returns User
 
     Returns:
@@ -45,7 +52,10 @@ async def login(req: UserIn, session: AsyncSession = Depends(get_session), auth:
     pw_match = False
     # Compare hashes, see if combo was valid
     try:
-        pw_match = verify_password(req.password, user_instance.hashed_password)
+        pw_match = await check_password(req.password, user_instance.hashed_password)
+    # If our hashing pool is full, let our 503 handler deal with it
+    except HashPoolSaturated:
+        raise
     except:
         return {"login_error": "Can't verify hash"}
     # If they don't match, return an error
@@ -60,7 +70,7 @@ async def login(req: UserIn, session: AsyncSession = Depends(get_session), auth:
 
 
 @router.post("/refresh")
-async def refresh_access_token(auth: AuthJWT = Depends()):
+async def refresh_access_token(auth: CachedAuthJWT = Depends()):
     """Take a valid refresh token and generate a new access/refresh token"""
     # Make sure User has a valid/unexpired refresh token
     auth.jwt_refresh_token_required()
@@ -75,26 +85,26 @@ async def refresh_access_token(auth: AuthJWT = Depends()):
 
 # Take a tokens jti and add it to our revoked token list
 @router.post('/logout')
-async def revoke_access_token(auth: AuthJWT = Depends()):
+async def revoke_access_token(auth: CachedAuthJWT = Depends()):
     # Make sure person making req has valid token
     auth.jwt_required()
     # Grab jti from token used in req
-    jti = auth.get_raw_jwt()['jti']
-    # Add to deny list
-    denylist.add(jti)
+    raw_jwt = auth.get_raw_jwt()
+    # Add to deny list until the token expires
+    revoke_token(raw_jwt)
     # Let client know
     return {"status": "tokens revoked ok"}
 
 
 # Take a refresh token jti and add it to our revoked token list
 @router.post('/revoke_refresh')
-async def revoke_refresh_token(auth: AuthJWT = Depends()):
+async def revoke_refresh_token(auth: CachedAuthJWT = Depends()):
     # Make sure person making req has valid refresh token
     auth.jwt_refresh_token_required()
     # Get jti or token used to make req
-    jti = auth.get_raw_jwt()['jti']
-    # Add to deny list
-    denylist.add(jti)
+    raw_jwt = auth.get_raw_jwt()
+    # Add to deny list until the token expires
+    revoke_token(raw_jwt)
     # Let client know
     return {"status": "refresh token revoke ok"}
 
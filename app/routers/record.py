@@ -1,21 +1,32 @@
 """
 Router for Record objs
 """
-import pandas as pd
+import hashlib
+from enum import Enum
+from functools import partial
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends
-
-from fastapi_jwt_auth import AuthJWT
+from fastapi import APIRouter, Depends, Header, Query, Request as HTTPRequest
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_session
+from app.database import get_read_session, get_session
+from app.core.services.auth import CachedAuthJWT
 from app.models.record import CensusRecord
-from app.core.services.record import make_comparison
+from app.core.services.cache import bump_dataset_version
+from app.core.services.cube import rebuild_cube
+from app.core.services.export import parse_columns, records_query, stream_records
+from app.core.services.ingest import ingest_records
+from app.core.services.jobs import JobConflict, JobStatus, job_runner, run_census_load
+from app.core.services.loader import DATASET_NAME
+from app.core.services.record import get_cached_comparison, make_comparisons, make_trend
+from app.core.services.serialize import FAST_JSON, FastJSONResponse, dumps, record_dict
 from app.schemas.record import RecordIn, RecordOut
 from app.schemas.request import Request
+from app.schemas.trend import TrendRequest
 
 # Router settings
 router = APIRouter(
@@ -25,31 +36,146 @@ router = APIRouter(
 
 
 # Load our pickle into DB
-@router.post("/load_pickle")
-async def load_pickle(session: AsyncSession = Depends(get_session), auth: AuthJWT = Depends()):
-    """Loads XLS data that was converted to DF into DB"""
+@router.post("/load_pickle", status_code=202)
+async def load_pickle(
+    upsert: bool = False, wait: bool = False, auth: CachedAuthJWT = Depends()
+):
+    """Loads XLS data that was converted to an Arrow dataset into DB
+
+    Runs as a background job, we answer with its id right away, check on it
+    at /data/jobs/{job_id}. If upsert is set, rows we already have for a
+    (race, year, age_range) get updated instead of duplicated, so loading
+    twice is safe. If wait is set we answer once the load is done instead
+    """
     # Make sure requested has valid JWT token
     auth.jwt_required()
-    # Hydrate our pickle back into a DF
-    df = pd.read_pickle("../data_processing/res.pkl")
-    # Create dict of to load into db
-    data = df.to_dict(orient='records')
-    # Build a list of CensusRecord objs
-    inst_list = []
-    for row in data:
-        inst_list.append(CensusRecord(**row))
-    # Try adding this list to DB session and committing
-    session.add_all(inst_list)
     try:
-        await session.commit()
-    except:
-        return {"status": "failed to load pickle"}
-    return {"status": "pickle loaded"}
+        job = job_runner.submit(DATASET_NAME, partial(run_census_load, upsert=upsert))
+    except JobConflict as e:
+        return JSONResponse(
+            status_code=409, content={"job_error": str(e), "job_id": e.job.id}
+        )
+    if wait:
+        await job_runner.wait(job)
+        return JSONResponse(status_code=200, content=job.dict())
+    return JSONResponse(
+        status_code=202,
+        content=job.dict(),
+        headers={"Location": f"{router.prefix}/jobs/{job.id}"},
+    )
+
+
+# Report how a load job is doing
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    job = job_runner.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"job_error": "job not found"})
+    return job.dict()
+
+
+# Stop a load job, whatever it loaded so far is rolled back
+@router.post("/jobs/{job_id}/cancel", status_code=202)
+async def cancel_job(job_id: str, auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    job = job_runner.cancel(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"job_error": "job not found"})
+    if job.status == JobStatus.committing:
+        return JSONResponse(
+            status_code=409,
+            content={
+                "job_error": "job is already committing, too late to cancel",
+                "job_id": job.id,
+            },
+        )
+    return JSONResponse(status_code=202, content=job.dict())
+
+
+class RecordFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+RECORD_MEDIA_TYPES = {
+    RecordFormat.ndjson: "application/x-ndjson",
+    RecordFormat.csv: "text/csv",
+}
+
+
+# Stream census records out in bulk, has to be declared before /{record_id}
+@router.get("/records")
+async def export_records(
+    race: Optional[str] = None,
+    age_range: Optional[str] = None,
+    year_from: Optional[int] = None,
+    year_to: Optional[int] = None,
+    after_id: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    columns: Optional[str] = None,
+    format: RecordFormat = RecordFormat.ndjson,
+    session: AsyncSession = Depends(get_read_session),
+    auth: CachedAuthJWT = Depends(),
+):
+    """Exports census records matching our filters, ordered by id
+
+    Page through by passing the last id you got back as after_id. columns is
+    a comma separated list of cols to export, id is always included
+    """
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    try:
+        cols = parse_columns(columns)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"export_error": str(e)})
+    query = records_query(cols, race, age_range, year_from, year_to, after_id, limit)
+    return StreamingResponse(
+        stream_records(session, cols, query, format.value),
+        media_type=RECORD_MEDIA_TYPES[format],
+    )
+
+
+# Stream many new census records in at once
+@router.post("/records/bulk")
+async def bulk_create_records(
+    http_request: HTTPRequest,
+    format: Optional[RecordFormat] = None,
+    commit_each_chunk: bool = False,
+    session: AsyncSession = Depends(get_session),
+    auth: CachedAuthJWT = Depends(),
+):
+    """Inserts records sent as NDJSON or CSV (with a header line)
+
+    format defaults to what the Content-Type says. Rows that aren't valid
+    records are skipped and reported. Everything is inserted in one
+    transaction, unless commit_each_chunk is set
+    """
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    if format is None:
+        content_type = http_request.headers.get("content-type", "")
+        is_csv = content_type.startswith("text/csv")
+        format = RecordFormat.csv if is_csv else RecordFormat.ndjson
+    result = await ingest_records(
+        session, http_request.stream(), format.value, commit_each_chunk
+    )
+    if result.rows_inserted:
+        # Table changed, swap in a fresh census cube and drop cached comparisons
+        await rebuild_cube(session)
+        bump_dataset_version()
+    return result.dict()
 
 
 # Use FastAPI's dependency injection to automatically gran our db session
 @router.get("/{record_id}", response_model=RecordOut)
-async def get_record_by_id(record_id: int, session: AsyncSession = Depends(get_session), auth: AuthJWT = Depends()):
+async def get_record_by_id(
+    record_id: int,
+    session: AsyncSession = Depends(get_read_session),
+    auth: CachedAuthJWT = Depends(),
+):
     # Make sure requester has valid JWT token
     auth.jwt_required()
     # Try grabbing record from DB
@@ -60,11 +186,19 @@ async def get_record_by_id(record_id: int, session: AsyncSession = Depends(get_s
     except NoResultFound:
         return {"get_record_error": "record not found"}
     # Turn our list of one into an obj
-    return result.scalars().first()
+    record = result.scalars().first()
+    if FAST_JSON and record is not None:
+        # We just read this from our own table, no need to validate it again
+        return FastJSONResponse(record_dict(record))
+    return record
 
 
 @router.post("/new_record", response_model=RecordOut)
-async def create_record(new_record: RecordIn, session: AsyncSession = Depends(get_session), auth: AuthJWT = Depends()):
+async def create_record(
+    new_record: RecordIn,
+    session: AsyncSession = Depends(get_session),
+    auth: CachedAuthJWT = Depends(),
+):
     # Make sure requester has valid JWT token
     auth.jwt_required()
     # Take data that was POSTd and instantiate new record
@@ -74,6 +208,11 @@ async def create_record(new_record: RecordIn, session: AsyncSession = Depends(ge
     # Try persisting to DB (committing) object
     try:
         await session.commit()
+        # Table changed, swap in a fresh census cube and drop cached comparisons
+        await rebuild_cube(session)
+        bump_dataset_version()
+        if FAST_JSON:
+            return FastJSONResponse(record_dict(new_instance))
         return new_instance
     # If we have an integrity error, rollback our transaction
     except IntegrityError:
@@ -81,12 +220,69 @@ async def create_record(new_record: RecordIn, session: AsyncSession = Depends(ge
         return {"error": "DB integrity error saving object"}
 
 
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match can hold a list of (possibly weak) tags, or *
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    strong = (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+    return "*" in tags or etag in strong
+
+
 # Take a request for a comparison, process & return it
 @router.post("/get_comparison")
-async def get_comparison(request: Request, session: AsyncSession = Depends(get_session), auth: AuthJWT = Depends()):
+async def get_comparison(
+    request: Request,
+    if_none_match: Optional[str] = Header(None),
+    session: AsyncSession = Depends(get_read_session),
+    auth: CachedAuthJWT = Depends(),
+):
     # Make sure request contains valid token
     auth.jwt_required()
     # Make our comparison, returns result in format reqd by spec
-    result = await make_comparison(request, session)
-    # Return our result
-    return result
+    result = await get_cached_comparison(request, session)
+    # Tag our response with a hash of its body so clients can revalidate
+    body = dumps(result)
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    # If the client already has this exact result, don't send it again
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+# Take a list of requests for comparisons and process them all in one go
+@router.post("/get_comparisons")
+async def get_comparisons(
+    requests: List[Request],
+    session: AsyncSession = Depends(get_read_session),
+    auth: CachedAuthJWT = Depends(),
+):
+    # Make sure request contains valid token
+    auth.jwt_required()
+    # Results come back in the same order as the requests, a request that
+    # can't be answered gets an error in its slot instead of failing the batch
+    results = await make_comparisons(requests, session)
+    if FAST_JSON:
+        return FastJSONResponse(results)
+    return results
+
+
+# Trend of a race's incomes and populations over a range of years
+@router.post("/trend")
+async def get_trend(
+    request: TrendRequest,
+    session: AsyncSession = Depends(get_read_session),
+    auth: CachedAuthJWT = Depends(),
+):
+    """Year over year and cumulative percent changes, plus the white/asian gap,
+    for every year in the range
+
+    Percent changes are (this year / other year - 1) * 100, cumulative ones
+    are against the first year in the range we have data for
+    """
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    trend = await make_trend(request, session)
+    if FAST_JSON:
+        return FastJSONResponse(trend)
+    return trend
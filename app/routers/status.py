@@ -0,0 +1,60 @@
+"""
+Router for service status
+"""
+from fastapi import APIRouter, Depends
+
+from app.core.services import cache
+from app.core.services.admission import db_limiter
+from app.core.services.auth import CachedAuthJWT, claim_cache, hash_pool
+from app.core.services.cube import get_generation
+from app.database import pool_stats, replicas
+
+# Router settings
+router = APIRouter(
+    prefix="/status",
+    tags=["status"],
+)
+
+
+# Report how well our comparison cache is doing
+@router.get("/cache")
+async def get_cache_stats(auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    return {
+        "dataset_version": cache.dataset_version,
+        "cube_generation": get_generation(),
+        **cache.comparison_cache.stats(),
+    }
+
+
+# Report how busy our password hashing pool is
+@router.get("/hash_pool")
+async def get_hash_pool_stats(auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    return hash_pool.stats()
+
+
+# Report how many requests skipped re-verifying their token
+@router.get("/jwt_cache")
+async def get_jwt_cache_stats(auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    return claim_cache.stats()
+
+
+# Report how busy our DB connection pool is
+@router.get("/pool")
+async def get_pool_stats(auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    return {**pool_stats(), **replicas.stats()}
+
+
+# Report how close DB bound routes are to our concurrency limit
+@router.get("/admission")
+async def get_admission_stats(auth: CachedAuthJWT = Depends()):
+    # Make sure requester has valid JWT token
+    auth.jwt_required()
+    return db_limiter.stats()
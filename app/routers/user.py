@@ -6,15 +6,13 @@ import datetime
 from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
 
-from fastapi_jwt_auth import AuthJWT
-
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import NoResultFound, IntegrityError
 from sqlalchemy import select
 
 # Import our dep here to automatically hand db session to routes
 from app.database import get_session
-from app.core.services.auth import get_password_hash
+from app.core.services.auth import CachedAuthJWT, hash_password
 from app.models.user import User
 from app.schemas.user import UserIn, UserOut
 
@@ -31,7 +29,7 @@ async def create_user(user: UserIn, session: AsyncSession = Depends(get_session)
     new_user = User()
     new_user.username = user.username
     # Get hash for PW
-    hashed_pw = get_password_hash(user.password)
+    hashed_pw = await hash_password(user.password)
     # Add hash to new User instance
     new_user.hashed_password = hashed_pw
     # Add to db session
@@ -49,7 +47,11 @@ async def create_user(user: UserIn, session: AsyncSession = Depends(get_session)
 
 # Delete a user, if the user is requesting to delete themselves
 @router.post("/delete/{u_id}")
-async def delete_user(u_id: int, session: AsyncSession = Depends(get_session), auth: AuthJWT = Depends()):
+async def delete_user(
+    u_id: int,
+    session: AsyncSession = Depends(get_session),
+    auth: CachedAuthJWT = Depends(),
+):
     # Make sure requester has valid JWT token
     auth.jwt_required()
     # Get username for token provided
@@ -1,17 +1,22 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, constr
+
+# Limits of census_records' cols, so a row that won't fit is rejected here
+# rather than failing the insert it's part of
+Label = constr(max_length=10)
+SmallInt = conint(ge=0, le=32767)
 
 
 # Schema's for our CensusRecord objs
 class RecordIn(BaseModel):
-    race: str
-    age_range: str
-    year: int
+    race: Label
+    age_range: Label
+    year: SmallInt
     # Male fields
-    num_males_with_income: int
+    num_males_with_income: SmallInt
     male_median_income_curr_dollars: float
     male_median_income_2019_dollars: float
     # Female fields
-    num_females_with_income: int
+    num_females_with_income: SmallInt
     female_median_income_curr_dollars: float
     female_median_income_2019_dollars: float
 
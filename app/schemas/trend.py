@@ -0,0 +1,24 @@
+from typing import Optional
+
+from pydantic import BaseModel, root_validator
+
+
+# Schema for a request for a trend over a range of years
+class TrendRequest(BaseModel):
+    race: str
+    sex: Optional[str] = None
+    # Either an age, which we find the age range of, or the age range itself
+    age: Optional[int] = None
+    age_range: Optional[str] = None
+    year_from: int
+    year_to: int
+
+    @root_validator(skip_on_failure=True)
+    def check_age_and_years(cls, values):
+        if values.get("age") is None and values.get("age_range") is None:
+            raise ValueError("either age or age_range is required")
+        if values["year_to"] < values["year_from"]:
+            raise ValueError("year_to must not be before year_from")
+        if values["year_to"] - values["year_from"] >= 200:
+            raise ValueError("year range can span at most 200 years")
+        return values
@@ -0,0 +1,148 @@
+"""
+Cold start cost of our app
+
+Imports app.main in fresh interpreters, the way every worker and every new
+container does, and reports how long the import took and the process's peak
+RSS after it. Exits non-zero if either goes over its budget, or if a module
+only our ingestion path needs (pandas, pyarrow, ...) got imported on the way
+
+Usage (from the repo root):
+    python benchmarks/coldstart.py [--runs N] [--max-seconds S]
+        [--max-rss-mb MB] [--top N]
+
+Budgets are machine specific, like our other benchmarks' baselines
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Only loaded for ingestion, importing app.main shouldn't pull these in
+HEAVY_MODULES = ("pandas", "pyarrow", "openpyxl")
+
+# Runs in each fresh interpreter, prints what importing app.main cost
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.main
+seconds = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# Linux reports KiB, macOS bytes
+rss_mb = rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+heavy = [name for name in json.loads(sys.argv[1]) if name in sys.modules]
+print(json.dumps({"seconds": seconds, "rss_mb": rss_mb, "heavy": heavy}))
+"""
+
+
+def child_env(scratch: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("PROJECT_NAME", "census-coldstart")
+    env.setdefault("authjwt_secret_key", "coldstart")
+    # Importing doesn't touch the DB, but settings still want somewhere to point
+    env["DATABASE_URI"] = "sqlite+aiosqlite:///" + os.path.join(scratch, "coldstart.db")
+    env["DENYLIST_PATH"] = os.path.join(scratch, "denylist.sqlite3")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (ROOT, env.get("PYTHONPATH"))))
+    return env
+
+
+def measure(env: dict) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD, json.dumps(HEAVY_MODULES)],
+        env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+    )
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def import_times(env: dict, code: str) -> dict:
+    """Cumulative microseconds spent importing each package code pulls in"""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+    )
+    packages = {}
+    for line in out.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        # Whole packages, submodules are already counted in them
+        if "." not in name:
+            packages[name] = int(cumulative)
+    return packages
+
+
+def top_imports(env: dict, n: int) -> list:
+    """Packages app.main pulls in, by cumulative import time"""
+    # Leave out what the interpreter imports at startup anyway
+    startup = import_times(env, "pass")
+    packages = import_times(env, "import app.main")
+    added = ((us, name) for name, us in packages.items() if name not in startup)
+    return sorted(added, reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--runs", type=int, default=5, help="fresh interpreters to import app.main in"
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=1.0,
+        help="budget for the median import time",
+    )
+    parser.add_argument(
+        "--max-rss-mb",
+        type=float,
+        default=120.0,
+        help="budget for the peak RSS after importing",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="slowest packages to list, 0 for none"
+    )
+    args = parser.parse_args()
+
+    env = child_env(tempfile.mkdtemp(prefix="census-coldstart-"))
+    runs = [measure(env) for _ in range(args.runs)]
+    seconds = statistics.median(run["seconds"] for run in runs)
+    rss_mb = max(run["rss_mb"] for run in runs)
+    heavy = sorted({name for run in runs for name in run["heavy"]})
+
+    print(
+        f"import app.main: {seconds * 1000:.0f} ms median over {args.runs} runs"
+        f" (budget {args.max_seconds * 1000:.0f} ms)"
+    )
+    print(f"peak RSS: {rss_mb:.1f} MB (budget {args.max_rss_mb:.1f} MB)")
+    if args.top:
+        print("\nslowest imports:")
+        for cumulative, name in top_imports(env, args.top):
+            print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+
+    failures = []
+    if seconds > args.max_seconds:
+        failures.append(
+            f"import took {seconds:.3f}s, budget is {args.max_seconds:.3f}s"
+        )
+    if rss_mb > args.max_rss_mb:
+        failures.append(
+            f"peak RSS was {rss_mb:.1f} MB, budget is {args.max_rss_mb:.1f} MB"
+        )
+    if heavy:
+        failures.append(f"imported {', '.join(heavy)}, which only ingestion needs")
+    if failures:
+        print("\nover budget:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("\nwithin budget")
+
+
+if __name__ == "__main__":
+    main()
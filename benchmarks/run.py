@@ -0,0 +1,334 @@
+"""
+Benchmarks for our API
+
+Drives app.main:app in-process through an async ASGI client, against a
+throwaway SQLite database standing in for Postgres, and reports throughput
+and p50/p95/p99 latency per endpoint. Results can be saved as a baseline and
+later runs compared against it, exiting non-zero if any endpoint's p95 got
+worse than the threshold allows
+
+Usage (from the repo root, with benchmarks/requirements.txt installed):
+    python benchmarks/run.py [--requests N] [--concurrency N] [--traffic FILE]
+                             [--baseline FILE] [--save-baseline]
+                             [--threshold 0.5]
+
+Without --traffic we run our built-in scenarios: login, get_comparison (with
+and without base_year), get_record_by_id, new_record and load_pickle. With
+--traffic we replay a JSON lines file instead, one request per line:
+    {"method": "POST", "path": "/data/get_comparison", "json": {...},
+     "name": "optional label"}
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Point the app at a scratch SQLite DB before it reads its settings
+SCRATCH = tempfile.mkdtemp(prefix="census-bench-")
+os.environ.setdefault("PROJECT_NAME", "census-bench")
+os.environ.setdefault("authjwt_secret_key", "bench")
+os.environ["DATABASE_URI"] = "sqlite+aiosqlite:///" + os.path.join(
+    SCRATCH, "bench.db"
+)
+os.environ["DENYLIST_PATH"] = os.path.join(SCRATCH, "denylist.sqlite3")
+os.environ.setdefault(
+    "CENSUS_DATASET_PATH", os.path.join(ROOT, "data_processing", "census.arrow")
+)
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+from app.core.services.metrics import route_label  # noqa: E402
+from app.main import app  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+USER = {"username": "bench", "password": "bench"}
+RACES = ("white", "asian")
+SEXES = ("male", "female")
+YEARS = range(2002, 2020)
+
+
+def comparison_body(rng: random.Random, base_year: bool) -> Dict[str, Any]:
+    body = {
+        "race": rng.choice(RACES),
+        "sex": rng.choice(SEXES),
+        "age": rng.randint(15, 54),
+        "year": rng.choice(YEARS),
+    }
+    if base_year:
+        body["base_year"] = rng.choice(YEARS)
+    return body
+
+
+def record_body(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "race": rng.choice(RACES),
+        "age_range": "15-24",
+        "year": rng.randint(2020, 2100),
+        "num_males_with_income": rng.randint(1000, 20000),
+        "male_median_income_curr_dollars": rng.uniform(10000, 90000),
+        "male_median_income_2019_dollars": rng.uniform(10000, 90000),
+        "num_females_with_income": rng.randint(1000, 20000),
+        "female_median_income_curr_dollars": rng.uniform(10000, 90000),
+        "female_median_income_2019_dollars": rng.uniform(10000, 90000),
+    }
+
+
+def scenarios(n: int, seed: int) -> List[Dict[str, Any]]:
+    """Our built-in workload, same requests every run for a given seed"""
+    rng = random.Random(seed)
+    plan = []
+    # bcrypt and full reloads are slow on purpose, so run fewer of them
+    for _ in range(max(1, n // 10)):
+        plan.append(
+            {"name": "login", "method": "POST", "path": "/auth/login", "json": USER}
+        )
+    for _ in range(n):
+        plan.append({
+            "name": "get_comparison",
+            "method": "POST",
+            "path": "/data/get_comparison",
+            "json": comparison_body(rng, base_year=False),
+        })
+    for _ in range(n):
+        plan.append({
+            "name": "get_comparison_base_year",
+            "method": "POST",
+            "path": "/data/get_comparison",
+            "json": comparison_body(rng, base_year=True),
+        })
+    for _ in range(n):
+        plan.append({
+            "name": "get_record_by_id",
+            "method": "GET",
+            "path": f"/data/{rng.randint(1, 252)}",
+        })
+    for _ in range(n):
+        plan.append({
+            "name": "new_record",
+            "method": "POST",
+            "path": "/data/new_record",
+            "json": record_body(rng),
+        })
+    for _ in range(max(1, n // 40)):
+        plan.append({
+            "name": "load_pickle",
+            "method": "POST",
+            "path": "/data/load_pickle?upsert=true&wait=true",
+        })
+    return plan
+
+
+def route_name(method: str, path: str) -> str:
+    # Name replayed requests by the route they hit, so /data/1 and /data/2
+    # are reported together as /data/{record_id}
+    scope = {
+        "type": "http",
+        "app": app,
+        "method": method,
+        "path": path.split("?")[0],
+        "root_path": "",
+    }
+    return f"{method} {route_label(scope)}"
+
+
+def read_traffic(path: str) -> List[Dict[str, Any]]:
+    plan = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entry.setdefault("name", route_name(entry["method"], entry["path"]))
+                plan.append(entry)
+    return plan
+
+
+async def run_batch(
+    client: httpx.AsyncClient, entries: List[Dict[str, Any]], concurrency: int
+) -> Dict[str, Any]:
+    """
+    Sends entries in order with up to concurrency in flight, returns timings
+    per endpoint name
+
+    req/s is each endpoint's share of the batch, so when a batch mixes
+    endpoints their rates add up to the batch's
+    """
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    queue = iter(entries)
+
+    async def worker():
+        for entry in queue:
+            start = time.perf_counter()
+            resp = await client.request(
+                entry["method"], entry["path"], json=entry.get("json")
+            )
+            latencies[entry["name"]].append(time.perf_counter() - start)
+            if resp.status_code >= 400:
+                errors[entry["name"]] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    results = {}
+    for name, times in latencies.items():
+        ms = np.array(times) * 1000
+        results[name] = {
+            "requests": len(times),
+            "errors": errors[name],
+            "rps": len(times) / elapsed if elapsed else 0.0,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+        }
+    return results
+
+
+async def run(
+    batches: List[List[Dict[str, Any]]], concurrency: int
+) -> Dict[str, Dict[str, Any]]:
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            # Log in and load our data, none of this is timed
+            await client.post("/users/create", json=USER)
+            token = (await client.post("/auth/login", json=USER)).json()["access_token"]
+            client.headers["Authorization"] = f"Bearer {token}"
+            await client.post("/data/load_pickle?upsert=true&wait=true")
+
+            results = {}
+            for batch in batches:
+                # Only one load runs at a time, concurrent ones would just get
+                # a 409
+                limit = 1 if batch[0]["name"] == "load_pickle" else concurrency
+                results.update(await run_batch(client, batch, limit))
+            return results
+    finally:
+        await app.router.shutdown()
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    threshold: float,
+) -> List[str]:
+    """Returns a line for each endpoint whose p95 regressed past threshold"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        # Ignore sub millisecond wobble on fast endpoints
+        allowed = max(base["p95_ms"] * (1 + threshold), base["p95_ms"] + 1.0)
+        if result["p95_ms"] > allowed:
+            regressions.append(
+                f"{name}: p95 {result['p95_ms']:.2f}ms, "
+                f"baseline {base['p95_ms']:.2f}ms"
+            )
+    return regressions
+
+
+def print_report(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Optional[Dict[str, Dict[str, Any]]],
+) -> None:
+    print(
+        f"{'endpoint':<36}{'reqs':>6}{'errs':>6}{'req/s':>10}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'base p95':>10}"
+    )
+    for name, r in results.items():
+        base = baseline.get(name, {}).get("p95_ms") if baseline else None
+        base = f"{base:.2f}" if base is not None else "-"
+        print(
+            f"{name:<36}{r['requests']:>6}{r['errors']:>6}{r['rps']:>10.1f}"
+            f"{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{base:>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="requests per built-in endpoint"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="requests in flight at once"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed for the built-in workload"
+    )
+    parser.add_argument(
+        "--traffic", default=None, help="JSON lines file of requests to replay"
+    )
+    parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE,
+        help="baseline results to compare against",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="write these results out as the baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="allowed p95 slowdown, 0.5 is 50%%",
+    )
+    args = parser.parse_args()
+
+    if args.traffic:
+        # Replay the file as is, endpoints interleaved the way they were recorded
+        batches = [read_traffic(args.traffic)]
+    else:
+        # Run our built-in endpoints one after another so they don't skew each other
+        groups: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for entry in scenarios(args.requests, args.seed):
+            groups[entry["name"]].append(entry)
+        batches = list(groups.values())
+    results = asyncio.run(run(batches, args.concurrency))
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            settings = {
+                k: v
+                for k, v in vars(args).items()
+                if k not in ("baseline", "save_baseline", "threshold")
+            }
+            json.dump({"args": settings, "results": results}, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        return
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nregressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nno regressions")
+
+
+if __name__ == "__main__":
+    main()
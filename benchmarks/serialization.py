@@ -0,0 +1,140 @@
+"""
+CPU cost of serializing our data endpoint responses
+
+Compares what FastAPI does for us by default (validate through the response
+model, jsonable_encoder, stdlib json) with our FAST_JSON path (prebuilt
+dicts, orjson) for each kind of response, and reports CPU microseconds per
+response and how much of it the fast path saves
+
+Usage (from the repo root):
+    python benchmarks/serialization.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault("PROJECT_NAME", "census-bench")
+os.environ.setdefault("authjwt_secret_key", "bench")
+# Serializers pick their path at import, we want the fast one available
+os.environ["FAST_JSON"] = "true"
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.core.services import serialize  # noqa: E402
+from app.models.record import CensusRecord  # noqa: E402
+from app.schemas.comparison import Comparison  # noqa: E402
+from app.schemas.record import RecordOut  # noqa: E402
+
+RECORD = CensusRecord(
+    id=5,
+    race="asian",
+    age_range="15-24",
+    year=2016,
+    num_males_with_income=861,
+    male_median_income_curr_dollars=11626.0,
+    male_median_income_2019_dollars=12386.0,
+    num_females_with_income=805,
+    female_median_income_curr_dollars=9377.0,
+    female_median_income_2019_dollars=9990.0,
+)
+# What make_comparisons hands us for each sex, straight out of numpy
+SIDES = {
+    "male": (3657.0, "white", 10047.0, 101.25, 98.5),
+    "female": (820.0, "asian", 9505.0, None, None),
+}
+
+
+def default_record():
+    return JSONResponse(jsonable_encoder(RecordOut.from_orm(RECORD))).body
+
+
+def fast_record():
+    return serialize.FastJSONResponse(serialize.record_dict(RECORD)).body
+
+
+def _comparison(build):
+    return {
+        "year": 2019,
+        "sex": None,
+        "age": 30,
+        "comparison": {sex: build(*side) for sex, side in SIDES.items()},
+    }
+
+
+def _model(
+    income_difference,
+    head,
+    population_difference,
+    percent_change_income,
+    percent_change_pop,
+):
+    return Comparison(
+        income_difference=income_difference,
+        head=head,
+        population_difference=population_difference,
+        percent_change_income=percent_change_income,
+        percent_change_pop=percent_change_pop,
+    )
+
+
+def default_comparison():
+    return JSONResponse(jsonable_encoder(_comparison(_model))).body
+
+
+def fast_comparison():
+    return serialize.FastJSONResponse(_comparison(serialize.comparison)).body
+
+
+def default_batch():
+    batch = [_comparison(_model) for _ in range(100)]
+    return JSONResponse(jsonable_encoder(batch)).body
+
+
+def fast_batch():
+    batch = [_comparison(serialize.comparison) for _ in range(100)]
+    return serialize.FastJSONResponse(batch).body
+
+
+CASES = (
+    ("get_record_by_id", default_record, fast_record),
+    ("get_comparison", default_comparison, fast_comparison),
+    ("get_comparisons x100", default_batch, fast_batch),
+)
+
+
+def cpu_us(fn, repeat: int) -> float:
+    fn()
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20000, help="responses to time per case"
+    )
+    args = parser.parse_args()
+
+    if serialize.orjson is None:
+        print("orjson isn't installed, the fast path only skips validation\n")
+    print(f"{'response':<24}{'default us':>12}{'fast us':>10}{'saved':>8}")
+    for name, default, fast in CASES:
+        # Both paths have to produce the same JSON for the timings to mean anything
+        assert json.loads(default()) == json.loads(fast()), name
+        repeat = args.repeat // 100 if "x100" in name else args.repeat
+        slow_us, fast_us = cpu_us(default, repeat), cpu_us(fast, repeat)
+        saved = 1 - fast_us / slow_us
+        print(f"{name:<24}{slow_us:>12.1f}{fast_us:>10.1f}{saved:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,33 @@
+"""
+ETL for Census P-08 (Age, by Median Income and Sex) workbooks
+
+Reads any number of P-08 style workbooks, one per race, and writes them out as
+a single Arrow dataset the API can load. Instead of slicing each sheet at fixed
+offsets, we find the age blocks and data rows from what's in column A, so new
+race tables or releases with more years work without changes
+
+Usage:
+    python process_xls.py [workbook.xlsx ...] [--out-dir DIR] [--workers N]
+                          [--incremental] [--cache-dir DIR]
+
+With no workbooks given, every p08*.xlsx next to this script is processed
+
+With --incremental, each workbook's normalized rows are cached by the sha256 of
+the file and only workbooks whose hash changed get parsed again. We also write
+census.diff.arrow, the (race, year, age_range) rows that were added, changed or
+removed since the last dataset, so loaders can apply just the delta
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
 
 # Define our header
 col_names = [
@@ -11,95 +40,8 @@ col_names = [
     "female_median_income_2019_dollars",
 ]
 
-# Load Asian census data XLS, skipping all headers
-dfa = pd.read_excel(
-    r'p08a.xlsx',
-    skiprows=8,
-    # Make sure PD doesn't use header row for our DF
-    header=None,
-    # Define col names
-    names=col_names,
-)
-# Load White census data XLS, skipping all headers
-dfw = pd.read_excel(
-    r'p08w.xlsx',
-    skiprows=8,
-    # Make sure PD doesn't use header row for our DF
-    header=None,
-    # Define cold names
-    names=col_names
-)
-# Splinter off rows into age group DFs for both sets of data
-dfa1524 = dfa.iloc[:20]
-dfa2534 = dfa.iloc[25:45]
-dfa3544 = dfa.iloc[50:70]
-dfa4554 = dfa.iloc[75:95]
-dfa5564 = dfa.iloc[100:120]
-dfa6574 = dfa.iloc[125:145]
-dfa75 = dfa.iloc[150:170]
-
-dfw1524 = dfw.iloc[:20]
-dfw2534 = dfw.iloc[25:45]
-dfw3544 = dfw.iloc[50:70]
-dfw4554 = dfw.iloc[75:95]
-dfw5564 = dfw.iloc[100:120]
-dfw6574 = dfw.iloc[125:145]
-dfw75 = dfw.iloc[150:170]
-
-# Add Age Range col to each DF
-dfa1524.insert(0, 'age_range', '15-24')
-dfa2534.insert(0, 'age_range', '25-34')
-dfa3544.insert(0, 'age_range', '35-44')
-dfa4554.insert(0, 'age_range', '45-54')
-dfa5564.insert(0, 'age_range', '55-64')
-dfa6574.insert(0, 'age_range', '65-74')
-dfa75.insert(0, 'age_range', 'Over 75')
-
-dfw1524.insert(0, 'age_range', '15-24')
-dfw2534.insert(0, 'age_range', '25-34')
-dfw3544.insert(0, 'age_range', '35-44')
-dfw4554.insert(0, 'age_range', '45-54')
-dfw5564.insert(0, 'age_range', '55-64')
-dfw6574.insert(0, 'age_range', '65-74')
-dfw75.insert(0, 'age_range', 'Over 75')
-
-# Stack cleaned DF's vertically
-dfa = pd.concat([
-    dfa1524,
-    dfa2534,
-    dfa3544,
-    dfa4554,
-    dfa5564,
-    dfa6574,
-    dfa75
-], axis=0)
-
-dfw = pd.concat([
-    dfw1524,
-    dfw2534,
-    dfw3544,
-    dfw4554,
-    dfw5564,
-    dfw6574,
-    dfw75
-], axis=0)
-
-# Add Race col
-dfa.insert(0, 'race', 'asian')
-dfw.insert(0, 'race', 'white')
-
-# Clean garbage chars in Year col using regex
-dfa['year'] = dfa['year'].replace(to_replace=r'(\s\(\d+\))', value='', regex=True)
-dfw['year'] = dfw['year'].replace(to_replace=r'(\s\(\d+\))', value='', regex=True)
-
-# Stack our cleaned + normalized data into a single DF
-df = pd.concat([
-    dfa,
-    dfw
-], axis=0)
-
-# Convert the DF col types to conform to our CensusRecord model
-df = df.astype({
+# Col types that conform to our CensusRecord model
+col_types = {
     "race": str,
     "age_range": str,
     "year": int,
@@ -109,7 +51,279 @@ df = df.astype({
     "num_females_with_income": int,
     "female_median_income_curr_dollars": float,
     "female_median_income_2019_dollars": float,
-})
+}
+
+# "Table P-8. Age--White People, by Median Income and Sex: 1967 to 2019"
+title_re = re.compile(r"Age--(?P<race>.+?) People", re.IGNORECASE)
+# "15 to 24 Years", "..65 to 74 Years"
+age_block_re = re.compile(r"(?P<low>\d+) to (?P<high>\d+) Years")
+# "..75 Years and Over"
+age_over_re = re.compile(r"(?P<low>\d+) Years and Over")
+# "2019", "2017 (40)", everything else in col A is a header or a footnote
+data_row_re = re.compile(r"^\d{4}(\s\(\d+\))?$")
+# Garbage footnote refs in our Year col
+year_footnote_re = r"(\s\(\d+\))"
+
+# What makes a census row unique
+key_cols = ["race", "year", "age_range"]
+
+
+def find_race(sheet: pd.DataFrame) -> str:
+    # Race comes from the table title at the top of the sheet
+    for cell in sheet[0].dropna().astype(str):
+        match = title_re.search(cell)
+        if match:
+            return match.group("race").strip().lower()
+    raise ValueError("could not find a P-8 table title to get race from")
+
+
+def find_age_range(cell: str):
+    # Turn an age block header into the age range we store, None if it isn't one
+    match = age_block_re.search(cell)
+    if match:
+        return f"{match.group('low')}-{match.group('high')}"
+    match = age_over_re.search(cell)
+    if match:
+        return f"Over {match.group('low')}"
+    return None
+
+
+def parse_workbook(path: str) -> pd.DataFrame:
+    """
+    Reads a single P-08 workbook into a frame of raw rows
+
+    Rows come back with race and age_range filled in, but year cleaning and
+    type casting are left for once all workbooks are stacked together
+    """
+    sheet = pd.read_excel(path, header=None)
+    if sheet.shape[1] != len(col_names):
+        raise ValueError(f"{path} has {sheet.shape[1]} cols, expected {len(col_names)}")
+    sheet.columns = range(len(col_names))
+    first_col = sheet[0].astype(str).str.strip()
+
+    # Mark the start of each age block, then carry its range down to its rows
+    age_ranges = first_col.map(find_age_range)
+    age_ranges = age_ranges.ffill()
+    # Only keep rows that look like data, this drops headers and footnotes
+    is_data = first_col.str.match(data_row_re) & age_ranges.notna()
+
+    df = sheet[is_data].copy()
+    df.columns = col_names
+    df.insert(0, "age_range", age_ranges[is_data])
+    df.insert(0, "race", find_race(sheet))
+    return df.reset_index(drop=True)
+
+
+def normalize(frames) -> pd.DataFrame:
+    # Stack our parsed workbooks into a single DF
+    df = pd.concat(frames, axis=0, ignore_index=True)
+    # Clean garbage chars in Year col using regex
+    df["year"] = df["year"].astype(str).str.replace(year_footnote_re, "", regex=True)
+    # Convert the DF col types to conform to our CensusRecord model
+    return df.astype(col_types)
+
+
+def file_sha256(path: str) -> str:
+    # Hash a file in chunks so big workbooks don't need to fit in memory
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_all(workbooks, workers) -> list:
+    # openpyxl parsing is CPU bound, so give each workbook its own process
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(parse_workbook, workbooks))
+
+
+def incremental_frames(workbooks, cache_dir: str, workers) -> list:
+    """
+    Returns a normalized frame per workbook, only parsing ones that changed
+
+    Normalized frames are cached in cache_dir as <sha256>.arrow, and
+    index.json maps each workbook to the hash we last parsed it at
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, "index.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    hashes = {path: file_sha256(path) for path in workbooks}
+    stale = [
+        path for path in workbooks
+        if index.get(os.path.abspath(path)) != hashes[path]
+        or not os.path.exists(os.path.join(cache_dir, hashes[path] + ".arrow"))
+    ]
+    if stale:
+        # Normalize everything we re-parsed in one go, then split it back up
+        raw = parse_all(stale, workers)
+        df = normalize(raw)
+        start = 0
+        for path, frame in zip(stale, raw):
+            part = df.iloc[start:start + len(frame)].reset_index(drop=True)
+            start += len(frame)
+            feather.write_feather(
+                part,
+                os.path.join(cache_dir, hashes[path] + ".arrow"),
+                compression="uncompressed",
+            )
+    print(
+        f"parsed {len(stale)} of {len(workbooks)} workbooks, "
+        "the rest came from cache"
+    )
+
+    # Drop cache entries for workbooks we no longer process
+    new_index = {os.path.abspath(path): hashes[path] for path in workbooks}
+    for old_hash in set(index.values()) - set(new_index.values()):
+        cached = os.path.join(cache_dir, old_hash + ".arrow")
+        if os.path.exists(cached):
+            os.remove(cached)
+    with open(index_path, "w") as f:
+        json.dump(new_index, f, indent=2)
+
+    return [
+        feather.read_feather(os.path.join(cache_dir, hashes[path] + ".arrow"))
+        for path in workbooks
+    ]
+
+
+def diff_datasets(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compares two datasets on (race, year, age_range)
+
+    Returns the rows that were added or changed (with their new values) and
+    removed (with their old values), with a change col saying which. Like the
+    API, if a key shows up more than once the first row wins
+    """
+    old = old.drop_duplicates(key_cols, keep="first")
+    new = new.drop_duplicates(key_cols, keep="first")
+    merged = new.merge(
+        old, on=key_cols, how="outer", suffixes=("", "_old"), indicator=True
+    )
+    value_cols = [col for col in new.columns if col not in key_cols]
+
+    added = merged["_merge"] == "left_only"
+    removed = merged["_merge"] == "right_only"
+    both = merged["_merge"] == "both"
+    differs = pd.Series(False, index=merged.index)
+    for col in value_cols:
+        differs |= merged[col] != merged[col + "_old"]
+    changed = both & differs
+
+    # Removed rows only have their old values, move them over
+    for col in value_cols:
+        merged.loc[removed, col] = merged.loc[removed, col + "_old"]
+    merged["change"] = None
+    merged.loc[added, "change"] = "added"
+    merged.loc[changed, "change"] = "changed"
+    merged.loc[removed, "change"] = "removed"
+
+    diff = merged[merged["change"].notna()][["change"] + list(new.columns)]
+    return diff.astype(col_types).reset_index(drop=True)
+
+
+def write_dataset(df: pd.DataFrame, out_dir: str) -> dict:
+    """Writes our DF out as census.arrow plus census.manifest.json"""
+    data_path = os.path.join(out_dir, "census.arrow")
+    # Write the DF out as an Arrow IPC file, uncompressed so the API can memory
+    # map it and read it zero-copy. Each race gets its own record batch so
+    # readers can skip the races they don't need
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    batches = []
+    with pa.OSFile(data_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            for race in df["race"].unique():
+                batch = pa.RecordBatch.from_pandas(
+                    df[df["race"] == race], schema=table.schema, preserve_index=False
+                )
+                writer.write_batch(batch)
+                batches.append({"race": race, "num_rows": batch.num_rows})
+
+    # Hash what we wrote so loaders can tell if the data changed without
+    # reading it
+    content_hash = file_sha256(data_path)
+
+    # Write a small manifest next to our data describing it
+    manifest = {
+        "format": "arrow-ipc",
+        "file": "census.arrow",
+        "schema": [
+            {"name": field.name, "type": str(field.type)} for field in table.schema
+        ],
+        "num_rows": table.num_rows,
+        "batches": batches,
+        "sha256": content_hash,
+    }
+    with open(os.path.join(out_dir, "census.manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    return manifest
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("workbooks", nargs="*", help="P-08 workbooks to process")
+    parser.add_argument("--out-dir", default=here, help="where to write census.arrow")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="max processes to parse with"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only re-parse workbooks that changed",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="where to cache parsed workbooks, defaults to OUT_DIR/.etl_cache",
+    )
+    args = parser.parse_args()
+
+    workbooks = args.workbooks or sorted(glob.glob(os.path.join(here, "p08*.xlsx")))
+    if not workbooks:
+        parser.error("no workbooks to process")
+
+    if not args.incremental:
+        df = normalize(parse_all(workbooks, args.workers))
+        manifest = write_dataset(df, args.out_dir)
+        print(
+            f"wrote {manifest['num_rows']} rows from {len(workbooks)} workbooks, "
+            f"sha256 {manifest['sha256']}"
+        )
+        return
+
+    cache_dir = args.cache_dir or os.path.join(args.out_dir, ".etl_cache")
+    frames = incremental_frames(workbooks, cache_dir, args.workers)
+    df = pd.concat(frames, axis=0, ignore_index=True)
+
+    # Diff against the dataset we're about to replace, if there is one
+    data_path = os.path.join(args.out_dir, "census.arrow")
+    if os.path.exists(data_path):
+        old = feather.read_feather(data_path)
+    else:
+        old = df.iloc[0:0]
+    diff = diff_datasets(old, df)
+    feather.write_feather(
+        diff,
+        os.path.join(args.out_dir, "census.diff.arrow"),
+        compression="uncompressed",
+    )
+
+    manifest = write_dataset(df, args.out_dir)
+    counts = diff["change"].value_counts()
+    print(
+        f"wrote {manifest['num_rows']} rows from {len(workbooks)} workbooks, "
+        f"sha256 {manifest['sha256']}, {counts.get('added', 0)} added, "
+        f"{counts.get('changed', 0)} changed, {counts.get('removed', 0)} removed"
+    )
+
 
-# Pickle the DF
-df.to_pickle("./res.pkl")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Settings our app needs before anything under app/ is imported
+
+Tests never touch a real DB or denylist, everything goes in a scratch dir
+"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH = tempfile.mkdtemp(prefix="census-tests-")
+
+os.environ.setdefault("PROJECT_NAME", "census-tests")
+os.environ.setdefault("authjwt_secret_key", "tests")
+os.environ["DATABASE_URI"] = "sqlite+aiosqlite:///" + os.path.join(SCRATCH, "tests.db")
+os.environ["DATABASE_REPLICA_URIS"] = ""
+os.environ["DENYLIST_PATH"] = os.path.join(SCRATCH, "denylist.sqlite3")
+os.environ["CENSUS_DATASET_PATH"] = os.path.join(
+    ROOT, "data_processing", "census.arrow"
+)
+
+
+@pytest.fixture
+def client():
+    """
+    TestClient for our app, started up against the scratch DB on a loop of its
+    own, census_records is emptied again once we're done
+    """
+    from fastapi.testclient import TestClient
+    from sqlalchemy import delete
+
+    from app.core.services.cache import bump_dataset_version
+    from app.database import AsyncSessionLocal, engine
+    from app.main import app
+    from app.models.record import CensusRecord
+
+    async def empty_records():
+        async with AsyncSessionLocal() as session:
+            await session.execute(delete(CensusRecord))
+            await session.commit()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with TestClient(app) as client:
+            client.run = loop.run_until_complete
+            yield client
+            loop.run_until_complete(empty_records())
+            bump_dataset_version()
+        # Pooled connections belong to this loop
+        loop.run_until_complete(engine.dispose())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.fixture
+def auth_headers(client):
+    from fastapi_jwt_auth import AuthJWT
+
+    token = AuthJWT().create_access_token(subject="tests")
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from fastapi_jwt_auth import AuthJWT
+
+from app.core.config import settings
+from app.core.services import admission
+from app.core.services.admission import ConcurrencyLimiter, TokenBuckets, token_subject
+from app.main import get_application  # also loads our JWT settings
+
+ORIGIN = "http://example.com"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bursts_then_refills(clock):
+    buckets = TokenBuckets(rate=2, burst=3, maxsize=10)
+    assert [buckets.take("a") for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a") == 0.5
+    # Other clients have their own bucket
+    assert buckets.take("b") == 0
+    clock[0] += 0.5
+    assert buckets.take("a") == 0
+    # Never refills past burst
+    clock[0] += 60
+    assert [buckets.take("a") for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_forgets_least_recently_seen_clients(clock):
+    buckets = TokenBuckets(rate=1, burst=1, maxsize=2)
+    buckets.take("a")
+    buckets.take("b")
+    buckets.take("a")
+    buckets.take("c")
+    assert list(buckets._buckets) == ["a", "c"]
+    # b starts over with a full bucket
+    assert buckets.take("b") == 0
+
+
+def test_rate_zero_is_unlimited(clock):
+    buckets = TokenBuckets(rate=0, burst=0, maxsize=2)
+    assert [buckets.take("a") for _ in range(100)] == [0] * 100
+    assert not buckets._buckets
+
+
+async def settle():
+    # Let every waiter run as far as it can
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_limiter_hands_slots_over_in_order():
+    async def main():
+        limiter = ConcurrencyLimiter(limit=1, max_queue=2, queue_timeout=5)
+        assert await limiter.acquire()
+        order = []
+
+        async def wait(name):
+            assert await limiter.acquire()
+            order.append(name)
+
+        waiters = [asyncio.ensure_future(wait(name)) for name in ("first", "second")]
+        await settle()
+        assert limiter.queue_depth == 2
+        # Queue's full
+        assert not await limiter.acquire()
+        limiter.release()
+        await settle()
+        assert order == ["first"]
+        limiter.release()
+        await asyncio.gather(*waiters)
+        assert order == ["first", "second"]
+        assert limiter.in_flight == 1
+        assert limiter.queue_depth == 0
+        limiter.release()
+        assert limiter.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_limiter_times_out_waiters():
+    async def main():
+        limiter = ConcurrencyLimiter(limit=1, max_queue=2, queue_timeout=0.01)
+        assert await limiter.acquire()
+        assert not await limiter.acquire()
+        assert limiter.queue_depth == 0
+        # The slot goes back to nobody waiting
+        limiter.release()
+        assert limiter.in_flight == 0
+        assert await limiter.acquire()
+
+    asyncio.run(main())
+
+
+def scope(authorization=None):
+    headers = []
+    if authorization is not None:
+        headers.append((b"authorization", authorization.encode("latin-1")))
+    return {"headers": headers}
+
+
+def test_token_subject_needs_a_token_we_signed():
+    token = AuthJWT().create_access_token(subject="alice")
+    assert token_subject(scope(f"Bearer {token}")) == "alice"
+    header, payload, signature = token.split(".")
+    forged = ".".join((header, payload, signature[::-1]))
+    assert token_subject(scope(f"Bearer {forged}")) is None
+    assert token_subject(scope("Bearer not.a.token")) is None
+    assert token_subject(scope(f"Basic {token}")) is None
+    assert token_subject(scope()) is None
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(settings, "BACKEND_CORS_ORIGINS", [ORIGIN])
+    # Every client is already out of tokens
+    buckets = TokenBuckets(rate=0.001, burst=0, maxsize=10)
+    monkeypatch.setattr(admission, "buckets", buckets)
+    return TestClient(get_application())
+
+
+def test_rejections_carry_cors_headers(client):
+    response = client.get("/data/1", headers={"Origin": ORIGIN})
+    assert response.status_code == 429
+    assert response.headers["access-control-allow-origin"] == ORIGIN
+    assert int(response.headers["retry-after"]) >= 1
+
+
+def test_options_skip_admission(client):
+    preflight = client.options("/data/1", headers={
+        "Origin": ORIGIN,
+        "Access-Control-Request-Method": "GET",
+    })
+    assert preflight.status_code == 200
+    # Not a preflight, still never costs a token
+    assert client.options("/data/1").status_code != 429
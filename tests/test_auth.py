@@ -0,0 +1,110 @@
+import pytest
+from fastapi_jwt_auth import AuthJWT
+
+import app.main  # noqa: F401 loads our JWT settings
+from app.core.services import auth
+from app.core.services.auth import CachedAuthJWT, ClaimCache, revoke_token
+
+
+def claims(jti, exp=2000.0):
+    return {"sub": "alice", "jti": jti, "exp": exp}
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, "time", lambda: now[0])
+    return now
+
+
+def test_put_get(now):
+    cache = ClaimCache(maxsize=4)
+    cache.put(("token", None), claims("a"))
+    assert cache.get(("token", None)) == claims("a")
+    assert cache.get(("token", "issuer")) is None
+    assert cache.stats() == {"size": 1, "maxsize": 4, "hits": 1, "misses": 1}
+
+
+def test_entries_expire_with_their_token(now):
+    cache = ClaimCache(maxsize=4)
+    cache.put(("token", None), claims("a", exp=1010.0))
+    now[0] = 1010.0
+    assert cache.get(("token", None)) is not None
+    now[0] = 1011.0
+    assert cache.get(("token", None)) is None
+    assert cache.stats()["size"] == 0
+    assert not cache._by_jti
+
+
+def test_tokens_without_exp_or_jti_are_not_cached(now):
+    cache = ClaimCache(maxsize=4)
+    cache.put(("no exp", None), {"sub": "alice", "jti": "a"})
+    cache.put(("no jti", None), {"sub": "alice", "exp": 2000.0})
+    assert cache.stats()["size"] == 0
+    cache = ClaimCache(maxsize=0)
+    cache.put(("token", None), claims("a"))
+    assert cache.stats()["size"] == 0
+
+
+def test_evicts_least_recently_used(now):
+    cache = ClaimCache(maxsize=2)
+    cache.put(("a", None), claims("a"))
+    cache.put(("b", None), claims("b"))
+    cache.get(("a", None))
+    cache.put(("c", None), claims("c"))
+    assert cache.get(("b", None)) is None
+    assert cache.get(("a", None)) is not None
+    assert set(cache._by_jti) == {"a", "c"}
+
+
+def test_purge_jti(now):
+    cache = ClaimCache(maxsize=4)
+    cache.put(("token", None), claims("a"))
+    cache.put(("token", "issuer"), claims("a"))
+    cache.put(("other", None), claims("b"))
+    cache.purge_jti("a")
+    cache.purge_jti("never seen")
+    assert cache.get(("token", None)) is None
+    assert cache.get(("token", "issuer")) is None
+    assert cache.get(("other", None)) is not None
+
+
+@pytest.fixture
+def claim_cache(monkeypatch):
+    cache = ClaimCache(maxsize=4)
+    monkeypatch.setattr(auth, "claim_cache", cache)
+    return cache
+
+
+def test_tokens_are_verified_once(monkeypatch, claim_cache):
+    token = AuthJWT().create_access_token(subject="alice")
+    verified = []
+    verify = AuthJWT._verified_token
+
+    def counting(self, encoded_token, issuer=None):
+        verified.append(encoded_token)
+        return verify(self, encoded_token, issuer)
+
+    monkeypatch.setattr(AuthJWT, "_verified_token", counting)
+    first = CachedAuthJWT()._verified_token(token)
+    second = CachedAuthJWT()._verified_token(token)
+    assert first == second
+    assert first["sub"] == "alice"
+    assert verified == [token]
+
+
+def test_forged_tokens_are_not_cached(claim_cache):
+    token = AuthJWT().create_access_token(subject="alice")
+    header, payload, signature = token.split(".")
+    forged = ".".join((header, payload, signature[::-1]))
+    with pytest.raises(Exception):
+        CachedAuthJWT()._verified_token(forged)
+    assert claim_cache.stats()["size"] == 0
+
+
+def test_revoke_token_purges_and_denies(claim_cache):
+    token = AuthJWT().create_access_token(subject="alice")
+    raw = CachedAuthJWT()._verified_token(token)
+    revoke_token(raw)
+    assert claim_cache.stats()["size"] == 0
+    assert raw["jti"] in auth.denylist
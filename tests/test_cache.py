@@ -0,0 +1,163 @@
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.core.services import cache
+from app.core.services.cache import LRUCache, bump_dataset_version, comparison_key
+from app.core.services.record import get_cached_comparison
+from app.routers.record import etag_matches
+from app.schemas.request import Request
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+def test_evicts_least_recently_used(clock):
+    lru = LRUCache(maxsize=2, ttl=60)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    # Reading a makes b the least recently used
+    assert lru.get("a") == 1
+    lru.put("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    assert lru.stats()["evictions"] == 1
+
+
+def test_entries_expire(clock):
+    lru = LRUCache(maxsize=2, ttl=60)
+    lru.put("a", 1)
+    clock.now += 60
+    assert lru.get("a") == 1
+    clock.now += 1
+    assert lru.get("a") is None
+    stats = lru.stats()
+    assert stats["size"] == 0
+    assert stats["hits"] == stats["misses"] == stats["expirations"] == 1
+
+
+def test_zero_size_caches_nothing(clock):
+    lru = LRUCache(maxsize=0, ttl=60)
+    lru.put("a", 1)
+    assert lru.get("a") is None
+
+
+def test_bump_dataset_version_invalidates(monkeypatch):
+    monkeypatch.setattr(cache, "comparison_cache", LRUCache(maxsize=8, ttl=60))
+    request = Request(year=2019, age=30)
+    key = comparison_key(request, "25-34")
+    cache.comparison_cache.put(key, {"year": 2019})
+    bump_dataset_version()
+    assert cache.comparison_cache.stats()["size"] == 0
+    assert comparison_key(request, "25-34") != key
+
+
+def test_key_ignores_age_and_sex_within_a_range():
+    a = Request(year=2019, age=25, sex="m")
+    b = Request(year=2019, age=34, sex="f", base_year=0)
+    assert comparison_key(a, "25-34") == comparison_key(b, "25-34")
+    assert comparison_key(a, "25-34") != comparison_key(a, "35-44")
+    assert comparison_key(a, "25-34") != comparison_key(
+        Request(year=2019, age=25, base_year=2010), "25-34"
+    )
+
+
+def test_cached_comparison_echoes_request(monkeypatch):
+    monkeypatch.setattr(cache, "comparison_cache", LRUCache(maxsize=8, ttl=60))
+    calls = []
+
+    async def fake_comparison(request, session):
+        calls.append(request)
+        return {
+            "year": request.year,
+            "sex": request.sex,
+            "age": request.age,
+            "comparison": {},
+        }
+
+    async def fake_age_range(age, session):
+        return "25-34"
+
+    monkeypatch.setattr("app.core.services.record.make_comparison", fake_comparison)
+    monkeypatch.setattr(
+        "app.core.services.record.get_age_range_from_req", fake_age_range
+    )
+    first = asyncio.run(get_cached_comparison(Request(year=2019, age=25), None))
+    second = asyncio.run(
+        get_cached_comparison(Request(year=2019, age=34, sex="f"), None)
+    )
+    assert len(calls) == 1
+    assert (first["age"], first["sex"]) == (25, None)
+    assert (second["age"], second["sex"]) == (34, "f")
+
+
+def test_errors_are_cached_as_is(monkeypatch):
+    monkeypatch.setattr(cache, "comparison_cache", LRUCache(maxsize=8, ttl=60))
+    error = {"error": "query does not match any data for year 1990"}
+
+    async def fake_comparison(request, session):
+        return error
+
+    async def fake_age_range(age, session):
+        return "25-34"
+
+    monkeypatch.setattr("app.core.services.record.make_comparison", fake_comparison)
+    monkeypatch.setattr(
+        "app.core.services.record.get_age_range_from_req", fake_age_range
+    )
+    assert asyncio.run(get_cached_comparison(Request(year=1990, age=30), None)) == error
+
+
+@pytest.mark.parametrize("replica, computed", [(False, 1), (True, 2)])
+def test_replica_reads_without_cube_arent_cached(monkeypatch, replica, computed):
+    monkeypatch.setattr(
+        "app.core.services.record.comparison_cache", LRUCache(maxsize=8, ttl=60)
+    )
+    monkeypatch.setattr(settings, "CENSUS_CUBE_ENABLED", False)
+    calls = []
+
+    async def fake_comparison(request, session):
+        calls.append(request)
+        return {"error": "query does not match any data for year 2019"}
+
+    async def fake_age_range(age, session):
+        return "25-34"
+
+    monkeypatch.setattr("app.core.services.record.make_comparison", fake_comparison)
+    monkeypatch.setattr(
+        "app.core.services.record.get_age_range_from_req", fake_age_range
+    )
+    monkeypatch.setattr(
+        "app.core.services.record.is_replica_session", lambda session: replica
+    )
+    for _ in range(2):
+        asyncio.run(get_cached_comparison(Request(year=2019, age=30), None))
+    # A replica may lag behind the dataset version we'd cache it under
+    assert len(calls) == computed
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ("", False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('"xyz"', False),
+    ("*", True),
+])
+def test_etag_matches(header, matches):
+    assert etag_matches(header, '"abc"') is matches
@@ -0,0 +1,122 @@
+import asyncio
+from itertools import product
+
+import pytest
+
+from app.core.services import cube
+from app.core.services.cube import VALUE_FIELDS, CensusCube
+from app.core.services.dataset import iter_rows, open_dataset
+from app.core.services.record import make_comparison, make_comparisons
+from app.schemas.comparison import Comparison
+from app.schemas.request import Request
+
+CUBE_COLUMNS = ("race", "year", "age_range", *VALUE_FIELDS)
+
+
+@pytest.fixture(scope="module")
+def census_cube():
+    table = open_dataset(columns=CUBE_COLUMNS)
+    return CensusCube.from_rows(iter_rows(table, CUBE_COLUMNS))
+
+
+@pytest.fixture(autouse=True)
+def served(monkeypatch, census_cube):
+    # Serve comparisons out of our dataset, no DB needed
+    monkeypatch.setattr(cube, "_cube", census_cube)
+
+
+def old_age_range(age):
+    # The age ranges comparisons used to be hard coded to
+    for low, high in ((15, 24), (25, 34), (35, 44), (45, 54)):
+        if low <= age <= high:
+            return f"{low}-{high}"
+
+
+def scalar_comparison(census_cube, request):
+    """The white vs asian comparison, worked out one value at a time like we used to"""
+    age_range = old_age_range(request.age)
+    rows = {
+        race: census_cube.get(race, request.year, age_range)
+        for race in ("white", "asian")
+    }
+    base = {
+        race: census_cube.get(race, request.base_year, age_range) for race in rows
+    }
+    comparison = {}
+    for sex in ("male", "female"):
+        def income(row):
+            return max(getattr(row, f"{sex}_median_income_curr_dollars"),
+                       getattr(row, f"{sex}_median_income_2019_dollars"))
+
+        def pop(row):
+            return getattr(row, f"num_{sex}s_with_income")
+
+        w_income, a_income = income(rows["white"]), income(rows["asian"])
+        w_pop, a_pop = pop(rows["white"]), pop(rows["asian"])
+        percent_change_income = percent_change_pop = None
+        if request.base_year and request.race in rows:
+            own, own_base = rows[request.race], base[request.race]
+            percent_change_income = income(own) / income(own_base) * 100
+            percent_change_pop = pop(own) / pop(own_base) * 100
+        comparison[sex] = Comparison(
+            income_difference=max(w_income, a_income) - min(w_income, a_income),
+            head="white" if w_income > a_income else "asian",
+            population_difference=max(w_pop, a_pop) - min(w_pop, a_pop),
+            percent_change_income=percent_change_income,
+            percent_change_pop=percent_change_pop,
+        )
+    return {
+        "year": request.year,
+        "sex": request.sex,
+        "age": request.age,
+        "comparison": comparison,
+    }
+
+
+def requests_grid(census_cube):
+    return [
+        Request(year=year, base_year=base_year, race=race, age=age, sex=sex)
+        for year, base_year, race, age, sex in product(
+            census_cube.years,
+            (None, 2002, 2010, 2019),
+            (None, "white", "asian"),
+            (15, 24, 25, 40, 54),
+            ("m", None),
+        )
+    ]
+
+
+def test_batch_matches_scalar_math(census_cube):
+    requests = requests_grid(census_cube)
+    results = asyncio.run(make_comparisons(requests, None))
+    assert results == [scalar_comparison(census_cube, request) for request in requests]
+
+
+def test_single_matches_batch(census_cube):
+    requests = requests_grid(census_cube)[::37]
+    batch = asyncio.run(make_comparisons(requests, None))
+    singles = [asyncio.run(make_comparison(request, None)) for request in requests]
+    assert singles == batch
+
+
+def test_unknown_race_gets_no_percent_changes():
+    request = Request(year=2019, base_year=2010, race="martian", age=30)
+    result = asyncio.run(make_comparison(request, None))
+    assert result["comparison"]["male"].percent_change_income is None
+    assert result["comparison"]["female"].percent_change_pop is None
+
+
+def test_errors():
+    requests = [Request(year=2019, age=10), Request(year=1990, age=30)]
+    age, year = asyncio.run(make_comparisons(requests, None))
+    assert age == {"error": "query does not match any data for age 10"}
+    assert year == {"error": "query does not match any data for year 1990"}
+    request = Request(year=2019, base_year=1990, race="white", age=30)
+    missing_base = asyncio.run(make_comparison(request, None))
+    assert missing_base == {
+        "error": "query does not match any data for race white in 1990"
+    }
+
+
+def test_empty_batch():
+    assert asyncio.run(make_comparisons([], None)) == []
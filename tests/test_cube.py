@@ -0,0 +1,74 @@
+import numpy as np
+
+from app.core.services.cube import VALUE_FIELDS, CensusCube, CubeRow
+
+
+def row(race, year, age_range, base):
+    # (race, year, age_range, *VALUE_FIELDS) with values we can tell apart
+    values = (base, base + 0.5, base + 1.0, base + 2, base + 2.5, base + 3.0)
+    return (race, year, age_range, *values)
+
+
+ROWS = [
+    row("white", 2019, "15-24", 100),
+    row("asian", 2019, "15-24", 200),
+    row("white", 2018, "25-34", 300),
+    # Same key as the first row, a .first() query would never have seen it
+    row("white", 2019, "15-24", 400),
+]
+
+
+def test_from_rows_labels_are_sorted():
+    cube = CensusCube.from_rows(ROWS)
+    assert cube.races == ("asian", "white")
+    assert cube.years == (2018, 2019)
+    assert cube.age_ranges == ("15-24", "25-34")
+    assert cube.values.shape == (2, 2, 2, len(VALUE_FIELDS))
+
+
+def test_from_rows_keeps_first_of_duplicate_keys():
+    cube = CensusCube.from_rows(ROWS)
+    first = CubeRow("white", 2019, "15-24", 100, 100.5, 101.0, 102, 102.5, 103.0)
+    assert cube.get("white", 2019, "15-24") == first
+
+
+def test_get_casts_counts_back_to_int():
+    found = CensusCube.from_rows(ROWS).get("asian", 2019, "15-24")
+    assert isinstance(found.num_males_with_income, int)
+    assert isinstance(found.num_females_with_income, int)
+
+
+def test_get_misses():
+    cube = CensusCube.from_rows(ROWS)
+    # Labels we've never seen
+    assert cube.get("black", 2019, "15-24") is None
+    assert cube.get("white", 2000, "15-24") is None
+    assert cube.get("white", 2019, "Over 75") is None
+    # Every label is known, but that cell has no row
+    assert cube.get("asian", 2018, "25-34") is None
+
+
+def test_take_matches_get():
+    cube = CensusCube.from_rows(ROWS)
+    keys = [
+        ("white", 2019, "15-24"),
+        ("asian", 2018, "25-34"),
+        ("black", 2019, "15-24"),
+        ("white", None, "15-24"),
+        ("white", 2018, "25-34"),
+    ]
+    values, present = cube.take(*zip(*keys))
+    assert present.tolist() == [True, False, False, False, True]
+    for (race, year, age_range), found, value in zip(keys, present, values):
+        if found:
+            assert tuple(value.tolist()) == tuple(cube.get(race, year, age_range)[3:])
+        else:
+            assert np.isnan(value).all()
+
+
+def test_empty_cube():
+    cube = CensusCube.from_rows([])
+    assert cube.races == cube.years == cube.age_ranges == ()
+    assert cube.get("white", 2019, "15-24") is None
+    values, present = cube.take(["white"], [2019], ["15-24"])
+    assert not present.any()
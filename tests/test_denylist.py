@@ -0,0 +1,75 @@
+import pytest
+
+from app.core.services import denylist
+from app.core.services.denylist import DenylistError, MemoryDenylist, SQLiteDenylist
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(denylist.time, "time", lambda: now[0])
+    return now
+
+
+def test_memory_denies_until_exp(clock):
+    jtis = MemoryDenylist(bucket_seconds=10, default_ttl=60)
+    jtis.add("a", exp=1030.0)
+    jtis.add("b")
+    # Already expired, nothing to deny
+    jtis.add("c", exp=999.0)
+    assert "a" in jtis and "b" in jtis and "c" not in jtis
+    clock[0] = 1031.0
+    assert "a" not in jtis and "b" in jtis
+    clock[0] = 1061.0
+    assert "b" not in jtis
+    # Held on to until its whole bucket has expired
+    clock[0] = 1070.0
+    assert "b" not in jtis
+    assert len(jtis) == 0
+
+
+def test_sqlite_is_shared_and_kept(tmp_path, clock):
+    path = str(tmp_path / "nested" / "denylist.sqlite3")
+    one = SQLiteDenylist(path, bucket_seconds=10, default_ttl=60)
+    other = SQLiteDenylist(path, bucket_seconds=10, default_ttl=60)
+    one.add("a", exp=1030.0)
+    assert "a" in other
+    assert "b" not in other
+    clock[0] = 1031.0
+    assert "a" not in other
+    assert len(one) == 0
+
+
+def test_sqlite_remembers_known_good_jtis(tmp_path, clock):
+    path = str(tmp_path / "denylist.sqlite3")
+    worker = SQLiteDenylist(path, 10, 60, cache_seconds=1.0, cache_size=2)
+    other = SQLiteDenylist(path, 10, 60)
+    assert "a" not in worker
+    other.add("a")
+    # Revoked elsewhere, we only notice once our cache of it runs out
+    assert "a" not in worker
+    clock[0] += 1.0
+    assert "a" in worker
+
+
+def test_sqlite_add_drops_known_good(tmp_path, clock):
+    jtis = SQLiteDenylist(str(tmp_path / "denylist.sqlite3"), 10, 60, 1.0, 2)
+    assert "a" not in jtis
+    jtis.add("a")
+    assert "a" in jtis
+
+
+def test_sqlite_known_good_is_bounded(tmp_path, clock):
+    jtis = SQLiteDenylist(str(tmp_path / "denylist.sqlite3"), 10, 60, 1.0, 2)
+    for jti in ("a", "b", "c"):
+        assert jti not in jtis
+    assert list(jtis._known_good) == ["b", "c"]
+
+
+def test_sqlite_open_fails_clearly(tmp_path):
+    # A dir we can't create, whoever we're running as
+    (tmp_path / "file").write_text("")
+    jtis = SQLiteDenylist(str(tmp_path / "file" / "denylist.sqlite3"), 10, 60)
+    with pytest.raises(DenylistError, match="DENYLIST_PATH"):
+        jtis.open()
+    SQLiteDenylist(str(tmp_path / "denylist.sqlite3"), 10, 60).open()
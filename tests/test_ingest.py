@@ -0,0 +1,100 @@
+import json
+
+from app.core.config import settings
+from app.core.services.ingest import MAX_LINE_BYTES
+
+FIELDS = (
+    "race",
+    "age_range",
+    "year",
+    "num_males_with_income",
+    "male_median_income_curr_dollars",
+    "male_median_income_2019_dollars",
+    "num_females_with_income",
+    "female_median_income_curr_dollars",
+    "female_median_income_2019_dollars",
+)
+
+
+def record(year, race="white"):
+    return dict(zip(FIELDS, (race, "15-24", year, 10, 100.0, 101.0, 20, 200.0, 201.0)))
+
+
+def ndjson(*rows):
+    return "\n".join(r if isinstance(r, str) else json.dumps(r) for r in rows)
+
+
+def post(client, auth_headers, body, content_type="application/x-ndjson", **params):
+    return client.post(
+        "/data/records/bulk",
+        data=body.encode(),
+        params=params,
+        headers={**auth_headers, "Content-Type": content_type},
+    ).json()
+
+
+def years(client, auth_headers):
+    response = client.get("/data/records", headers=auth_headers)
+    return sorted(json.loads(line)["year"] for line in response.text.splitlines())
+
+
+def test_ndjson_skips_and_reports_bad_rows(client, auth_headers):
+    body = ndjson(
+        record(2001),
+        "{not json",
+        record(2002, race="much too long a race"),
+        "",
+        record(2003),
+    )
+    result = post(client, auth_headers, body)
+    assert result["status"] == "ok"
+    assert result["rows_received"] == 4
+    assert result["rows_inserted"] == 2
+    assert result["rows_invalid"] == 2
+    assert [error["line"] for error in result["errors"]] == [2, 3]
+    assert result["errors"][0]["errors"] == [{"msg": "invalid JSON"}]
+    assert result["errors"][1]["errors"][0]["loc"] == ["race"]
+    assert years(client, auth_headers) == [2001, 2003]
+
+
+def test_csv(client, auth_headers):
+    rows = [",".join(FIELDS)]
+    rows += [",".join(str(v) for v in record(year).values()) for year in (2001, 2002)]
+    rows.insert(2, "white,15-24,2010")
+    rows.append(",".join(str(v) for v in record(99999).values()))
+    result = post(client, auth_headers, "\n".join(rows), content_type="text/csv")
+    assert result["rows_inserted"] == 2
+    assert [error["line"] for error in result["errors"]] == [3, 5]
+    assert result["errors"][0]["errors"] == [{"msg": "expected 9 values, got 3"}]
+    assert years(client, auth_headers) == [2001, 2002]
+
+
+def test_over_long_lines_are_rejected(client, auth_headers):
+    body = ndjson(record(2001)) + "\n" + "x" * (MAX_LINE_BYTES + 1)
+    result = post(client, auth_headers, body)
+    assert result["status"] == "failed"
+    assert result["failure"] == f"line 2 is longer than {MAX_LINE_BYTES} bytes"
+    assert result["rows_inserted"] == 0
+    assert years(client, auth_headers) == []
+
+
+def failing_upload():
+    # Two full chunks of 2, then a line that fails the whole upload
+    rows = ndjson(*(record(year) for year in range(2001, 2005)))
+    return rows + "\n" + "x" * (MAX_LINE_BYTES + 1)
+
+
+def test_one_transaction_by_default(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(settings, "BULK_LOAD_CHUNK_SIZE", 2)
+    result = post(client, auth_headers, failing_upload())
+    assert result["status"] == "failed"
+    assert (result["rows_inserted"], result["chunks_committed"]) == (0, 0)
+    assert years(client, auth_headers) == []
+
+
+def test_commit_each_chunk_keeps_earlier_chunks(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(settings, "BULK_LOAD_CHUNK_SIZE", 2)
+    result = post(client, auth_headers, failing_upload(), commit_each_chunk="true")
+    assert result["status"] == "failed"
+    assert (result["rows_inserted"], result["chunks_committed"]) == (4, 2)
+    assert years(client, auth_headers) == [2001, 2002, 2003, 2004]
@@ -0,0 +1,235 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.core.services.dataset import DatasetError
+from app.core.services.jobs import (
+    JobConflict,
+    JobStatus,
+    LoadCancelled,
+    LoadJob,
+    LoadJobRunner,
+)
+from app.core.services.loader import bulk_load
+from app.database import Base
+from app.models.record import CensusRecord
+
+
+class Load:
+    """
+    Fake run callable, loads chunks rows of 10 then commits, stopping before
+    each step until we let it go
+    """
+
+    def __init__(self, chunks=3):
+        self.chunks = chunks
+        self.ran = False
+        self.gates = [asyncio.Event() for _ in range(chunks + 1)]
+
+    async def __call__(self, job):
+        self.ran = True
+        for i, gate in enumerate(self.gates[:-1], 1):
+            await gate.wait()
+            job.progress(i * 10)
+        await self.gates[-1].wait()
+        job.progress(self.chunks * 10, final=True)
+
+    def let_go(self, steps=None):
+        for gate in self.gates[:steps]:
+            gate.set()
+
+
+async def settle():
+    # Let every task run as far as it can
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_job_succeeds():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=10)
+        load = Load()
+        load.let_go()
+        job = await runner.wait(runner.submit("census", load))
+        assert job.status == JobStatus.succeeded
+        assert job.rows_processed == 30
+        assert job.finished_at >= job.started_at
+        assert runner.get(job.id) is job
+
+    asyncio.run(main())
+
+
+def test_one_job_per_dataset():
+    async def main():
+        runner = LoadJobRunner(workers=2, history=10)
+        load = Load()
+        job = runner.submit("census", load)
+        with pytest.raises(JobConflict) as conflict:
+            runner.submit("census", Load())
+        assert conflict.value.job is job
+        other = Load()
+        other.let_go()
+        await runner.wait(runner.submit("other", other))
+        load.let_go()
+        await runner.wait(job)
+        # Free again once it's done
+        again = Load()
+        again.let_go()
+        job = await runner.wait(runner.submit("census", again))
+        assert job.status == JobStatus.succeeded
+
+    asyncio.run(main())
+
+
+def test_cancel_before_start():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=10)
+        first, second = Load(), Load()
+        running = runner.submit("census", first)
+        queued = runner.submit("other", second)
+        await settle()
+        assert queued.status == JobStatus.queued
+        runner.cancel(queued.id)
+        first.let_go()
+        await runner.wait(running)
+        await runner.wait(queued)
+        assert queued.status == JobStatus.cancelled
+        assert not second.ran
+
+    asyncio.run(main())
+
+
+def test_cancel_mid_run():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=10)
+        load = Load()
+        job = runner.submit("census", load)
+        load.let_go(1)
+        await settle()
+        assert (job.status, job.rows_processed) == (JobStatus.running, 10)
+        runner.cancel(job.id)
+        load.let_go()
+        await runner.wait(job)
+        assert job.status == JobStatus.cancelled
+        assert job.rows_processed == 20
+
+    asyncio.run(main())
+
+
+def test_cancel_after_last_chunk():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=10)
+        load = Load()
+        job = runner.submit("census", load)
+        # Every chunk is in, we're just short of committing
+        load.let_go(3)
+        await settle()
+        assert job.rows_processed == 30
+        runner.cancel(job.id)
+        load.let_go()
+        await runner.wait(job)
+        assert job.status == JobStatus.cancelled
+
+    asyncio.run(main())
+
+
+def test_committing_jobs_cant_be_cancelled():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=10)
+        committed = asyncio.Event()
+
+        async def load(job):
+            job.progress(10, final=True)
+            await committed.wait()
+
+        job = runner.submit("census", load)
+        await settle()
+        assert runner.cancel(job.id).status == JobStatus.committing
+        assert not job.cancel_requested
+        committed.set()
+        await runner.wait(job)
+        assert job.status == JobStatus.succeeded
+        assert runner.cancel(job.id).cancel_requested is False
+        assert runner.cancel("no such job") is None
+
+    asyncio.run(main())
+
+
+def test_errors_dont_leak_db_internals():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=10)
+
+        async def db_error(job):
+            raise RuntimeError("password authentication failed for user postgres")
+
+        async def dataset_error(job):
+            raise DatasetError("census.arrow is corrupt")
+
+        failed = await runner.wait(runner.submit("census", db_error))
+        assert failed.status == JobStatus.failed
+        assert failed.error == "DB error loading dataset"
+        failed = await runner.wait(runner.submit("census", dataset_error))
+        assert failed.error == "census.arrow is corrupt"
+
+    asyncio.run(main())
+
+
+def test_history_is_trimmed():
+    async def main():
+        runner = LoadJobRunner(workers=1, history=2)
+        jobs = []
+        for _ in range(3):
+            load = Load()
+            load.let_go()
+            jobs.append(await runner.wait(runner.submit("census", load)))
+        running = runner.submit("census", Load())
+        # Oldest finished ones go first, never the one still running
+        assert list(runner.jobs) == [jobs[2].id, running.id]
+        # Shutting down before it got going, it never starts
+        await runner.shutdown()
+        assert running.status == JobStatus.cancelled
+
+    asyncio.run(main())
+
+
+def row(year):
+    return ("white", "15-24", year, 10, 100.0, 101.0, 20, 200.0, 201.0)
+
+
+def test_bulk_load_rolls_back_a_cancel_at_commit(tmp_path):
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        try:
+            job = LoadJob("census")
+
+            def cancel_at_commit(rows, final=False):
+                # Cancel lands after our last chunk went in
+                if final:
+                    job.cancel_requested = True
+                job.progress(rows, final)
+
+            async with AsyncSession(engine) as session:
+                with pytest.raises(LoadCancelled):
+                    await bulk_load(
+                        session, [row(2019), row(2018)], progress=cancel_at_commit
+                    )
+            async with AsyncSession(engine) as session:
+                count = await session.scalar(select(func.count(CensusRecord.id)))
+            assert job.rows_processed == 2
+            assert count == 0
+
+            job = LoadJob("census")
+            async with AsyncSession(engine) as session:
+                await bulk_load(session, [row(2019), row(2018)], progress=job.progress)
+            async with AsyncSession(engine) as session:
+                count = await session.scalar(select(func.count(CensusRecord.id)))
+            assert job.status == JobStatus.committing
+            assert count == 2
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
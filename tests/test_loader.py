@@ -0,0 +1,94 @@
+import asyncio
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.core.services.dataset import read_manifest
+from app.core.services.loader import bulk_load, load_census_dataset
+from app.database import Base
+from app.models.dataset import LoadedDataset
+from app.models.record import CensusRecord
+
+
+def run(tmp_path, test):
+    # Runs test(engine) against a fresh SQLite DB, so loads take the INSERT path
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'load.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        try:
+            await test(engine)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+
+async def count(engine):
+    async with AsyncSession(engine) as session:
+        return await session.scalar(select(func.count(CensusRecord.id)))
+
+
+def test_upsert_twice_loads_once(tmp_path):
+    manifest = read_manifest()
+
+    async def test(engine):
+        counts = []
+        for _ in range(2):
+            async with AsyncSession(engine) as session:
+                result = await load_census_dataset(session, upsert=True)
+            assert result.rows == manifest["num_rows"]
+            counts.append(await count(engine))
+        # The dataset repeats some keys, only their first copy is kept
+        assert counts[0] == counts[1] < manifest["num_rows"]
+        async with AsyncSession(engine) as session:
+            loaded = await session.get(LoadedDataset, "census")
+        assert loaded.sha256 == manifest["sha256"]
+
+    run(tmp_path, test)
+
+
+def test_upsert_updates_in_place(tmp_path):
+    async def test(engine):
+        async with AsyncSession(engine) as session:
+            await load_census_dataset(session)
+        async with AsyncSession(engine) as session:
+            first = await session.scalar(select(CensusRecord).order_by(CensusRecord.id))
+            first_id, males = first.id, first.num_males_with_income
+            await session.execute(
+                update(CensusRecord)
+                .where(CensusRecord.id == first_id)
+                .values(num_males_with_income=males + 1)
+            )
+            await session.commit()
+        async with AsyncSession(engine) as session:
+            await load_census_dataset(session, upsert=True)
+        async with AsyncSession(engine) as session:
+            reloaded = await session.get(CensusRecord, first_id)
+            assert reloaded.num_males_with_income == males
+
+    run(tmp_path, test)
+
+
+def row(year, males):
+    return ("white", "15-24", year, males, 100.0, 101.0, 20, 200.0, 201.0)
+
+
+def test_first_copy_of_a_key_wins(tmp_path):
+    async def test(engine):
+        async with AsyncSession(engine) as session:
+            await bulk_load(session, [row(2019, 1), row(2019, 2), row(2018, 3)])
+        async with AsyncSession(engine) as session:
+            await bulk_load(session, [row(2019, 4), row(2019, 5)], upsert=True)
+        async with AsyncSession(engine) as session:
+            records = (
+                await session.execute(select(CensusRecord).order_by(CensusRecord.id))
+            ).scalars().all()
+        # Without upsert both copies went in, the upsert updated the first
+        assert [(r.year, r.num_males_with_income) for r in records] == [
+            (2019, 4),
+            (2019, 2),
+            (2018, 3),
+        ]
+
+    run(tmp_path, test)
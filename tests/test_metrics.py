@@ -0,0 +1,74 @@
+import re
+
+from app.core.services.metrics import Counter, Histogram, route_label
+from app.main import app
+
+
+def sample(text, line_start):
+    # Value of the series whose line starts with line_start, 0 if it's not there
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+RECORD_ROUTE = 'method="GET",route="/data/{record_id}"'
+
+
+def test_requests_are_counted_by_route(client, auth_headers):
+    before = client.get("/metrics").text
+    for record_id in (1, 2, 3):
+        assert client.get(f"/data/{record_id}", headers=auth_headers).status_code == 200
+    after = client.get("/metrics")
+    assert after.headers["content-type"].startswith("text/plain")
+    after = after.text
+
+    def grew(series):
+        return sample(after, series) - sample(before, series)
+
+    # Every record id lands in the same series
+    assert grew(f"http_requests_total{{{RECORD_ROUTE},status=\"200\"}}") == 3
+    assert grew(f"http_request_duration_seconds_count{{{RECORD_ROUTE}}}") == 3
+    inf_bucket = f'http_request_duration_seconds_bucket{{{RECORD_ROUTE},le="+Inf"}}'
+    assert grew(inf_bucket) == 3
+    assert grew(f"db_queries_total{{{RECORD_ROUTE}}}") >= 3
+    assert sample(after, f"http_requests_in_flight{{{RECORD_ROUTE}}}") == 0
+    assert not re.search(r'route="/data/\d', after)
+
+
+def scope(method, path):
+    return {"type": "http", "app": app, "method": method, "path": path, "root_path": ""}
+
+
+def test_route_label():
+    assert route_label(scope("GET", "/data/12")) == "/data/{record_id}"
+    assert route_label(scope("POST", "/data/get_comparison")) == "/data/get_comparison"
+    # Right path, wrong method, still counted under its route
+    assert route_label(scope("DELETE", "/metrics")) == "/metrics"
+    assert route_label(scope("GET", "/nowhere/at/all")) == "<unmatched>"
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "How long", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(("/a",), value)
+    assert histogram.render() == [
+        "# HELP latency_seconds How long",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1.0"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 6.05',
+        'latency_seconds_count{route="/a"} 4',
+    ]
+
+
+def test_counter_render_escapes_labels():
+    gauge = Counter("things", "Things", ("name",), kind="gauge")
+    gauge.inc(('say "hi"\\\n',), 2)
+    gauge.inc(('say "hi"\\\n',), -1)
+    assert gauge.render() == [
+        "# HELP things Things",
+        "# TYPE things gauge",
+        'things{name="say \\"hi\\"\\\\\\n"} 1',
+    ]
@@ -0,0 +1,106 @@
+from sqlalchemy import create_engine, func, inspect, select
+
+from app import migrations
+from app.core.config import settings
+from app.database import AsyncSessionLocal, engine
+from app.migrations import MIGRATIONS, init_models, schema_version
+from app.models.record import CensusRecord
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def test_versions_only_go_up():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == list(range(1, len(MIGRATIONS) + 1))
+
+
+def recorder(applied, version):
+    def apply(conn):
+        applied.append(version)
+
+    return apply
+
+
+def test_only_missing_migrations_run_in_order(monkeypatch):
+    applied = []
+    steps = [(v, f"step {v}", recorder(applied, v)) for v in (1, 2, 3)]
+    monkeypatch.setattr(migrations, "MIGRATIONS", steps)
+    db = create_engine("sqlite://")
+    with db.begin() as conn:
+        assert migrations._migrate(conn) == 3
+    assert applied == [1, 2, 3]
+    # A DB that's only had the first one gets the rest
+    with db.begin() as conn:
+        conn.execute(schema_version.update().values(version=1))
+        assert migrations._migrate(conn) == 3
+        assert conn.execute(select(schema_version.c.version)).scalars().all() == [3]
+    assert applied == [1, 2, 3, 2, 3]
+
+
+def versions(client):
+    async def read():
+        async with engine.connect() as conn:
+            result = await conn.execute(select(schema_version.c.version))
+            return result.scalars().all()
+
+    return client.run(read())
+
+
+def count_records(client):
+    async def count():
+        async with AsyncSessionLocal() as session:
+            return await session.scalar(select(func.count(CensusRecord.id)))
+
+    return client.run(count())
+
+
+def add_record(client):
+    async def add():
+        async with AsyncSessionLocal() as session:
+            session.add(CensusRecord(
+                race="white",
+                age_range="15-24",
+                year=2019,
+                num_males_with_income=1,
+                male_median_income_curr_dollars=1.0,
+                male_median_income_2019_dollars=1.0,
+                num_females_with_income=1,
+                female_median_income_curr_dollars=1.0,
+                female_median_income_2019_dollars=1.0,
+            ))
+            await session.commit()
+
+    client.run(add())
+
+
+def test_startup_migrates_the_test_db(client):
+    # Our client fixture already ran init_models on startup
+    assert versions(client) == [LATEST]
+
+    async def schema():
+        async with engine.connect() as conn:
+            return await conn.run_sync(
+                lambda sync: (
+                    set(inspect(sync).get_table_names()),
+                    {i["name"] for i in inspect(sync).get_indexes("census_records")},
+                )
+            )
+
+    tables, indexes = client.run(schema())
+    assert {"users", "census_records", "loaded_datasets", "schema_version"} <= tables
+    assert {index.name for index in CensusRecord.__table__.indexes} <= indexes
+
+
+def test_second_boot_keeps_data(client):
+    add_record(client)
+    assert client.run(init_models()) == LATEST
+    assert versions(client) == [LATEST]
+    assert count_records(client) == 1
+
+
+def test_reset_on_startup_wipes_data(client, monkeypatch):
+    add_record(client)
+    monkeypatch.setattr(settings, "RESET_DB_ON_STARTUP", True)
+    assert client.run(init_models()) == LATEST
+    assert versions(client) == [LATEST]
+    assert count_records(client) == 0
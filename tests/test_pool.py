@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database import TimedQueuePool, engine_options, pool_stats
+
+
+def run(tmp_path, test):
+    # A pool of one connection that gives up waiting for it quickly
+    db = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+        poolclass=TimedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05,
+    )
+
+    async def main():
+        try:
+            await test(db)
+        finally:
+            await db.dispose()
+
+    asyncio.run(main())
+
+
+def test_sqlite_picks_its_own_pool():
+    assert "poolclass" not in engine_options("sqlite+aiosqlite:///census.db")
+    options = engine_options("postgresql+asyncpg://census@db/census")
+    assert options["poolclass"] is TimedQueuePool
+
+
+def test_counts_checkouts(tmp_path):
+    async def test(db):
+        for _ in range(3):
+            async with db.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        stats = pool_stats(db)
+        assert stats["pool"] == "TimedQueuePool"
+        assert stats["checkouts"] == 3
+        assert stats["timeouts"] == 0
+        assert stats["checked_out"] == 0
+        assert stats["checked_in"] == 1
+        assert stats["wait_seconds_max"] <= stats["wait_seconds_total"]
+        assert stats["wait_seconds_avg"] == pytest.approx(
+            stats["wait_seconds_total"] / 3
+        )
+
+    run(tmp_path, test)
+
+
+def test_counts_timeouts(tmp_path):
+    async def test(db):
+        async with db.connect():
+            assert pool_stats(db)["checked_out"] == 1
+            with pytest.raises(exc.TimeoutError):
+                async with db.connect():
+                    pass
+        stats = pool_stats(db)
+        assert (stats["checkouts"], stats["timeouts"]) == (1, 1)
+        # The wait that timed out isn't counted as one
+        assert stats["wait_seconds_max"] < 0.05
+
+    run(tmp_path, test)
+
+
+def test_counters_survive_recreate(tmp_path):
+    async def test(db):
+        async with db.connect():
+            pass
+        pool = db.sync_engine.pool
+        pool.timeouts = 2
+        fresh = pool.recreate()
+        assert (fresh.checkouts, fresh.timeouts) == (1, 2)
+        assert fresh.wait_seconds_total == pool.wait_seconds_total
+        assert fresh.wait_seconds_max == pool.wait_seconds_max
+
+    run(tmp_path, test)
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from app.core.services import cube
+from app.core.services.cube import AgeBuckets, CensusCube
+from app.core.services.record import make_comparisons
+from app.schemas.request import Request
+
+
+def row(race, income, pop, year=2019, age_range="25-34"):
+    # Same numbers for both sexes, curr dollars above 2019 ones
+    return (race, year, age_range, pop, income, income - 1, pop, income, income - 1)
+
+
+def compare(monkeypatch, rows, **request):
+    monkeypatch.setattr(cube, "_cube", CensusCube.from_rows(rows))
+    request = Request(**{"year": 2019, "age": 30, **request})
+    return asyncio.run(make_comparisons([request], None))[0]
+
+
+def test_head_and_differences_span_every_race(monkeypatch):
+    rows = [row("asian", 500, 10), row("black", 900, 40), row("white", 700, 25)]
+    male = compare(monkeypatch, rows)["comparison"]["male"]
+    assert male.head == "black"
+    assert male.income_difference == 400
+    assert male.population_difference == 30
+
+
+def test_ties_go_to_the_race_that_sorts_first(monkeypatch):
+    rows = [row("white", 900, 10), row("black", 900, 20), row("asian", 500, 30)]
+    assert compare(monkeypatch, rows)["comparison"]["female"].head == "black"
+
+
+def test_races_missing_a_year_sit_out(monkeypatch):
+    rows = [
+        row("asian", 500, 10),
+        row("white", 700, 25),
+        row("black", 100, 90, year=2018),
+    ]
+    male = compare(monkeypatch, rows)["comparison"]["male"]
+    assert male.head == "white"
+    assert male.income_difference == 200
+    assert male.population_difference == 15
+
+
+def test_single_race_compares_to_itself(monkeypatch):
+    male = compare(monkeypatch, [row("white", 700, 25)])["comparison"]["male"]
+    assert male.head == "white"
+    assert male.income_difference == male.population_difference == 0
+
+
+def test_percent_changes_for_any_race(monkeypatch):
+    rows = [
+        row("asian", 500, 10),
+        row("black", 900, 40),
+        row("black", 600, 20, year=2010),
+    ]
+    result = compare(monkeypatch, rows, race="black", base_year=2010)
+    male = result["comparison"]["male"]
+    assert male.percent_change_income == 150
+    assert male.percent_change_pop == 200
+
+
+def test_known_race_without_data_is_an_error(monkeypatch):
+    rows = [row("asian", 500, 10), row("black", 900, 40, year=2018)]
+    assert compare(monkeypatch, rows, race="black") == {
+        "error": "query does not match any data for race black"
+    }
+
+
+BUCKETS = AgeBuckets(["25-34", "15-24", "Over 75", "65-74", "not an age"])
+
+
+@pytest.mark.parametrize("age, age_range", [
+    (14, None),
+    (15, "15-24"),
+    (24, "15-24"),
+    (25, "25-34"),
+    (34, "25-34"),
+    # Gap between ranges
+    (35, None),
+    (64, None),
+    (65, "65-74"),
+    (74, "65-74"),
+    (75, "Over 75"),
+    (120, "Over 75"),
+])
+def test_age_buckets(age, age_range):
+    assert BUCKETS.find([age]) == [age_range]
+
+
+def test_age_buckets_skip_labels_they_cant_parse():
+    assert BUCKETS.labels == ["15-24", "25-34", "65-74", "Over 75"]
+
+
+def test_age_buckets_find_in_bulk():
+    assert BUCKETS.find([40, 15, 80]) == [None, "15-24", "Over 75"]
+    assert BUCKETS.find([]) == []
+
+
+def test_empty_age_buckets():
+    assert AgeBuckets([]).find([30, 80]) == [None, None]
@@ -0,0 +1,107 @@
+import asyncio
+
+from app import database
+from app.database import AsyncSessionLocal, ReplicaSet, is_replica_session
+
+
+def replica_set(tmp_path, *names, selection="round_robin", retry_seconds=30.0):
+    # A SQLite file per replica, ones under a missing dir can't be opened
+    uris = [f"sqlite+aiosqlite:///{tmp_path / name}" for name in names]
+    return ReplicaSet(uris, selection, retry_seconds, connect_timeout=1.0)
+
+
+def run(replicas, test):
+    async def main():
+        try:
+            await test(replicas)
+        finally:
+            await replicas.close()
+
+    asyncio.run(main())
+
+
+def test_round_robin_alternates(tmp_path):
+    async def test(replicas):
+        a, b = replicas.replicas
+        await replicas.check()
+        assert [replicas.pick() for _ in range(4)] == [a, b, a, b]
+
+    run(replica_set(tmp_path, "a.db", "b.db"), test)
+
+
+def test_least_busy_prefers_fewest_in_flight(tmp_path):
+    async def test(replicas):
+        a, b = replicas.replicas
+        await replicas.check()
+        a.in_flight = 2
+        assert [replicas.pick() for _ in range(3)] == [b, b, b]
+        # Equally busy, back to taking turns
+        a.in_flight = b.in_flight = 0
+        assert {replicas.pick(), replicas.pick()} == {a, b}
+
+    run(replica_set(tmp_path, "a.db", "b.db", selection="least_busy"), test)
+
+
+def test_down_replica_is_skipped(tmp_path):
+    async def test(replicas):
+        a, down = replicas.replicas
+        await replicas.check()
+        assert down.healthy is False
+        assert down.failures == 1
+        assert [replicas.pick() for _ in range(3)] == [a, a, a]
+        assert replicas.fallbacks == 0
+
+    run(replica_set(tmp_path, "a.db", "missing/b.db"), test)
+
+
+def test_falls_back_to_primary_with_none_up(tmp_path):
+    async def test(replicas):
+        await replicas.check()
+        assert replicas.pick() is None
+        assert replicas.pick() is None
+        assert replicas.fallbacks == 2
+
+    run(replica_set(tmp_path, "missing/a.db", "missing/b.db"), test)
+
+
+def test_pick_never_waits_on_a_probe(tmp_path):
+    async def test(replicas):
+        (a,) = replicas.replicas
+        # Never checked, so this request goes to the primary while it's probed
+        assert replicas.pick() is None
+        assert a.probe is not None
+        await a.probe
+        assert replicas.pick() is a
+
+    run(replica_set(tmp_path, "a.db"), test)
+
+
+def test_recovers_after_retry_window(tmp_path):
+    async def test(replicas):
+        a, b = replicas.replicas
+        await replicas.check()
+        assert b.healthy is False
+        (tmp_path / "missing").mkdir()
+        # Still inside its retry window, not even probed
+        assert [replicas.pick() for _ in range(2)] == [a, a]
+        assert b.probe is None
+        await asyncio.sleep(0.1)
+        # Due a retry, probed in the background while a keeps serving
+        assert replicas.pick() is a
+        await b.probe
+        assert b.healthy is True
+        assert {replicas.pick(), replicas.pick()} == {a, b}
+
+    run(replica_set(tmp_path, "a.db", "missing/b.db", retry_seconds=0.05), test)
+
+
+def test_knows_replica_sessions(tmp_path, monkeypatch):
+    async def test(replicas):
+        monkeypatch.setattr(database, "replicas", replicas)
+        (a,) = replicas.replicas
+        async with a.session_factory() as session:
+            assert is_replica_session(session)
+        async with AsyncSessionLocal() as session:
+            assert not is_replica_session(session)
+
+    run(replica_set(tmp_path, "a.db"), test)
@@ -0,0 +1,69 @@
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.core.services import serialize
+from app.models.record import CensusRecord
+from app.schemas.comparison import Comparison
+from app.schemas.record import RecordOut
+
+RECORD = CensusRecord(
+    id=5,
+    race="asian",
+    age_range="15-24",
+    year=2016,
+    num_males_with_income=861,
+    male_median_income_curr_dollars=11626.5,
+    male_median_income_2019_dollars=12386.0,
+    num_females_with_income=805,
+    female_median_income_curr_dollars=9377.0,
+    female_median_income_2019_dollars=9990.25,
+)
+
+
+# Without orjson dumps falls back to the stdlib's default separators
+needs_orjson = pytest.mark.skipif(serialize.orjson is None, reason="needs orjson")
+
+
+@pytest.fixture(autouse=True)
+def fast_json(monkeypatch):
+    monkeypatch.setattr(serialize, "FAST_JSON", True)
+
+
+def model_body(content):
+    # What FastAPI sends without FAST_JSON
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def fast_body(content):
+    return serialize.FastJSONResponse(content).body
+
+
+@needs_orjson
+def test_record_dict_matches_record_out():
+    assert serialize.record_dict(RECORD) == RecordOut.from_orm(RECORD).dict()
+    assert fast_body(serialize.record_dict(RECORD)) == model_body(
+        RecordOut.from_orm(RECORD)
+    )
+
+
+@needs_orjson
+@pytest.mark.parametrize("side", [
+    (3657.0, "white", 10047.0, 101.25, 98.5),
+    # Differences out of float math get truncated, same as Comparison does
+    (820.75, "asian", -9505.5, None, None),
+    (0.0, "black", 0.0, -12.5, 0.0),
+])
+def test_comparison_matches_model(side):
+    fast = serialize.comparison(*side)
+    model = Comparison(
+        income_difference=side[0],
+        head=side[1],
+        population_difference=side[2],
+        percent_change_income=side[3],
+        percent_change_pop=side[4],
+    )
+    result = {"year": 2019, "sex": None, "age": 30}
+    assert fast_body({**result, "comparison": {"male": fast}}) == model_body(
+        {**result, "comparison": {"male": model}}
+    )
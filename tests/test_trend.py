@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+YEARS = (2010, 2011, 2012, 2013)
+# (income, population) per year, asian has no 2012
+WHITE = ((100, 10), (150, 20), (120, 20), (180, 15))
+ASIAN = ((80, 5), (150, 10), None, (200, 30))
+
+
+def record(race, year, income, pop):
+    # Females earn twice as much, curr dollars are what counts
+    return {
+        "race": race,
+        "age_range": "25-34",
+        "year": year,
+        "num_males_with_income": pop,
+        "male_median_income_curr_dollars": income,
+        "male_median_income_2019_dollars": income - 1,
+        "num_females_with_income": pop,
+        "female_median_income_curr_dollars": income * 2,
+        "female_median_income_2019_dollars": income * 2 - 1,
+    }
+
+
+@pytest.fixture
+def census(client, auth_headers):
+    rows = [
+        record(race, year, *point)
+        for race, points in (("white", WHITE), ("asian", ASIAN))
+        for year, point in zip(YEARS, points)
+        if point is not None
+    ]
+    result = client.post(
+        "/data/records/bulk",
+        data="\n".join(json.dumps(row) for row in rows).encode(),
+        headers=auth_headers,
+    ).json()
+    assert result["rows_inserted"] == len(rows)
+
+
+def trend(client, auth_headers, **request):
+    body = {"race": "white", "age": 30, "year_from": 2010, "year_to": 2013, **request}
+    response = client.post("/data/trend", json=body, headers=auth_headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def column(points, field):
+    return [point[field] for point in points]
+
+
+def test_percent_changes(client, auth_headers, census):
+    result = trend(client, auth_headers, sex="male")
+    assert (result["age_range"], result["gap"]) == ("25-34", "white - asian")
+    assert list(result["trend"]) == ["male"]
+    male = result["trend"]["male"]
+    assert column(male, "year") == list(YEARS)
+    assert column(male, "income") == [100, 150, 120, 180]
+    assert column(male, "population") == [10, 20, 20, 15]
+    assert column(male, "percent_change_income_yoy") == pytest.approx(
+        [None, 50, -20, 50]
+    )
+    assert column(male, "percent_change_income_cumulative") == pytest.approx(
+        [0, 50, 20, 80]
+    )
+    assert column(male, "percent_change_pop_yoy") == pytest.approx([None, 100, 0, -25])
+    assert column(male, "percent_change_pop_cumulative") == pytest.approx(
+        [0, 100, 100, 50]
+    )
+
+
+def test_white_asian_gap(client, auth_headers, census):
+    result = trend(client, auth_headers, race="asian")
+    male, female = result["trend"]["male"], result["trend"]["female"]
+    # Missing a year on either side leaves a hole in the gap
+    assert column(male, "income_gap") == [20, 0, None, -20]
+    assert column(female, "income_gap") == [40, 0, None, -40]
+    assert column(male, "population_gap") == [5, 10, None, -15]
+    # asian's own series skips its missing year
+    assert column(male, "income") == [80, 150, None, 200]
+    assert column(male, "percent_change_income_yoy")[3] is None
+    assert column(male, "percent_change_income_cumulative")[3] == pytest.approx(150)
+
+
+def test_years_before_the_first_with_data(client, auth_headers, census):
+    result = trend(client, auth_headers, age_range="25-34", year_from=2008)
+    male = result["trend"]["male"]
+    assert column(male, "income")[:3] == [None, None, 100]
+    # Cumulative changes are against the first year we have
+    assert column(male, "percent_change_income_cumulative")[2:4] == [0, 50]
+
+
+def test_no_data_in_range(client, auth_headers, census):
+    assert trend(client, auth_headers, year_from=1990, year_to=1999) == {
+        "error": "query does not match any data for race white"
+    }
+    assert trend(client, auth_headers, race="martian") == {
+        "error": "query does not match any data for race martian"
+    }